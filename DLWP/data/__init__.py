@@ -9,3 +9,5 @@ Data retrieval classes.
 """
 
 from .cfsr import CFSReanalysis, CFSReforecast
+from .grid import Regridder, GridLocator
+from .catalog import FileCatalog
@@ -0,0 +1,170 @@
+#
+# Copyright (c) 2017-18 Jonathan Weyn <jweyn@uw.edu>
+#
+# See the file LICENSE for your rights.
+#
+
+"""
+Lazy access to a collection of data files split along a time dimension.
+"""
+
+import os
+import json
+import threading
+import numpy as np
+import pandas as pd
+import xarray as xr
+import netCDF4
+from xarray.backends import CachingFileManager, NetCDF4DataStore
+from xarray.backends.lru_cache import LRUCache
+
+
+class FileCatalog(object):
+    """
+    Catalog of a collection of netCDF files, e.g., the monthly files of processed CFS data, which are split along a
+    time dimension. The time coordinate, variables, and shapes of each file are recorded in a small JSON index file, so
+    that opening the catalog reads no data files. Only the files that contain the requested times are opened by sel().
+    The netCDF handles of the opened files are kept in a bounded least-recently-used pool owned by the catalog: a
+    file whose handle was closed to make room for another is reopened through the pool when the lazy data selected
+    from it are read, so the bound holds for as long as the selected data are in use.
+    """
+
+    def __init__(self, files, index_file=None, concat_dim='time', max_open_files=32, **dataset_kwargs):
+        """
+        Initialize a FileCatalog.
+
+        :param files: list of str: paths to the data files
+        :param index_file: str: path to the JSON index file. If it exists, the entries of files which have not changed
+            since are read from it; other files are indexed and the index file is updated. If None, the files are
+            indexed every time.
+        :param concat_dim: str: name of the time dimension along which the files are split
+        :param max_open_files: int: maximum number of file handles to keep open at once
+        :param dataset_kwargs: kwargs passed to xarray.open_dataset() for each file, which is opened with the netCDF4
+            library. By default, files are opened with chunks={}, so that data are read lazily with dask.
+        """
+        if int(max_open_files) < 1:
+            raise ValueError("'max_open_files' must be >= 1")
+        self.files = list(files)
+        self.index_file = index_file
+        self.concat_dim = concat_dim
+        self._max_open_files = int(max_open_files)
+        self._dataset_kwargs = dict({'chunks': {}}, **dataset_kwargs)
+        self._file_cache = LRUCache(self._max_open_files, on_evict=lambda key, handle: handle.close())
+        self._datasets = {}
+        self._lock = threading.Lock()
+        self.index = {}
+        self._build_index()
+
+    def _index_entry(self, file_name):
+        # Time coordinate (ns since the epoch), variables, and shapes of a file
+        with xr.open_dataset(file_name) as ds:
+            times = pd.DatetimeIndex(ds[self.concat_dim].values)
+            return {
+                'times': times.asi8.tolist(),
+                'variables': {v: {'dims': list(ds[v].dims), 'shape': list(ds[v].shape)} for v in ds.data_vars}
+            }
+
+    def _build_index(self):
+        saved = {}
+        if self.index_file is not None and os.path.isfile(self.index_file):
+            try:
+                with open(self.index_file, 'r') as fid:
+                    saved = json.load(fid)
+                if saved.get('concat_dim') != self.concat_dim:
+                    saved = {}
+            except (IOError, OSError, ValueError):
+                saved = {}
+        saved_files = saved.get('files', {})
+        updated = False
+        for file_name in self.files:
+            if not os.path.isfile(file_name):
+                raise IOError('file %s not found' % file_name)
+            stat = os.stat(file_name)
+            source = {'size': stat.st_size, 'mtime': stat.st_mtime}
+            key = os.path.abspath(file_name)
+            entry = saved_files.get(key)
+            if entry is None or entry.get('source') != source:
+                entry = self._index_entry(file_name)
+                entry['source'] = source
+                saved_files[key] = entry
+                updated = True
+            self.index[file_name] = entry
+        if updated and self.index_file is not None:
+            try:
+                temp_file = '%s.%d.tmp' % (self.index_file, os.getpid())
+                with open(temp_file, 'w') as fid:
+                    json.dump({'concat_dim': self.concat_dim, 'files': saved_files}, fid)
+                os.replace(temp_file, self.index_file)
+            except (IOError, OSError) as e:
+                print("* Warning: unable to save catalog index file %s ('%s')" % (self.index_file, str(e)))
+
+    @property
+    def times(self):
+        """
+        :return: pandas DatetimeIndex: all times in the catalog, in the order of the files
+        """
+        return pd.DatetimeIndex(np.concatenate([np.array(self.index[f]['times'], dtype='datetime64[ns]')
+                                                for f in self.files]))
+
+    @property
+    def variables(self):
+        """
+        :return: list of str: names of the variables in any of the files
+        """
+        variables = []
+        for f in self.files:
+            variables.extend([v for v in self.index[f]['variables'] if v not in variables])
+        return variables
+
+    def _open(self, file_name):
+        # Get the Dataset of a file, opening it if necessary. Its netCDF handle is managed by the catalog's pool, which
+        # closes the least recently used handle when full and reopens closed handles when their data are read.
+        with self._lock:
+            if file_name not in self._datasets:
+                manager = CachingFileManager(netCDF4.Dataset, file_name, mode='r', cache=self._file_cache)
+                self._datasets[file_name] = xr.open_dataset(NetCDF4DataStore(manager), **self._dataset_kwargs)
+            return self._datasets[file_name]
+
+    def sel(self, time=None, variables=None):
+        """
+        Select data from the catalog, opening only the files which contain the requested times.
+
+        :param time: datetime, or iterable of datetimes, or slice of datetimes: times to select. If None, select all
+            times in the catalog.
+        :param variables: list of str: variables to select. If None, select all variables.
+        :return: xarray Dataset: selected data, concatenated along the time dimension
+        """
+        datasets = []
+        for file_name in self.files:
+            file_times = pd.DatetimeIndex(np.array(self.index[file_name]['times'], dtype='datetime64[ns]'))
+            if time is None:
+                file_sel = None
+            elif isinstance(time, slice):
+                file_sel = file_times[(time.start is None or file_times >= pd.Timestamp(time.start)) &
+                                      (time.stop is None or file_times <= pd.Timestamp(time.stop))]
+            else:
+                file_sel = file_times[file_times.isin(pd.DatetimeIndex(np.atleast_1d(time)))]
+            if file_sel is not None and len(file_sel) == 0:
+                continue
+            ds = self._open(file_name)
+            if variables is not None:
+                ds = ds[[v for v in variables if v in ds.data_vars]]
+            if file_sel is not None:
+                ds = ds.sel(**{self.concat_dim: file_sel})
+            datasets.append(ds)
+        if len(datasets) == 0:
+            raise KeyError('no data in the catalog for the requested times')
+        result = xr.concat(datasets, dim=self.concat_dim, data_vars='minimal', coords='minimal', compat='override')
+        if time is not None and not isinstance(time, slice):
+            # Return the times in the requested order; raises KeyError for times not in the catalog
+            result = result.sel(**{self.concat_dim: time})
+        return result
+
+    def close(self):
+        """
+        Close all open files.
+        """
+        with self._lock:
+            for ds in self._datasets.values():
+                ds.close()
+            self._datasets = {}
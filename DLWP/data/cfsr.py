@@ -11,18 +11,27 @@ degree grid may come in the future.
 """
 
 import os
+import json
+import shutil
 import warnings
 import itertools as it
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
 import netCDF4 as nc
 import pandas as pd
 import xarray as xr
-from scipy.interpolate import RectBivariateSpline
 from datetime import datetime, timedelta
+from .grid import Regridder, GridLocator
+from .catalog import FileCatalog
 try:
-    from urllib.request import urlopen
+    from urllib.request import urlopen, Request
+    from urllib.error import HTTPError
+    from http.client import HTTPException
 except ImportError:
-    from urllib import urlopen
+    from urllib2 import urlopen, Request, HTTPError
+    from httplib import HTTPException
 try:
     import pygrib
 except ImportError:
@@ -59,6 +68,391 @@ def call_fetch(args):
     obj._fetch(*args[1:])
 
 
+def _download(remote_file, local_file, chunk_size=1048576, retries=3, timeout=60):
+    """
+    Download a file, streaming it in chunks to the temporary file '<local_file>.part'. A partial download left by an
+    earlier attempt is resumed with an HTTP Range request, if the server supports it. The temporary file is renamed to
+    local_file only once its size matches the size reported by the server.
+
+    :param remote_file: str: URL of the file
+    :param local_file: str: path of the local file
+    :param chunk_size: int: number of bytes to read at a time
+    :param retries: int: number of times to retry a failed download
+    :param timeout: float: timeout in seconds of each connection attempt and read
+    :return: int: size of the file in bytes
+    """
+    part_file = '%s.part' % local_file
+    for attempt in range(retries + 1):
+        try:
+            offset = os.path.getsize(part_file) if os.path.isfile(part_file) else 0
+            request = Request(remote_file)
+            if offset > 0:
+                request.add_header('Range', 'bytes=%d-' % offset)
+            response = urlopen(request, timeout=timeout)
+            try:
+                if offset > 0 and response.getcode() != 206:
+                    # The server ignored the range; start over
+                    offset = 0
+                content_range = response.headers.get('Content-Range')
+                content_length = response.headers.get('Content-Length')
+                if content_range is not None and '/' in content_range and not content_range.endswith('*'):
+                    size = int(content_range.split('/')[-1])
+                elif content_length is not None:
+                    size = offset + int(content_length)
+                else:
+                    size = None
+                with open(part_file, 'ab' if offset > 0 else 'wb') as fd:
+                    while True:
+                        chunk = response.read(chunk_size)
+                        if not chunk:
+                            break
+                        fd.write(chunk)
+            finally:
+                response.close()
+            local_size = os.path.getsize(part_file)
+            if size is not None and local_size != size:
+                raise IOError('incomplete download of %s: got %d of %d bytes' % (remote_file, local_size, size))
+            os.replace(part_file, local_file)
+            return local_size
+        except HTTPError as e:
+            if e.code == 416:
+                # The partial file is not a prefix of the remote file
+                os.remove(part_file)
+            elif 400 <= e.code < 500:
+                raise
+            if attempt == retries:
+                raise
+            print('warning: failed to download %s, retrying (%s)' % (remote_file, str(e)))
+        except (IOError, OSError, HTTPException) as e:
+            # HTTPException covers responses cut short or garbled in transfer, e.g. IncompleteRead
+            if attempt == retries:
+                raise
+            print('warning: failed to download %s, retrying (%s)' % (remote_file, str(e)))
+
+
+def _grib_file_index(file_name):
+    """
+    Get the index of the messages in a GRIB file. The index is read from the file '<file_name>.idx.json' if it is up to
+    date with the GRIB file; otherwise, all messages are scanned once and the index file is (re-)written for the next
+    time.
+
+    :param file_name: str: path to the GRIB file
+    :return: list: for each message, in order, a list of the values of grib_index_keys. Keys which cannot be read from a
+        message are None.
+    """
+    index_file = '%s.idx.json' % file_name
+    stat = os.stat(file_name)
+    source = {'size': stat.st_size, 'mtime': stat.st_mtime, 'keys': list(grib_index_keys)}
+    try:
+        with open(index_file, 'r') as fid:
+            index = json.load(fid)
+        if index['source'] == source:
+            return index['messages']
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        pass
+
+    # Position of each field in the file. pygrib's messages are copies, so their 'offset' key is not that in the file.
+    positions = [(offset, length, field) for offset, length, n_fields in _grib_message_layout(file_name)
+                 for field in range(n_fields)]
+    messages = []
+    grib_data = pygrib.open(file_name)
+    try:
+        for grb in grib_data:
+            message = []
+            for key in grib_index_keys[:5]:
+                try:
+                    message.append(int(grb[key]))
+                except (RuntimeError, KeyError, TypeError, ValueError):
+                    message.append(None)
+            message.append(int(grb.messagenumber))
+            messages.append(message)
+    finally:
+        grib_data.close()
+    if len(positions) != len(messages):
+        # Unexpected file layout; fields can still be read by their message number
+        positions = [(None, None, None)] * len(messages)
+    messages = [m[:5] + list(p) + m[5:] for m, p in zip(messages, positions)]
+    try:
+        # Write to a temporary file first, so that concurrent readers never see a partial index
+        with open('%s.%d' % (index_file, os.getpid()), 'w') as fid:
+            json.dump({'source': source, 'messages': messages}, fid)
+        os.replace('%s.%d' % (index_file, os.getpid()), index_file)
+    except (IOError, OSError) as e:
+        warnings.warn("unable to save GRIB index file %s ('%s')" % (index_file, str(e)))
+    return messages
+
+
+def _grib_message_layout(file_name):
+    """
+    Find the messages of a GRIB file from their section headers, without decoding them.
+
+    :param file_name: str: path to the GRIB file
+    :return: list: (byte offset, length in bytes, number of fields) of each message
+    """
+    layout = []
+    with open(file_name, 'rb') as fid:
+        offset = 0
+        while True:
+            fid.seek(offset)
+            header = fid.read(16)
+            if len(header) < 16 or header[:4] != b'GRIB':
+                break
+            if header[7] == 1:
+                # GRIB1 messages hold a single field
+                length = int.from_bytes(header[4:7], 'big')
+                n_fields = 1
+            else:
+                # A GRIB2 message holds one field for each data section (7) before the end section
+                length = int.from_bytes(header[8:16], 'big')
+                n_fields = 0
+                position = offset + 16
+                while position < offset + length - 4:
+                    fid.seek(position)
+                    section = fid.read(5)
+                    if len(section) < 5:
+                        break
+                    section_length = int.from_bytes(section[:4], 'big')
+                    if section_length < 5:
+                        break
+                    if section[4] == 7:
+                        n_fields += 1
+                    position += section_length
+            layout.append((offset, length, n_fields))
+            offset += length
+    return layout
+
+
+def _read_grib_lat_lon(file_name):
+    """
+    Read the 1d latitude and longitude coordinates of the regular grid of a GRIB file.
+
+    :param file_name: str: path to the GRIB file
+    :return: lat, lon: 1d float32 ndarrays
+    """
+    exists, exists_file_name = _check_exists(file_name, path=True)
+    if not exists:
+        raise IOError('File %s not found.' % file_name)
+    grib_data = pygrib.open(file_name)
+    try:
+        lats = np.array(grib_data[1]['latitudes'], dtype=np.float32)
+        lons = np.array(grib_data[1]['longitudes'], dtype=np.float32)
+        shape = grib_data[1].values.shape
+        lat = lats.reshape(shape)[:, 0]
+        lon = lons.reshape(shape)[0, :]
+    except BaseException:
+        print('* Warning: cannot get lat/lon from grib file %s' % exists_file_name)
+        raise
+    finally:
+        grib_data.close()
+    return lat, lon
+
+
+def _check_interpolate(interpolate, method):
+    """
+    Check the 'interpolate' and 'interpolate_method' parameters of the CFS write methods.
+    """
+    if len(interpolate) != 2:
+        raise ValueError("'interpolate' must be a tuple of length 2")
+    if len(interpolate[0].shape) != 1:
+        raise ValueError("lat in 'interpolate' must be 1 dimensional")
+    if len(interpolate[1].shape) != 1:
+        raise ValueError("lon in 'interpolate' must be 1 dimensional")
+    if method not in Regridder.methods:
+        raise ValueError("'interpolate_method' must be one of %s" % (Regridder.methods,))
+
+
+def _init_zarr_store(store, template, times, variables, write_into_existing=True):
+    """
+    Create a consolidated zarr store for processed CFS data, or extend an existing one with new variables and later
+    times. Only metadata are written; the data are filled in afterwards by region writes.
+
+    :param store: str: path to the zarr store
+    :param template: function: template(times, variables) returns a Dataset of lazy (dask) arrays with the
+        coordinates and variables of the store for the given times and variable names
+    :param times: pandas DatetimeIndex: times of the data to be written
+    :param variables: list of str: names of the variables to be written
+    :param write_into_existing: bool: if False, an existing store is deleted first
+    """
+    if os.path.exists(store) and not write_into_existing:
+        shutil.rmtree(store)
+    if not os.path.exists(store):
+        template(times, variables).to_zarr(store, mode='w-', compute=False, consolidated=True)
+        return
+    existing = xr.open_zarr(store, consolidated=True)
+    existing_times = pd.DatetimeIndex(existing['time'].values)
+    existing_variables = list(existing.data_vars.keys())
+    existing.close()
+    if times[0] < existing_times[0]:
+        raise ValueError('cannot write dates before the start of the existing zarr store %s (%s)' %
+                         (store, existing_times[0]))
+    new_variables = [v for v in variables if v not in existing_variables]
+    if len(new_variables) > 0:
+        template(existing_times, new_variables).to_zarr(store, mode='a', compute=False, consolidated=True)
+    new_times = times[times > existing_times[-1]]
+    if len(new_times) > 0:
+        new_times = pd.date_range(existing_times[-1], new_times[-1], freq=existing_times[-1] - existing_times[-2])[1:]
+        template(new_times, existing_variables + new_variables).to_zarr(store, append_dim='time', compute=False,
+                                                                       consolidated=True)
+
+
+def _zarr_time_axis(store):
+    """
+    :param store: str: path to a zarr store created by _init_zarr_store
+    :return: list of datetime: time coordinate of the store
+    """
+    ds = xr.open_zarr(store, consolidated=True)
+    time_axis = list(pd.DatetimeIndex(ds['time'].values).to_pydatetime())
+    ds.close()
+    return time_axis
+
+
+def _remove_grib_file(file_name):
+    """
+    Delete a GRIB file and its index file, if they exist.
+
+    :param file_name: str: path to the GRIB file
+    """
+    for f in [file_name, '%s.idx.json' % file_name]:
+        if os.path.isfile(f):
+            os.remove(f)
+
+
+def _read_grib_message(fid, offset, length):
+    """
+    Read a single GRIB message at a known position in a file. Only the first field of a multi-field message is decoded.
+
+    :param fid: file object: GRIB file opened in binary mode
+    :param offset: int: byte offset of the message
+    :param length: int: length of the message in bytes
+    :return: pygrib.gribmessage
+    """
+    fid.seek(offset)
+    return pygrib.fromstring(fid.read(length))
+
+
+class _GribFieldReader(object):
+    """
+    Read the fields of a GRIB file by their position in the file's index. The first field of a message is decoded
+    straight from the bytes of the message. pygrib.fromstring cannot reach the later fields of 'multi-field' messages,
+    so these are read by their message number in a pygrib.open instance, opened the first time one is needed.
+    """
+
+    def __init__(self, file_name):
+        """
+        :param file_name: str: path to the GRIB file
+        """
+        self.file_name = file_name
+        self._fid = open(file_name, 'rb')
+        self._grib_data = None
+
+    def read(self, offset, length, field, message_number):
+        """
+        :param offset: int: byte offset of the message
+        :param length: int: length of the message in bytes
+        :param field: int: position of the field within its message
+        :param message_number: int: pygrib message number of the field
+        :return: pygrib.gribmessage
+        """
+        if field == 0 and offset is not None:
+            return _read_grib_message(self._fid, offset, length)
+        if self._grib_data is None:
+            self._grib_data = pygrib.open(self.file_name)
+        return self._grib_data.message(message_number)
+
+    def close(self):
+        self._fid.close()
+        if self._grib_data is not None:
+            self._grib_data.close()
+            self._grib_data = None
+
+
+def _grib_index(messages):
+    """
+    Key the messages of a GRIB file index by parameter.
+
+    :param messages: list: index of the messages in a GRIB file, from _grib_file_index
+    :return: dict: (offset, length, field within the message, message number) of the messages keyed by (discipline,
+        parameterCategory, parameterNumber, level), and by (discipline, parameterCategory, parameterNumber) for the
+        first message of each parameter
+    """
+    index = {}
+    for message in messages:
+        key = tuple(message[:4])
+        if None in key:
+            continue
+        index.setdefault(key, tuple(message[5:9]))
+        index.setdefault(key[:3], tuple(message[5:9]))
+    return index
+
+
+def _decode_grib(file_name, keys, regridder=None):
+    """
+    Decode the requested fields of a GRIB file.
+
+    :param file_name: str: path to the GRIB file
+    :param keys: list of tuples: (discipline, parameterCategory, parameterNumber[, level]) of the requested fields
+    :param regridder: Regridder: if not None, regrid the decoded fields with it
+    :return: list: float32 ndarray of each field; None if it is not in the file, or the exception raised decoding it
+    """
+    index = _grib_index(_grib_file_index(file_name))
+    fields = []
+    reader = _GribFieldReader(file_name)
+    try:
+        for key in keys:
+            if key not in index:
+                fields.append(None)
+                continue
+            try:
+                fields.append(np.array(reader.read(*index[key]).values, dtype=np.float32))
+            except Exception as e:
+                # Interrupts are not caught, so that they stop the pool of decoding workers
+                fields.append(e)
+    finally:
+        reader.close()
+    if regridder is not None:
+        # Regrid all decoded fields at once
+        decoded = [n for n, field in enumerate(fields) if isinstance(field, np.ndarray)]
+        if len(decoded) > 0:
+            regridded = regridder(np.stack([fields[n] for n in decoded]))
+            for n, field in zip(decoded, regridded):
+                fields[n] = field
+    return fields
+
+
+def _decode_grib_files(file_names, keys, workers=4, regridder=None):
+    """
+    Generator decoding the requested fields of GRIB files in parallel, up to 2 * workers files ahead of the consumer.
+    Files are decoded in worker processes, or in threads if this is already a daemonic process (e.g. a worker of
+    multiprocessing.Pool), which may not have children.
+
+    :param file_names: iterable of str: paths to GRIB files
+    :param keys: list of tuples: (discipline, parameterCategory, parameterNumber[, level]) of the requested fields
+    :param workers: int: number of decoding workers. If <= 1, decode serially.
+    :param regridder: Regridder: if not None, regrid the decoded fields with it
+    :return: yields the result of _decode_grib for each file, in order
+    """
+    if workers <= 1:
+        for file_name in file_names:
+            yield _decode_grib(file_name, keys, regridder)
+        return
+    if multiprocessing.current_process().daemon:
+        executor = ThreadPoolExecutor(max_workers=workers)
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers)
+    pending = deque()
+    try:
+        for file_name in file_names:
+            pending.append(executor.submit(_decode_grib, file_name, keys, regridder))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
 # Format strings for files to read/write
 grib_dir_format = '%Y/%Y%m/%Y%m%d'
 grib_file_format = 'pgb{:s}{:s}.gdas.%Y%m%d%H.grb2'
@@ -71,6 +465,12 @@ data_end_date = datetime(2011, 3, 31)
 reforecast_start_date = datetime(1999, 1, 1)
 reforecast_end_date = datetime(2009, 12, 31, 18)
 
+# Keys of each message saved in the GRIB index files, '<grib_file>.idx.json'. Only the first five are read from the
+# decoded fields. The byte offset and length of the message holding each field, and the position of the field within
+# its (multi-field) message, come from the section headers of the file; the last is pygrib's message number.
+grib_index_keys = ('discipline', 'parameterCategory', 'parameterNumber', 'level', 'forecastTime', 'offset',
+                   'totalLength', 'fieldInMessage', 'messagenumber')
+
 # Parameter tables for GRIB data. Should be included in repository.
 dir_path = os.path.dirname(os.path.realpath(__file__))
 grib2_table = np.genfromtxt('%s/cfsr_pgb_grib_table.csv' % dir_path, dtype='str', delimiter=',')
@@ -130,9 +530,11 @@ class CFSReanalysis(object):
         self.inverse_lat = True
         # Data
         self.Dataset = None
+        self.catalog = None
         self.basemap = None
         self._lat_array = None
         self._lon_array = None
+        self._locator = None
 
     @property
     def lat(self):
@@ -199,19 +601,22 @@ class CFSReanalysis(object):
     def closest_lat_lon(self, lat, lon):
         """
         Find the grid-point index of the closest point to the specified latitude and longitude values in loaded
-        CFS reanalysis data.
+        CFS reanalysis data. Many points may be located at once by passing arrays; the grid index is built once per
+        opened Dataset.
 
-        :param lat: float or int: latitude in degrees
-        :param lon: float or int: longitude in degrees
-        :return:
+        :param lat: float or array: latitude(s) in degrees
+        :param lon: float or array: longitude(s) in degrees
+        :return: tuple of (lat, lon) grid indices, ints or arrays of the shape of lat
         """
-        if lon < 0.:
-            lon += 360.
-        distance = (self.lat - lat) ** 2 + (self.lon - lon) ** 2
-        min_dist = 2.5 if self._resolution == 'l' else 1.
-        if np.min(distance) > min_dist:
-            raise ValueError('no latitude/longitude points within 1 degree of requested lat/lon!')
-        return np.unravel_index(np.argmin(distance, axis=None), distance.shape)
+        if self._locator is None:
+            self._locator = GridLocator(self.lat, self.lon)
+        index, distance = self._locator.closest(lat, lon, return_distance=True)
+        max_dist = 1.6 if self._resolution == 'l' else 1.
+        if np.any(distance > max_dist):
+            raise ValueError('no latitude/longitude points within %g degree(s) of requested lat/lon!' % max_dist)
+        if np.ndim(lat) == 0 and np.ndim(lon) == 0:
+            return tuple(int(i) for i in index)
+        return index
 
     def retrieve(self, dates, n_proc=4, verbose=False):
         """
@@ -221,8 +626,9 @@ class CFSReanalysis(object):
 
         :param dates: list or tuple: date or datetime objects of of analysis times. May be 'all', in which case
             all dates in the object's 'dataset_dates' attributes are retrieved.
-        :param n_proc: int: if >1, fetches files in parallel. This speeds up performance but may not scale well if
-            internet I/O is the bottleneck. Set to 0 to use all available threads.
+        :param n_proc: int: if >1, fetches files in parallel, with this many concurrent downloads. This speeds up
+            performance but may not scale well if internet I/O is the bottleneck. Set to 0 to use as many downloads as
+            available threads. Each file is streamed to disk and resumed if a partial download exists.
         :param verbose: bool: include progress print statements
         :return: None
         """
@@ -253,24 +659,15 @@ class CFSReanalysis(object):
             if grib_file_name not in self.raw_files:
                 self.raw_files.append(grib_file_name)
 
-        if n_proc == 0 or n_proc > 1:
-            try:
-                import multiprocessing
-                if n_proc == 0:
-                    n_proc = multiprocessing.cpu_count()
-            except ImportError:
-                warnings.warn("'multiprocessing' module not available; falling back to serial")
-                n_proc = 1
+        if n_proc == 0:
+            n_proc = multiprocessing.cpu_count()
 
         if n_proc == 1:
             for file in self.raw_files:
                 call_fetch((self, file, verbose))
         else:
-            pool = multiprocessing.Pool(processes=n_proc)
-            pool.map(call_fetch, zip(it.repeat(self), self.raw_files, it.repeat(verbose)))
-            pool.close()
-            pool.terminate()
-            pool.join()
+            with ThreadPoolExecutor(max_workers=n_proc) as executor:
+                list(executor.map(call_fetch, zip(it.repeat(self), self.raw_files, it.repeat(verbose))))
 
     def _fetch(self, f, verbose):
         pid = os.getpid()
@@ -283,25 +680,19 @@ class CFSReanalysis(object):
         if verbose:
             print('PID %s: downloading %s' % (pid, remote_file))
         try:
-            response = urlopen(remote_file)
-            with open(local_file, 'wb') as fd:
-                fd.write(response.read())
+            _download(remote_file, local_file)
         except BaseException as e:
-            print('warning: failed to download %s, retrying' % remote_file)
-            try:
-                response = urlopen(remote_file)
-                with open(local_file, 'wb') as fd:
-                    fd.write(response.read())
-            except BaseException as e:
-                print('warning: failed to download %s' % remote_file)
-                print('* Reason: "%s"' % str(e))
+            print('warning: failed to download %s' % remote_file)
+            print('* Reason: "%s"' % str(e))
 
     def write(self, variables='all', dates='all', levels='all', write_into_existing=True, omit_existing=False,
-              delete_raw_files=False, n_proc=4, verbose=False):
+              delete_raw_files=False, n_proc=4, decode_workers=4, interpolate=None, interpolate_method='bicubic',
+              file_format='netcdf', verbose=False):
         """
         Reads raw CFS reanalysis files for the given dates (list or tuple form) and specified variables and levels and
         writes the data to reformatted netCDF files. Processed files are saved under self._root_directory/processed;
-        one file per month is created.
+        one file per month is created. Alternatively, writes all data to a single consolidated zarr store, filled in
+        by parallel writes of each month's region.
 
         :param variables: list: list of variables to retrieve from data or 'all'
         :param dates: list or tuple of datetime: date or datetime objects of model initialization; may be 'all', in
@@ -317,6 +708,17 @@ class CFSReanalysis(object):
             made
         :param n_proc: int: if >1, runs write tasks in parallel, one per month of data. This speeds up performance but
             may not scale well if disk I/O is the bottleneck. Set to 0 to use all available threads.
+        :param decode_workers: int: number of workers decoding the GRIB files of each month in parallel, while a single
+            writer fills the netCDF file. Worker processes are used if n_proc is 1, or threads otherwise. Set to 1 to
+            decode serially.
+        :param interpolate: tuple of (lat, lon) 1-d coordinates: if not None, interpolates from the regular grid to
+            a new regular grid. Latitude may be ascending or descending. Longitude must be 0-360.
+        :param interpolate_method: str: 'bilinear', 'bicubic', or 'conservative'; see DLWP.data.grid.Regridder. The
+            interpolation weights are cached in the processed directory.
+        :param file_format: str: 'netcdf' for monthly netCDF files, or 'zarr' for the single zarr store
+            self.zarr_file. The store is created, or extended with new variables and later dates, before the months are
+            processed; each month's data are stored in separate chunks. With 'zarr', write_into_existing=False replaces
+            the whole store, and omit_existing skips the months for which the store already has data.
         :param verbose: bool: include progress print statements
         :return:
         """
@@ -328,6 +730,8 @@ class CFSReanalysis(object):
         else:
             self.set_dates(dates)
             dates = self.dataset_dates
+        if file_format not in ['netcdf', 'zarr']:
+            raise ValueError("'file_format' must be 'netcdf' or 'zarr'")
         if levels == 'all':
             levels = [l for l in self.level_coord]
         else:
@@ -345,6 +749,10 @@ class CFSReanalysis(object):
         if int(n_proc) < 0:
             raise ValueError("'multiprocess' must be an integer >= 0")
         self.dataset_variables = list(variables)
+        if interpolate is not None:
+            _check_interpolate(interpolate, interpolate_method)
+            self._ny = len(interpolate[0])
+            self._nx = len(interpolate[1])
 
         # Generate monthly batches of dates
         dates_index = pd.DatetimeIndex(dates).sort_values()
@@ -354,6 +762,10 @@ class CFSReanalysis(object):
         for nm in range(len(unique_months)):
             month_list.append(list(dates_index[months == unique_months[nm]].to_pydatetime()))
 
+        if file_format == 'zarr':
+            if not self._init_zarr(dates, unique_months, variables, interpolate, write_into_existing, verbose):
+                return
+
         if n_proc == 0 or n_proc > 1:
             try:
                 import multiprocessing
@@ -366,35 +778,95 @@ class CFSReanalysis(object):
         if n_proc == 1:
             for nm, month in enumerate(month_list):
                 call_process_month((self, nm, month, unique_months, variables, levels, write_into_existing,
-                                    omit_existing, delete_raw_files, verbose))
+                                    omit_existing, delete_raw_files, decode_workers, interpolate, interpolate_method,
+                                    file_format, verbose))
         else:
             pool = multiprocessing.Pool(processes=n_proc)
             pool.map(call_process_month, zip(it.repeat(self), range(len(month_list)), month_list,
                                              it.repeat(unique_months), it.repeat(variables), it.repeat(levels),
                                              it.repeat(write_into_existing), it.repeat(omit_existing),
-                                             it.repeat(delete_raw_files), it.repeat(verbose)))
+                                             it.repeat(delete_raw_files), it.repeat(decode_workers),
+                                             it.repeat(interpolate), it.repeat(interpolate_method),
+                                             it.repeat(file_format), it.repeat(verbose)))
             pool.close()
             pool.terminate()
             pool.join()
 
+    @property
+    def zarr_file(self):
+        """
+        :return: str: path to the zarr store of processed data
+        """
+        return '%s/processed/%scfsr.zarr' % (self._root_directory, self._file_id)
+
+    def _grib_file_name(self, dt):
+        grib_file_dir = datetime.strftime(dt, grib_dir_format)
+        grib_file_name = datetime.strftime(dt, grib_file_format.format(self._resolution, self._run_type))
+        return '%s/%s/%s' % (self._root_directory, grib_file_dir, grib_file_name)
+
+    def _init_zarr(self, dates, unique_months, variables, interpolate, write_into_existing, verbose):
+        # Create or extend the zarr store. Returns False if there is no raw file from which to get the grid.
+        import dask.array
+        if interpolate is not None:
+            lat, lon = interpolate
+        else:
+            for dt in dates:
+                try:
+                    lat, lon = _read_grib_lat_lon(self._grib_file_name(dt))
+                    break
+                except (IOError, OSError):
+                    continue
+            else:
+                print('CFSReanalysis.write: no raw files found for the grid coordinates; will do nothing.')
+                return False
+        level_variables = list(grib2_table[grib2_table[:, 6] == 'isobaricInhPa', 0])
+
+        def template(times, names):
+            data_vars = {}
+            for var in names:
+                row = list(grib2_table[:, 0]).index(var)
+                if var in level_variables:
+                    dims = ('time', 'level', 'lat', 'lon')
+                    shape = (len(times), len(self.level_coord), len(lat), len(lon))
+                else:
+                    dims = ('time', 'lat', 'lon')
+                    shape = (len(times), len(lat), len(lon))
+                data_vars[var] = xr.Variable(dims, dask.array.full(shape, np.nan, dtype=np.float32, chunks=shape), {
+                    'long_name': grib2_table[row, 4],
+                    'units': grib2_table[row, 5]
+                }, encoding={'chunks': (1,) * (len(shape) - 2) + shape[-2:]})
+            return xr.Dataset(data_vars, coords={
+                'time': ('time', times, {
+                    'long_name': 'Model initialization time'
+                }),
+                'level': ('level', np.array(self.level_coord, dtype=np.float32), {
+                    'long_name': 'Pressure level',
+                    'units': 'hPa'
+                }),
+                'lat': ('lat', np.array(lat, dtype=np.float32), {
+                    'long_name': 'Latitude',
+                    'units': 'degrees_north'
+                }),
+                'lon': ('lon', np.array(lon, dtype=np.float32), {
+                    'long_name': 'Longitude',
+                    'units': 'degrees_east'
+                })
+            }, attrs={
+                'description': 'Selected variables and levels from the CFS Reanalysis'
+            })
+
+        if verbose:
+            print('CFSReanalysis.write: initializing zarr store %s' % self.zarr_file)
+        os.makedirs('%s/processed' % self._root_directory, exist_ok=True)
+        times = pd.date_range(unique_months[0].start_time, unique_months[-1].end_time, freq=pd.Timedelta(hours=6))
+        _init_zarr_store(self.zarr_file, template, times, variables, write_into_existing=write_into_existing)
+        return True
+
     # Define a function for multi-processing
     def _process_month(self, m, month, unique_months, variables, levels, write_into_existing, omit_existing,
-                       delete_raw_files, verbose):
+                       delete_raw_files, decode_workers, interpolate, interpolate_method, file_format, verbose):
         # Define some data reading functions that also write to the output
-        def read_write_grib_lat_lon(file_name, nc_fid):
-            exists, exists_file_name = _check_exists(file_name, path=True)
-            if not exists:
-                raise IOError('File %s not found.' % file_name)
-            grib_data = pygrib.open(file_name)
-            try:
-                lats = np.array(grib_data[1]['latitudes'], dtype=np.float32)
-                lons = np.array(grib_data[1]['longitudes'], dtype=np.float32)
-                shape = grib_data[1].values.shape
-                lat = lats.reshape(shape)[:, 0]
-                lon = lons.reshape(shape)[0, :]
-            except BaseException:
-                print('* Warning: cannot get lat/lon from grib file %s' % exists_file_name)
-                raise
+        def write_lat_lon(lat, lon, nc_fid):
             if verbose:
                 print('PID %s: Writing latitude and longitude' % pid)
             nc_var = nc_fid.createVariable('lat', np.float32, ('lat',), zlib=True)
@@ -409,83 +881,51 @@ class CFSReanalysis(object):
                 'units': 'degrees_east'
             })
             nc_fid.variables['lon'][:] = lon
-            grib_data.close()
 
-        def read_write_grib(file_name, time_index, nc_fid):
-            exists, exists_file_name = _check_exists(file_name, path=True)
-            if not exists:
-                print('* Warning: file %s not found' % file_name)
-                return
-            if verbose:
-                print('PID %s: Reading %s' % (pid, exists_file_name))
-            grib_data = pygrib.open(file_name)
-            # Have to do this the hard way, because grib_index doesn't work on these 'multi-field' files
-            grib_index = []
-            grib_index_no_level = []
-            for grb in grib_data:
-                try:
-                    grib_index.append([int(grb.discipline), int(grb.parameterCategory),
-                                       int(grb.parameterNumber), int(grb.level)])
-                    grib_index_no_level.append([int(grb.discipline), int(grb.parameterCategory),
-                                                int(grb.parameterNumber)])
-                except RuntimeError:
-                    grib_index.append([])
-                    grib_index_no_level.append([])
-            if verbose:
-                print('PID %s: Variables to fetch: %s' % (pid, variables))
+        def create_variables(nc_fid):
+            # Create the requested variables and list the GRIB fields to write into them
+            fields = []
             for row in range(grib2_table.shape[0]):
                 var = grib2_table[row, 0]
-                if var in variables:
-                    if var not in nc_fid.variables.keys():
-                        if verbose:
-                            print('PID %s: Creating variable %s' % (pid, var))
-                        if grib2_table[row, 6] == 'isobaricInhPa':
-                            nc_var = nc_fid.createVariable(var, np.float32, ('time', 'level', 'lat', 'lon'), zlib=True)
-                        else:
-                            nc_var = nc_fid.createVariable(var, np.float32, ('time', 'lat', 'lon'), zlib=True)
-                        nc_var.setncatts({
-                            'long_name': grib2_table[row, 4],
-                            'units': grib2_table[row, 5],
-                            '_FillValue': fill_value
-                        })
+                if var not in variables:
+                    continue
+                if nc_fid is not None and var not in nc_fid.variables.keys():
+                    if verbose:
+                        print('PID %s: Creating variable %s' % (pid, var))
                     if grib2_table[row, 6] == 'isobaricInhPa':
-                        for level_index, level in enumerate(levels):
-                            try:
-                                if verbose:
-                                    print('PID %s: Writing %s at level %d' % (pid, var, level))
-                                # Match a list containing discipline, parameterCategory, parameterNumber, level.
-                                # Add one because grib indexing starts at 1.
-                                grib_key = grib_index.index([int(grib2_table[row, 1]), int(grib2_table[row, 2]),
-                                                             int(grib2_table[row, 3]), int(level)]) + 1
-                                if verbose:
-                                    print('  found %s' % grib_data[grib_key])
-                                data = np.array(grib_data[grib_key].values, dtype=np.float32)
-                                nc_fid.variables[var][time_index, level_index, ...] = data
-                            except OSError:  # missing index gives an OS read error
-                                print('* Warning: grib variable %s not found in file %s' % (var, file_name))
-                                pass
-                            except BaseException as e:
-                                print("* Warning: failed to write %s to netCDF file ('%s')" % (var, str(e)))
+                        nc_var = nc_fid.createVariable(var, np.float32, ('time', 'level', 'lat', 'lon'), zlib=True)
                     else:
-                        try:
-                            if verbose:
-                                print('PID %s: Writing %s' % (pid, var))
-                            # Match a list containing discipline, parameterCategory, parameterNumber, level.
-                            # Add one because grib indexing starts at 1.
-                            grib_key = grib_index_no_level.index([int(grib2_table[row, 1]), int(grib2_table[row, 2]),
-                                                                  int(grib2_table[row, 3])]) + 1
-                            if verbose:
-                                print('  found %s' % grib_data[grib_key])
-                            data = np.array(grib_data[grib_key].values, dtype=np.float32)
-                            nc_fid.variables[var][time_index, ...] = data
-                        except OSError:  # missing index gives an OS read error
-                            print('* Warning: grib variable %s not found in file %s' % (var, file_name))
-                            pass
-                        except BaseException as e:
-                            print("* Warning: failed to write %s to netCDF file ('%s')" % (var, str(e)))
-
-            grib_data.close()
-            return
+                        nc_var = nc_fid.createVariable(var, np.float32, ('time', 'lat', 'lon'), zlib=True)
+                    nc_var.setncatts({
+                        'long_name': grib2_table[row, 4],
+                        'units': grib2_table[row, 5],
+                        '_FillValue': fill_value
+                    })
+                # Match a tuple containing discipline, parameterCategory, parameterNumber[, level]
+                key = (int(grib2_table[row, 1]), int(grib2_table[row, 2]), int(grib2_table[row, 3]))
+                if grib2_table[row, 6] == 'isobaricInhPa':
+                    for level_index, level in enumerate(levels):
+                        fields.append((var, level_index, key + (int(level),)))
+                else:
+                    fields.append((var, None, key))
+            return fields
+
+        def write_grib(file_name, time_index, fields, data, targets):
+            if verbose:
+                print('PID %s: Writing %s' % (pid, file_name))
+            for (var, level_index, key), field in zip(fields, data):
+                if field is None:
+                    print('* Warning: grib variable %s not found in file %s' % (var, file_name))
+                elif isinstance(field, Exception):
+                    print("* Warning: failed to write %s to netCDF file ('%s')" % (var, str(field)))
+                else:
+                    try:
+                        if level_index is None:
+                            targets[var][time_index, ...] = field
+                        else:
+                            targets[var][time_index, level_index, ...] = field
+                    except Exception as e:
+                        print("* Warning: failed to write %s to netCDF file ('%s')" % (var, str(e)))
 
         # We're gonna have to do this the ugly way, with the netCDF4 module.
         # Iterate over months, create a netCDF file for the month, and fill in all datetimes we want
@@ -493,94 +933,150 @@ class CFSReanalysis(object):
         pid = os.getpid()
         nc_file_dir = '%s/processed' % self._root_directory
         os.makedirs(nc_file_dir, exist_ok=True)
-        nc_file_name = '%s/%s%s.nc' % (nc_file_dir, self._file_id, datetime.strftime(month[0], '%Y%m'))
-        if verbose:
-            print('PID %s: Writing to file %s' % (pid, nc_file_name))
-        nc_file_open_type = 'w'
-        init_coord = True
-        if os.path.isfile(nc_file_name):
-            if omit_existing:
-                if verbose:
-                    print('PID %s: Omitting file %s; exists' % (pid, nc_file_name))
-                return
-            if write_into_existing:
-                nc_file_open_type = 'a'
-                init_coord = False
-            else:
-                os.remove(nc_file_name)
-        nc_file_id = nc.Dataset(nc_file_name, nc_file_open_type, format='NETCDF4')
-
-        # Initialize coordinates, if needed
-        time_axis = pd.DatetimeIndex(start=unique_months[m].start_time, end=unique_months[m].end_time,
-                                     freq='6H').to_pydatetime()
-        if init_coord:
-            # Create dimensions
+        if file_format == 'zarr':
+            # The zarr store was created by write(); fill in this month's region
+            import zarr
             if verbose:
-                print('PID %s: Creating coordinate dimensions' % pid)
-            nc_file_id.description = 'Selected variables and levels from the CFS Reanalysis'
-            nc_file_id.createDimension('time', 0)
-            nc_file_id.createDimension('level', len(self.level_coord))
-            nc_file_id.createDimension('lat', self._ny)
-            nc_file_id.createDimension('lon', self._nx)
-
-            # Create unlimited time variable for initialization time
-            nc_var = nc_file_id.createVariable('time', np.float32, 'time', zlib=True)
-            time_units = 'hours since 1970-01-01 00:00:00'
-
-            nc_var.setncatts({
-                'long_name': 'Model initialization time',
-                'units': time_units
-            })
-            nc_file_id.variables['time'][:] = nc.date2num(time_axis, time_units)
+                print('PID %s: Writing to zarr store %s' % (pid, self.zarr_file))
+            nc_file_id = None
+            targets = zarr.open_group(self.zarr_file, mode='r+')
+            time_axis = _zarr_time_axis(self.zarr_file)
+            init_coord = False
+        else:
+            nc_file_name = '%s/%s%s.nc' % (nc_file_dir, self._file_id, datetime.strftime(month[0], '%Y%m'))
+            if verbose:
+                print('PID %s: Writing to file %s' % (pid, nc_file_name))
+            nc_file_open_type = 'w'
+            init_coord = True
+            if os.path.isfile(nc_file_name):
+                if omit_existing:
+                    if verbose:
+                        print('PID %s: Omitting file %s; exists' % (pid, nc_file_name))
+                    return
+                if write_into_existing:
+                    nc_file_open_type = 'a'
+                    init_coord = False
+                else:
+                    os.remove(nc_file_name)
+            nc_file_id = nc.Dataset(nc_file_name, nc_file_open_type, format='NETCDF4')
 
-            # Create unchanging level variable
-            nc_var = nc_file_id.createVariable('level', np.float32, 'level', zlib=True)
-            nc_var.setncatts({
-                'long_name': 'Pressure level',
-                'units': 'hPa'
-            })
-            nc_file_id.variables['level'][:] = self.level_coord
+            # Initialize coordinates, if needed
+            time_axis = pd.DatetimeIndex(start=unique_months[m].start_time, end=unique_months[m].end_time,
+                                         freq='6H').to_pydatetime()
+            if init_coord:
+                # Create dimensions
+                if verbose:
+                    print('PID %s: Creating coordinate dimensions' % pid)
+                nc_file_id.description = 'Selected variables and levels from the CFS Reanalysis'
+                nc_file_id.createDimension('time', 0)
+                nc_file_id.createDimension('level', len(self.level_coord))
+                nc_file_id.createDimension('lat', self._ny)
+                nc_file_id.createDimension('lon', self._nx)
+
+                # Create unlimited time variable for initialization time
+                nc_var = nc_file_id.createVariable('time', np.float32, 'time', zlib=True)
+                time_units = 'hours since 1970-01-01 00:00:00'
+
+                nc_var.setncatts({
+                    'long_name': 'Model initialization time',
+                    'units': time_units
+                })
+                nc_file_id.variables['time'][:] = nc.date2num(time_axis, time_units)
 
-        # Now go through the time files to add data to the netCDF file
+                # Create unchanging level variable
+                nc_var = nc_file_id.createVariable('level', np.float32, 'level', zlib=True)
+                nc_var.setncatts({
+                    'long_name': 'Pressure level',
+                    'units': 'hPa'
+                })
+                nc_file_id.variables['level'][:] = self.level_coord
+            targets = nc_file_id.variables
+
+        # Now go through the time files to add data to the netCDF file. GRIB files are decoded in parallel, and the
+        # decoded fields are written here, so only this process writes to the netCDF file.
+        fields = create_variables(nc_file_id)
+        if file_format == 'zarr' and omit_existing and len(fields) > 0:
+            field_index = (time_axis.index(month[0]),) + (() if fields[0][1] is None else (fields[0][1],))
+            if not np.all(np.isnan(targets[fields[0][0]][field_index])):
+                if verbose:
+                    print('PID %s: Omitting month %s; exists in zarr store' % (pid, unique_months[m]))
+                return
+        if verbose:
+            print('PID %s: Variables to fetch: %s' % (pid, variables))
+        grib_files = []
+        regridder = None
         for dt in month:
-            grib_file_dir = datetime.strftime(dt, grib_dir_format)
-            grib_file_name = datetime.strftime(dt, grib_file_format.format(self._resolution, self._run_type))
-            grib_file_name = '%s/%s/%s' % (self._root_directory, grib_file_dir, grib_file_name)
-            # Write the latitude and longitude coordinate arrays, if needed
-            if init_coord:
+            grib_file_name = self._grib_file_name(dt)
+            if not _check_exists(grib_file_name):
+                print('* Warning: file %s not found' % grib_file_name)
+                continue
+            # Write the latitude and longitude coordinate arrays and set up the interpolation, if needed
+            if init_coord or (interpolate is not None and regridder is None):
                 try:
-                    read_write_grib_lat_lon(grib_file_name, nc_file_id)
-                    init_coord = False
+                    data_lat, data_lon = _read_grib_lat_lon(grib_file_name)
                 except (IOError, OSError):
                     print("* Warning: file %s not found for coordinates; trying the next one." % grib_file_name)
-            read_write_grib(grib_file_name, list(time_axis).index(dt), nc_file_id)
+                    continue
+                if interpolate is not None:
+                    regridder = Regridder(data_lat, data_lon, interpolate[0], interpolate[1], method=interpolate_method,
+                                          cache_file='%s/%sregrid_%s.npz' % (nc_file_dir, self._file_id,
+                                                                             interpolate_method))
+                    data_lat, data_lon = interpolate
+                if init_coord:
+                    write_lat_lon(data_lat, data_lon, nc_file_id)
+                    init_coord = False
+            grib_files.append((grib_file_name, list(time_axis).index(dt)))
+
+        decoded = _decode_grib_files([f[0] for f in grib_files], [f[2] for f in fields], workers=decode_workers,
+                                     regridder=regridder)
+        for (grib_file_name, time_index), data in zip(grib_files, decoded):
+            write_grib(grib_file_name, time_index, fields, data, targets)
 
             # Delete files if requested
             if delete_raw_files:
-                if os.path.isfile(grib_file_name):
-                    os.remove(grib_file_name)
+                _remove_grib_file(grib_file_name)
 
-        nc_file_id.close()
+        if nc_file_id is not None:
+            nc_file_id.close()
 
-    def open(self, exact_dates=True, concat_dim='time', **dataset_kwargs):
+    def open(self, exact_dates=True, concat_dim='time', file_format='netcdf', max_open_files=32, **dataset_kwargs):
         """
-        Open an xarray multi-file Dataset for the processed files with dates set using set_dates(), retrieve(), or
-        write(). Once opened, this Dataset is accessible by self.Dataset.
+        Open an xarray Dataset for the processed files with dates set using set_dates(), retrieve(), or write(). Once
+        opened, this Dataset is accessible by self.Dataset.
+
+        The monthly netCDF files are opened through a FileCatalog, self.catalog, which keeps an index of the times and
+        variables of each file in the processed directory. Files are only opened when their data are selected, and at
+        most max_open_files are kept open at once.
 
         :param exact_dates: bool: if True, set the Dataset to have the exact dates of this instance; otherwise,
             keep all of the monthly dates in the opened files
-        :param concat_dim: passed to xarray.open_mfdataset()
-        :param dataset_kwargs: kwargs passed to xarray.open_mfdataset()
+        :param concat_dim: name of the time dimension along which the files are concatenated
+        :param file_format: str: 'netcdf' to open the monthly netCDF files, or 'zarr' to open the zarr store
+            self.zarr_file, which only reads its consolidated metadata
+        :param max_open_files: int: maximum number of netCDF files to keep open at once
+        :param dataset_kwargs: kwargs passed to xarray.open_dataset() for each netCDF file, or xarray.open_zarr()
         """
-        nc_file_dir = '%s/processed' % self._root_directory
-        if not self.dataset_dates:
+        if file_format not in ['netcdf', 'zarr']:
+            raise ValueError("'file_format' must be 'netcdf' or 'zarr'")
+        if exact_dates and not self.dataset_dates:
             raise ValueError("use set_dates() to specify times of data to load")
-        dates_index = pd.DatetimeIndex(self.dataset_dates).sort_values()
-        months = dates_index.to_period('M')
-        unique_months = months.unique()
-        nc_files = ['%s/%s%s.nc' % (nc_file_dir, self._file_id, d.strftime('%Y%m')) for d in unique_months]
-        self.Dataset = xr.open_mfdataset(nc_files, concat_dim=concat_dim, **dataset_kwargs)
-        if exact_dates:
+        if file_format == 'zarr':
+            self.Dataset = xr.open_zarr(self.zarr_file, consolidated=True, **dataset_kwargs)
+        else:
+            if not self.dataset_dates:
+                raise ValueError("use set_dates() to specify times of data to load")
+            nc_file_dir = '%s/processed' % self._root_directory
+            dates_index = pd.DatetimeIndex(self.dataset_dates).sort_values()
+            months = dates_index.to_period('M')
+            unique_months = months.unique()
+            nc_files = ['%s/%s%s.nc' % (nc_file_dir, self._file_id, d.strftime('%Y%m'))
+                        for d in unique_months]
+            if self.catalog is not None:
+                self.catalog.close()
+            self.catalog = FileCatalog(nc_files, index_file='%s/%scatalog.json' % (nc_file_dir, self._file_id),
+                                       concat_dim=concat_dim, max_open_files=max_open_files, **dataset_kwargs)
+            self.Dataset = self.catalog.sel(time=self.dataset_dates if exact_dates else None)
+        if exact_dates and file_format == 'zarr':
             self.Dataset = self.Dataset.sel(time=self.dataset_dates)
         self.dataset_variables = list(self.Dataset.variables.keys())
 
@@ -604,8 +1100,12 @@ class CFSReanalysis(object):
         if self.Dataset is not None:
             self.Dataset.close()
             self.Dataset = None
+            if self.catalog is not None:
+                self.catalog.close()
+                self.catalog = None
             self._lon_array = None
             self._lat_array = None
+            self._locator = None
         else:
             raise ValueError('no Dataset to close')
 
@@ -702,9 +1202,11 @@ class CFSReforecast(object):
         self.inverse_lat = True
         # Data
         self.Dataset = None
+        self.catalog = None
         self.basemap = None
         self._lat_array = None
         self._lon_array = None
+        self._locator = None
 
     @property
     def lat(self):
@@ -760,19 +1262,22 @@ class CFSReforecast(object):
     def closest_lat_lon(self, lat, lon):
         """
         Find the grid-point index of the closest point to the specified latitude and longitude values in loaded
-        CFS reanalysis data.
+        CFS reanalysis data. Many points may be located at once by passing arrays; the grid index is built once per
+        opened Dataset.
 
-        :param lat: float or int: latitude in degrees
-        :param lon: float or int: longitude in degrees
-        :return:
+        :param lat: float or array: latitude(s) in degrees
+        :param lon: float or array: longitude(s) in degrees
+        :return: tuple of (lat, lon) grid indices, ints or arrays of the shape of lat
         """
-        if lon < 0.:
-            lon += 360.
-        distance = (self.lat - lat) ** 2 + (self.lon - lon) ** 2
-        min_dist = 1.
-        if np.min(distance) > min_dist:
-            raise ValueError('no latitude/longitude points within 1 degree of requested lat/lon!')
-        return np.unravel_index(np.argmin(distance, axis=None), distance.shape)
+        if self._locator is None:
+            self._locator = GridLocator(self.lat, self.lon)
+        index, distance = self._locator.closest(lat, lon, return_distance=True)
+        max_dist = 1.
+        if np.any(distance > max_dist):
+            raise ValueError('no latitude/longitude points within %g degree(s) of requested lat/lon!' % max_dist)
+        if np.ndim(lat) == 0 and np.ndim(lon) == 0:
+            return tuple(int(i) for i in index)
+        return index
 
     def retrieve(self, dates, variables='all', n_proc=4, verbose=False):
         """
@@ -783,8 +1288,9 @@ class CFSReforecast(object):
         :param dates: list or tuple: date or datetime objects of of analysis times. May be 'all', in which case
             all dates in the object's 'dataset_dates' attributes are retrieved.
         :param variables: list: list of variables to retrieve or 'all'
-        :param n_proc: int: if >1, fetches files in parallel. This speeds up performance but may not scale well if
-            internet I/O is the bottleneck. Set to 0 to use all available threads.
+        :param n_proc: int: if >1, fetches files in parallel, with this many concurrent downloads. This speeds up
+            performance but may not scale well if internet I/O is the bottleneck. Set to 0 to use as many downloads as
+            available threads. Each file is streamed to disk and resumed if a partial download exists.
         :param verbose: bool: include progress print statements
         :return: None
         """
@@ -825,24 +1331,15 @@ class CFSReforecast(object):
                 if grib_file_name not in self.raw_files:
                     self.raw_files.append(grib_file_name)
 
-        if n_proc == 0 or n_proc > 1:
-            try:
-                import multiprocessing
-                if n_proc == 0:
-                    n_proc = multiprocessing.cpu_count()
-            except ImportError:
-                warnings.warn("'multiprocessing' module not available; falling back to serial")
-                n_proc = 1
+        if n_proc == 0:
+            n_proc = multiprocessing.cpu_count()
 
         if n_proc == 1:
             for file in self.raw_files:
                 call_fetch((self, file, verbose))
         else:
-            pool = multiprocessing.Pool(processes=n_proc)
-            pool.map(call_fetch, zip(it.repeat(self), self.raw_files, it.repeat(verbose)))
-            pool.close()
-            pool.terminate()
-            pool.join()
+            with ThreadPoolExecutor(max_workers=n_proc) as executor:
+                list(executor.map(call_fetch, zip(it.repeat(self), self.raw_files, it.repeat(verbose))))
 
     def _fetch(self, f, verbose):
         pid = os.getpid()
@@ -855,21 +1352,14 @@ class CFSReforecast(object):
         if verbose:
             print('PID %s: downloading %s' % (pid, remote_file))
         try:
-            response = urlopen(remote_file)
-            with open(local_file, 'wb') as fd:
-                fd.write(response.read())
+            _download(remote_file, local_file)
         except BaseException as e:
-            print('warning: failed to download %s, retrying' % remote_file)
-            try:
-                response = urlopen(remote_file)
-                with open(local_file, 'wb') as fd:
-                    fd.write(response.read())
-            except BaseException as e:
-                print('warning: failed to download %s' % remote_file)
-                print('* Reason: "%s"' % str(e))
+            print('warning: failed to download %s' % remote_file)
+            print('* Reason: "%s"' % str(e))
 
     def write(self, variables='all', dates='all', forecast_hours=1080, interpolate=None, write_into_existing=True,
-              omit_existing=False, delete_raw_files=False, n_proc=4, verbose=False):
+              omit_existing=False, delete_raw_files=False, n_proc=4, interpolate_method='bicubic', file_format='netcdf',
+              verbose=False):
         """
         Reads raw CFS reanalysis files for the given dates (list or tuple form) and specified variables and levels and
         writes the data to reformatted netCDF files. Processed files are saved under self._root_directory/processed;
@@ -881,8 +1371,7 @@ class CFSReforecast(object):
             self.retrieve() or self.set_dates())
         :param forecast_hours: int: maximum number of forecast hours to include
         :param interpolate: tuple of (lat, lon) 1-d coordinates: if not None, interpolates from the regular grid to
-            a new regular grid. If self.inverse_lat is True, expects monotonically decreasing latitude coordinate,
-            otherwise must be monotonically increasing. Longitude must be 0-360.
+            a new regular grid. Latitude may be ascending or descending. Longitude must be 0-360.
         :param write_into_existing: bool: if True, checks for existing files and appends if they exist. If False,
             overwrites any existing files.
         :param omit_existing: bool: if True, then if a processed file exists, skip it. Only useful if existing data
@@ -891,6 +1380,10 @@ class CFSReforecast(object):
             made
         :param n_proc: int: if >1, runs write tasks in parallel, one per month of data. This speeds up performance but
             may not scale well if disk I/O is the bottleneck. Set to 0 to use all available threads.
+        :param interpolate_method: str: 'bilinear', 'bicubic', or 'conservative'; see DLWP.data.grid.Regridder. The
+            interpolation weights are cached in the processed directory.
+        :param file_format: str: 'netcdf' for monthly netCDF files, or 'zarr' for the single zarr store
+            self.zarr_file; see CFSReanalysis.write
         :param verbose: bool: include progress print statements
         :return:
         """
@@ -902,6 +1395,8 @@ class CFSReforecast(object):
         else:
             self.set_dates(dates)
             dates = self.dataset_dates
+        if file_format not in ['netcdf', 'zarr']:
+            raise ValueError("'file_format' must be 'netcdf' or 'zarr'")
         if len(variables) == 0:
             print('CFSReanalysis.write: no variables specified; will do nothing.')
             return
@@ -913,12 +1408,7 @@ class CFSReforecast(object):
             raise ValueError('maximum forecast_hours should be at least %d' % self._dt)
         self.f_hour = np.array(np.arange(self._dt, forecast_hours + 1, self._dt), dtype='int')
         if interpolate is not None:
-            if len(interpolate) != 2:
-                raise ValueError("'interpolate' must be a tuple of length 2")
-            if len(interpolate[0].shape) != 1:
-                raise ValueError("lat in 'interpolate' must be 1 dimensional")
-            if len(interpolate[1].shape) != 1:
-                raise ValueError("lon in 'interpolate' must be 1 dimensional")
+            _check_interpolate(interpolate, interpolate_method)
             self._ny = len(interpolate[0])
             self._nx = len(interpolate[1])
 
@@ -930,6 +1420,10 @@ class CFSReforecast(object):
         for m in range(len(unique_months)):
             month_list.append(list(dates_index[months == unique_months[m]].to_pydatetime()))
 
+        if file_format == 'zarr':
+            if not self._init_zarr(dates, unique_months, variables, interpolate, write_into_existing, verbose):
+                return
+
         if n_proc == 0 or n_proc > 1:
             try:
                 import multiprocessing
@@ -941,39 +1435,98 @@ class CFSReforecast(object):
 
         if n_proc == 1:
             for nm, month in enumerate(month_list):
-                call_process_month((self, nm, month, unique_months, variables, interpolate, write_into_existing,
-                                    omit_existing, delete_raw_files, verbose))
+                call_process_month((self, nm, month, unique_months, variables, interpolate, interpolate_method,
+                                    write_into_existing, omit_existing, delete_raw_files, file_format, verbose))
         else:
             pool = multiprocessing.Pool(processes=n_proc)
             pool.map(call_process_month, zip(it.repeat(self), range(len(month_list)), month_list,
                                              it.repeat(unique_months), it.repeat(variables), it.repeat(interpolate),
-                                             it.repeat(write_into_existing), it.repeat(omit_existing),
-                                             it.repeat(delete_raw_files), it.repeat(verbose)))
+                                             it.repeat(interpolate_method), it.repeat(write_into_existing),
+                                             it.repeat(omit_existing), it.repeat(delete_raw_files),
+                                             it.repeat(file_format), it.repeat(verbose)))
             pool.close()
             pool.terminate()
             pool.join()
 
-    def _process_month(self, m, month, unique_months, variables, interpolate, write_into_existing, omit_existing,
-                       delete_raw_files, verbose):
-        def read_grib_lat_lon(file_name):
-            exists, exists_file_name = _check_exists(file_name, path=True)
-            if not exists:
-                raise IOError('File %s not found.' % file_name)
-            grib_data = pygrib.open(file_name)
-            try:
-                lats = np.array(grib_data[1]['latitudes'], dtype=np.float32)
-                lons = np.array(grib_data[1]['longitudes'], dtype=np.float32)
-                shape = grib_data[1].values.shape
-                lat = lats.reshape(shape)[:, 0]
-                lon = lons.reshape(shape)[0, :]
-            except BaseException:
-                print('* Warning: cannot get lat/lon from grib file %s' % exists_file_name)
-                raise
-            grib_data.close()
-            return lat, lon
+    @property
+    def zarr_file(self):
+        """
+        :return: str: path to the zarr store of processed data
+        """
+        return '%s/processed/%sfcst.zarr' % (self._root_directory, self._file_id)
 
+    def _grib_file_name(self, var, dt):
+        grib_file_dir = datetime.strftime(dt, reforecast_dir_format).format(var)
+        if dt.hour == 0:
+            # 1st of the month 4 months later
+            end_date = datetime.strftime((dt.replace(day=1) + timedelta(days=130)).replace(day=1), '%Y%m%d%H')
+        else:
+            end_date = datetime.strftime(dt + timedelta(days=45), '%Y%m%d%H')
+        start_date = datetime.strftime(dt, '%Y%m%d%H')
+        return '%s/%s/%s' % (self._root_directory, grib_file_dir,
+                             reforecast_file_format.format(var, start_date, end_date, start_date))
+
+    def _init_zarr(self, dates, unique_months, variables, interpolate, write_into_existing, verbose):
+        # Create or extend the zarr store. Returns False if there is no raw file from which to get the grid.
+        import dask.array
+        if interpolate is not None:
+            lat, lon = interpolate
+        else:
+            for var, dt in it.product(variables, dates):
+                try:
+                    lat, lon = _read_grib_lat_lon(self._grib_file_name(var, dt))
+                    break
+                except (IOError, OSError):
+                    continue
+            else:
+                print('CFSReforecast.write: no raw files found for the grid coordinates; will do nothing.')
+                return False
+
+        def template(times, names):
+            shape = (len(self.f_hour), len(times), len(lat), len(lon))
+            data_vars = {}
+            for var in names:
+                data_vars[var] = xr.Variable(('f_hour', 'time', 'lat', 'lon'),
+                                             dask.array.full(shape, np.nan, dtype=np.float32, chunks=shape), {
+                    'long_name': var,
+                    'units': 'N/A'
+                }, encoding={'chunks': (1, 1) + shape[-2:]})
+            return xr.Dataset(data_vars, coords={
+                'f_hour': ('f_hour', self.f_hour, {
+                    'long_name': 'Forecast hour'
+                }),
+                'time': ('time', times, {
+                    'long_name': 'Model initialization time'
+                }),
+                'lat': ('lat', np.array(lat, dtype=np.float32), {
+                    'long_name': 'Latitude',
+                    'units': 'degrees_north'
+                }),
+                'lon': ('lon', np.array(lon, dtype=np.float32), {
+                    'long_name': 'Longitude',
+                    'units': 'degrees_east'
+                })
+            }, attrs={
+                'description': 'Selected variables from the CFS Reforecast'
+            })
+
+        if os.path.exists(self.zarr_file) and write_into_existing:
+            ds = xr.open_zarr(self.zarr_file, consolidated=True)
+            if not np.array_equal(ds['f_hour'].values, self.f_hour):
+                raise ValueError('forecast hours of the existing zarr store %s do not match forecast_hours' %
+                                 self.zarr_file)
+            ds.close()
+        if verbose:
+            print('CFSReforecast.write: initializing zarr store %s' % self.zarr_file)
+        os.makedirs('%s/processed' % self._root_directory, exist_ok=True)
+        times = pd.date_range(unique_months[0].start_time, unique_months[-1].end_time, freq=pd.Timedelta(hours=6))
+        _init_zarr_store(self.zarr_file, template, times, variables, write_into_existing=write_into_existing)
+        return True
+
+    def _process_month(self, m, month, unique_months, variables, interpolate, interpolate_method, write_into_existing,
+                       omit_existing, delete_raw_files, file_format, verbose):
         def read_write_grib_lat_lon(file_name, nc_fid):
-            lat, lon = read_grib_lat_lon(file_name)
+            lat, lon = _read_grib_lat_lon(file_name)
             if verbose:
                 print('PID %s: Writing latitude and longitude' % pid)
             nc_var = nc_fid.createVariable('lat', np.float32, ('lat',))
@@ -989,31 +1542,33 @@ class CFSReforecast(object):
             })
             nc_fid.variables['lon'][:] = lon
 
-        def read_write_grib(file_name, time_index, variable):
+        def read_write_grib(file_name, time_index, variable, regridder):
             exists, exists_file_name = _check_exists(file_name, path=True)
             if not exists:
                 print('* Warning: file %s not found' % file_name)
                 return
             if verbose:
                 print('PID %s: Reading %s' % (pid, exists_file_name))
-            grib_data = pygrib.open(file_name)
-            for grb in grib_data:
-                if grb.forecastTime > np.max(self.f_hour):
+            messages = _grib_file_index(file_name)
+            reader = _GribFieldReader(file_name)
+            # Fields to regrid, all at once, and their forecast hour indices
+            fields = []
+            f_hour_inds = []
+            for message in messages:
+                forecast_time = message[4]
+                if forecast_time is not None and forecast_time > np.max(self.f_hour):
                     break
                 try:
-                    f_hour_ind = list(self.f_hour).index(int(grb.forecastTime))
+                    f_hour_ind = list(self.f_hour).index(forecast_time)
                 except ValueError:
                     continue
                 try:
                     if verbose:
                         print('PID %s: Writing forecast hour %d' % (pid, self.f_hour[f_hour_ind]))
-                    data = np.array(grb.values, dtype=np.float32)
-                    if interpolate is not None:
-                        f_interp = RectBivariateSpline(data_lat, data_lon, data)
-                        if self.inverse_lat:
-                            variable[f_hour_ind, time_index, ...] = f_interp(interpolate[0][::-1], interpolate[1])
-                        else:
-                            variable[f_hour_ind, time_index, ...] = f_interp(interpolate[0], interpolate[1])
+                    data = np.array(reader.read(*message[5:9]).values, dtype=np.float32)
+                    if regridder is not None:
+                        fields.append(data)
+                        f_hour_inds.append(f_hour_ind)
                     else:
                         variable[f_hour_ind, time_index, ...] = data
                 except OSError:  # missing index gives an OS read error
@@ -1021,7 +1576,13 @@ class CFSReforecast(object):
                     pass
                 except BaseException as e:
                     print("* Warning: failed to write to netCDF file ('%s')" % str(e))
-            grib_data.close()
+            reader.close()
+            if len(fields) > 0:
+                for f_hour_ind, data in zip(f_hour_inds, regridder(np.stack(fields))):
+                    try:
+                        variable[f_hour_ind, time_index, ...] = data
+                    except Exception as e:
+                        print("* Warning: failed to write to netCDF file ('%s')" % str(e))
             return
 
         # We're gonna have to do this the ugly way, with the netCDF4 module.
@@ -1031,56 +1592,73 @@ class CFSReforecast(object):
         n_fhour = len(self.f_hour)
         nc_file_dir = '%s/processed' % self._root_directory
         os.makedirs(nc_file_dir, exist_ok=True)
-        nc_file_name = '%s/%sfcst_%s.nc' % (nc_file_dir, self._file_id, datetime.strftime(month[0], '%Y%m'))
-        if verbose:
-            print('PID %s: Writing to file %s' % (pid, nc_file_name))
-        nc_file_open_type = 'w'
-        init_coord = True
-        if os.path.isfile(nc_file_name):
-            if omit_existing:
+        if file_format == 'zarr':
+            # The zarr store was created by write(); fill in this month's region
+            import zarr
+            if verbose:
+                print('PID %s: Writing to zarr store %s' % (pid, self.zarr_file))
+            nc_file_id = None
+            group = zarr.open_group(self.zarr_file, mode='r+')
+            time_axis = _zarr_time_axis(self.zarr_file)
+            init_coord = False
+            if omit_existing and not np.all(np.isnan(group[variables[0]][0, time_axis.index(month[0])])):
                 if verbose:
-                    print('PID %s: Omitting file %s; exists' % (pid, nc_file_name))
+                    print('PID %s: Omitting month %s; exists in zarr store' % (pid, unique_months[m]))
                 return
-            if write_into_existing:
-                nc_file_open_type = 'a'
-                init_coord = False
-            else:
-                os.remove(nc_file_name)
-        nc_file_id = nc.Dataset(nc_file_name, nc_file_open_type, format='NETCDF4')
-
-        # Initialize coordinates
-        time_axis = pd.DatetimeIndex(start=unique_months[m].start_time, end=unique_months[m].end_time,
-                                     freq='6H').to_pydatetime()
-        if init_coord:
-            # Create dimensions
+        else:
+            nc_file_name = '%s/%sfcst_%s.nc' % (nc_file_dir, self._file_id, datetime.strftime(month[0], '%Y%m'))
             if verbose:
-                print('PID %s: Creating coordinate dimensions' % pid)
-            nc_file_id.description = 'Selected variables and levels from the CFS Reanalysis'
-            nc_file_id.createDimension('f_hour', n_fhour)
-            nc_file_id.createDimension('time', 0)
-            nc_file_id.createDimension('lat', self._ny)
-            nc_file_id.createDimension('lon', self._nx)
-
-            # Create forecast hour variable
-            nc_var = nc_file_id.createVariable('f_hour', np.int, 'f_hour')
-            nc_var.setncatts({
-                'long_name': 'Forecast hour'
-            })
-            nc_file_id.variables['f_hour'][:] = self.f_hour
+                print('PID %s: Writing to file %s' % (pid, nc_file_name))
+            nc_file_open_type = 'w'
+            init_coord = True
+            if os.path.isfile(nc_file_name):
+                if omit_existing:
+                    if verbose:
+                        print('PID %s: Omitting file %s; exists' % (pid, nc_file_name))
+                    return
+                if write_into_existing:
+                    nc_file_open_type = 'a'
+                    init_coord = False
+                else:
+                    os.remove(nc_file_name)
+            nc_file_id = nc.Dataset(nc_file_name, nc_file_open_type, format='NETCDF4')
 
-            # Create unlimited time variable for initialization time
-            nc_var = nc_file_id.createVariable('time', np.float32, 'time')
-            time_units = 'hours since 1970-01-01 00:00:00'
+            # Initialize coordinates
+            time_axis = pd.DatetimeIndex(start=unique_months[m].start_time, end=unique_months[m].end_time,
+                                         freq='6H').to_pydatetime()
+            if init_coord:
+                # Create dimensions
+                if verbose:
+                    print('PID %s: Creating coordinate dimensions' % pid)
+                nc_file_id.description = 'Selected variables and levels from the CFS Reanalysis'
+                nc_file_id.createDimension('f_hour', n_fhour)
+                nc_file_id.createDimension('time', 0)
+                nc_file_id.createDimension('lat', self._ny)
+                nc_file_id.createDimension('lon', self._nx)
+
+                # Create forecast hour variable
+                nc_var = nc_file_id.createVariable('f_hour', np.int, 'f_hour')
+                nc_var.setncatts({
+                    'long_name': 'Forecast hour'
+                })
+                nc_file_id.variables['f_hour'][:] = self.f_hour
 
-            nc_var.setncatts({
-                'long_name': 'Model initialization time',
-                'units': time_units
-            })
-            nc_file_id.variables['time'][:] = nc.date2num(time_axis, time_units)
+                # Create unlimited time variable for initialization time
+                nc_var = nc_file_id.createVariable('time', np.float32, 'time')
+                time_units = 'hours since 1970-01-01 00:00:00'
+
+                nc_var.setncatts({
+                    'long_name': 'Model initialization time',
+                    'units': time_units
+                })
+                nc_file_id.variables['time'][:] = nc.date2num(time_axis, time_units)
 
         # Now go through the time files to add data to the netCDF file
+        regridder = None
         for var in variables:
-            if var not in nc_file_id.variables.keys():
+            if nc_file_id is None:
+                var_to_write = group[var]
+            elif var not in nc_file_id.variables.keys():
                 if verbose:
                     print('PID %s: Creating variable %s' % (pid, var))
                 var_to_write = nc_file_id.createVariable(var, np.float32, ('f_hour', 'time', 'lat', 'lon'), zlib=True)
@@ -1092,17 +1670,7 @@ class CFSReforecast(object):
             else:
                 var_to_write = nc_file_id.variables[var]
             for dt in month:
-                # File name
-                grib_file_dir = datetime.strftime(dt, reforecast_dir_format).format(var)
-                if dt.hour == 0:
-                    # 1st of the month 4 months later
-                    end_date = datetime.strftime((dt.replace(day=1) + timedelta(days=130)).replace(day=1),
-                                                 '%Y%m%d%H')
-                else:
-                    end_date = datetime.strftime(dt + timedelta(days=45), '%Y%m%d%H')
-                start_date = datetime.strftime(dt, '%Y%m%d%H')
-                grib_file_name = '%s/%s/%s' % (self._root_directory, grib_file_dir,
-                                               reforecast_file_format.format(var, start_date, end_date, start_date))
+                grib_file_name = self._grib_file_name(var, dt)
 
                 # Write the latitude and longitude coordinate arrays, if needed
                 if init_coord:
@@ -1130,47 +1698,68 @@ class CFSReforecast(object):
                         nc_file_id.variables['lon'][:] = interpolate[1]
                         init_coord = False
 
-                # Get the data lat/lon if we need to interpolate
-                if interpolate is not None:
+                # Get the data lat/lon if we need to interpolate. All files are on the same grid, so the interpolation
+                # weights are computed (or loaded from the cache) only once.
+                if interpolate is not None and regridder is None:
                     try:
-                        data_lat, data_lon = read_grib_lat_lon(grib_file_name)
-                        if self.inverse_lat:
-                            data_lat = data_lat[::-1]
+                        data_lat, data_lon = _read_grib_lat_lon(grib_file_name)
                     except (IOError, OSError):
                         print("* Warning: could not get coordinates from file %s but I need coordinates to "
                               "interpolate. I'm skipping to the next one!"
                               % grib_file_name)
                         continue
+                    regridder = Regridder(data_lat, data_lon, interpolate[0], interpolate[1], method=interpolate_method,
+                                          cache_file='%s/%sfcst_regrid_%s.npz' % (nc_file_dir, self._file_id,
+                                                                                  interpolate_method))
 
                 # Write the data
-                read_write_grib(grib_file_name, list(time_axis).index(dt), var_to_write)
+                read_write_grib(grib_file_name, list(time_axis).index(dt), var_to_write, regridder)
 
                 # Delete files if requested
                 if delete_raw_files:
-                    if os.path.isfile(grib_file_name):
-                        os.remove(grib_file_name)
+                    _remove_grib_file(grib_file_name)
 
-        nc_file_id.close()
+        if nc_file_id is not None:
+            nc_file_id.close()
 
-    def open(self, exact_dates=True, concat_dim='time', **dataset_kwargs):
+    def open(self, exact_dates=True, concat_dim='time', file_format='netcdf', max_open_files=32, **dataset_kwargs):
         """
-        Open an xarray multi-file Dataset for the processed files with dates set using set_dates(), retrieve(), or
-        write(). Once opened, this Dataset is accessible by self.Dataset.
+        Open an xarray Dataset for the processed files with dates set using set_dates(), retrieve(), or write(). Once
+        opened, this Dataset is accessible by self.Dataset.
+
+        The monthly netCDF files are opened through a FileCatalog, self.catalog, which keeps an index of the times and
+        variables of each file in the processed directory. Files are only opened when their data are selected, and at
+        most max_open_files are kept open at once.
 
         :param exact_dates: bool: if True, set the Dataset to have the exact dates of this instance; otherwise,
             keep all of the monthly dates in the opened files
-        :param concat_dim: passed to xarray.open_mfdataset()
-        :param dataset_kwargs: kwargs passed to xarray.open_mfdataset()
+        :param concat_dim: name of the time dimension along which the files are concatenated
+        :param file_format: str: 'netcdf' to open the monthly netCDF files, or 'zarr' to open the zarr store
+            self.zarr_file, which only reads its consolidated metadata
+        :param max_open_files: int: maximum number of netCDF files to keep open at once
+        :param dataset_kwargs: kwargs passed to xarray.open_dataset() for each netCDF file, or xarray.open_zarr()
         """
-        nc_file_dir = '%s/processed' % self._root_directory
-        if not self.dataset_dates:
+        if file_format not in ['netcdf', 'zarr']:
+            raise ValueError("'file_format' must be 'netcdf' or 'zarr'")
+        if exact_dates and not self.dataset_dates:
             raise ValueError("use set_dates() to specify times of data to load")
-        dates_index = pd.DatetimeIndex(self.dataset_dates).sort_values()
-        months = dates_index.to_period('M')
-        unique_months = months.unique()
-        nc_files = ['%s/%sfcst_%s.nc' % (nc_file_dir, self._file_id, d.strftime('%Y%m')) for d in unique_months]
-        self.Dataset = xr.open_mfdataset(nc_files, concat_dim=concat_dim, **dataset_kwargs)
-        if exact_dates:
+        if file_format == 'zarr':
+            self.Dataset = xr.open_zarr(self.zarr_file, consolidated=True, **dataset_kwargs)
+        else:
+            if not self.dataset_dates:
+                raise ValueError("use set_dates() to specify times of data to load")
+            nc_file_dir = '%s/processed' % self._root_directory
+            dates_index = pd.DatetimeIndex(self.dataset_dates).sort_values()
+            months = dates_index.to_period('M')
+            unique_months = months.unique()
+            nc_files = ['%s/%sfcst_%s.nc' % (nc_file_dir, self._file_id, d.strftime('%Y%m'))
+                        for d in unique_months]
+            if self.catalog is not None:
+                self.catalog.close()
+            self.catalog = FileCatalog(nc_files, index_file='%s/%sfcst_catalog.json' % (nc_file_dir, self._file_id),
+                                       concat_dim=concat_dim, max_open_files=max_open_files, **dataset_kwargs)
+            self.Dataset = self.catalog.sel(time=self.dataset_dates if exact_dates else None)
+        if exact_dates and file_format == 'zarr':
             self.Dataset = self.Dataset.sel(time=self.dataset_dates)
         self.dataset_variables = list(self.Dataset.variables.keys())
 
@@ -1181,7 +1770,11 @@ class CFSReforecast(object):
         if self.Dataset is not None:
             self.Dataset.close()
             self.Dataset = None
+            if self.catalog is not None:
+                self.catalog.close()
+                self.catalog = None
             self._lon_array = None
             self._lat_array = None
+            self._locator = None
         else:
             raise ValueError('no Dataset to close')
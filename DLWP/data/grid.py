@@ -0,0 +1,369 @@
+#
+# Copyright (c) 2017-18 Jonathan Weyn <jweyn@uw.edu>
+#
+# See the file LICENSE for your rights.
+#
+
+"""
+Utilities for regridding data between regular latitude-longitude grids and locating points on them.
+"""
+
+import os
+import numpy as np
+
+
+def _is_global(lon):
+    """
+    :param lon: 1d array: ascending longitudes in degrees
+    :return: bool: True if the longitudes are evenly spaced and wrap around the globe
+    """
+    if len(lon) < 2:
+        return False
+    dx = np.diff(lon)
+    return bool(np.allclose(dx, dx[0]) and np.isclose(len(lon) * dx[0], 360.))
+
+
+def _linear_indices(x_in, x_out, period=None):
+    """
+    Indices and weights of 1d linear interpolation. Points outside the input coordinates take the value at the nearest
+    end, unless the coordinate is periodic.
+
+    :param x_in: 1d array: ascending input coordinates
+    :param x_out: 1d array: output coordinates
+    :param period: float: if not None, the period of a cyclic coordinate
+    :return: j0, j1, w: 1d arrays: each output point is (1 - w) * x_in[j0] + w * x_in[j1]
+    """
+    n = len(x_in)
+    if period is not None:
+        x = np.concatenate([x_in, [x_in[0] + period]])
+        x_out = x_in[0] + np.mod(x_out - x_in[0], period)
+    else:
+        x = x_in
+        x_out = np.clip(x_out, x_in[0], x_in[-1])
+    j = np.clip(np.searchsorted(x, x_out, side='right') - 1, 0, len(x) - 2)
+    w = (x_out - x[j]) / (x[j + 1] - x[j])
+    return j % n, (j + 1) % n, w
+
+
+def _linear_weights(x_in, x_out, period=None):
+    """
+    Matrix of 1d linear interpolation weights. Points outside the input coordinates take the value at the nearest end,
+    unless the coordinate is periodic.
+
+    :param x_in: 1d array: ascending input coordinates
+    :param x_out: 1d array: output coordinates
+    :param period: float: if not None, the period of a cyclic coordinate
+    :return: ndarray (len(x_out), len(x_in)): weights
+    """
+    j0, j1, w = _linear_indices(x_in, x_out, period=period)
+    rows = np.arange(len(x_out))
+    weights = np.zeros((len(x_out), len(x_in)))
+    np.add.at(weights, (rows, j0), 1. - w)
+    np.add.at(weights, (rows, j1), w)
+    return weights
+
+
+def _cubic_weights(x_in, x_out):
+    """
+    Matrix of 1d interpolation weights of a not-a-knot cubic spline. Points outside the input coordinates take the value
+    at the nearest end. Applied along both axes of a grid, this equals scipy's RectBivariateSpline with its defaults.
+
+    :param x_in: 1d array: ascending input coordinates
+    :param x_out: 1d array: output coordinates
+    :return: ndarray (len(x_out), len(x_in)): weights
+    """
+    from scipy.interpolate import make_interp_spline
+    spline = make_interp_spline(x_in, np.eye(len(x_in)), k=3)
+    return spline(np.clip(x_out, x_in[0], x_in[-1]))
+
+
+def _cell_edges(x):
+    """
+    :param x: 1d array: ascending cell centers
+    :return: 1d array: cell edges, halfway between the centers, with the outermost cells symmetric about their centers
+    """
+    mid = 0.5 * (x[1:] + x[:-1])
+    return np.concatenate([[x[0] - (mid[0] - x[0])], mid, [x[-1] + (x[-1] - mid[-1])]])
+
+
+def _overlap_weights(edges_in, edges_out, period=None):
+    """
+    Matrix of 1d conservative remapping weights: the fraction of each output cell covered by each input cell,
+    normalized over the part of the output cell covered by input cells.
+
+    :param edges_in: 1d array: ascending edges of the input cells
+    :param edges_out: 1d array: ascending edges of the output cells
+    :param period: float: if not None, the period of a cyclic coordinate
+    :return: ndarray (len(edges_out) - 1, len(edges_in) - 1): weights
+    """
+    shifts = [0.] if period is None else [-period, 0., period]
+    overlap = 0.
+    for shift in shifts:
+        lower = np.maximum(edges_out[:-1, np.newaxis], edges_in[np.newaxis, :-1] + shift)
+        upper = np.minimum(edges_out[1:, np.newaxis], edges_in[np.newaxis, 1:] + shift)
+        overlap = overlap + np.maximum(upper - lower, 0.)
+    total = overlap.sum(axis=1, keepdims=True)
+    return overlap / np.where(total > 0., total, 1.)
+
+
+class Regridder(object):
+    """
+    Regrid fields between two regular latitude-longitude grids. Interpolation between rectilinear grids is separable,
+    so the weights are one matrix for latitude and one for longitude. They are computed once for a pair of grids and
+    then applied to any number of fields as two matrix products. The weights may be cached in a file between runs.
+
+    Methods are 'bilinear', 'bicubic' (a not-a-knot cubic spline, as scipy's RectBivariateSpline), and 'conservative'
+    (area-weighted on the sphere). Longitude is treated as cyclic by the bilinear and conservative methods if the input
+    grid is global.
+    """
+
+    methods = ('bilinear', 'bicubic', 'conservative')
+
+    def __init__(self, lat_in, lon_in, lat_out, lon_out, method='bilinear', cache_file=None):
+        """
+        Initialize a Regridder.
+
+        :param lat_in: 1d array: latitudes of the input grid, in degrees, ascending or descending
+        :param lon_in: 1d array: longitudes of the input grid, in degrees, ascending
+        :param lat_out: 1d array: latitudes of the output grid
+        :param lon_out: 1d array: longitudes of the output grid. Must be in the same range (0-360 or -180-180) as
+            lon_in, unless the input grid is global.
+        :param method: str: interpolation method; one of 'bilinear', 'bicubic', or 'conservative'
+        :param cache_file: str: path to a .npz file in which to save the weights. If the file exists and matches the
+            grids and method, the weights are loaded from it.
+        """
+        if method not in self.methods:
+            raise ValueError("'method' must be one of %s" % (self.methods,))
+        self.lat_in = np.array(lat_in, dtype=np.float64).ravel()
+        self.lon_in = np.array(lon_in, dtype=np.float64).ravel()
+        self.lat_out = np.array(lat_out, dtype=np.float64).ravel()
+        self.lon_out = np.array(lon_out, dtype=np.float64).ravel()
+        if np.any(np.diff(self.lon_in) <= 0):
+            raise ValueError("'lon_in' must be strictly ascending")
+        self.method = method
+        self.lat_weights = None
+        self.lon_weights = None
+        if cache_file is not None and os.path.isfile(cache_file):
+            self.load(cache_file)
+        if self.lat_weights is None:
+            self._compute_weights()
+            if cache_file is not None:
+                self.save(cache_file)
+
+    @property
+    def shape_in(self):
+        """
+        :return: tuple: (lat, lon) shape of the input grid
+        """
+        return len(self.lat_in), len(self.lon_in)
+
+    @property
+    def shape_out(self):
+        """
+        :return: tuple: (lat, lon) shape of the output grid
+        """
+        return len(self.lat_out), len(self.lon_out)
+
+    def _compute_weights(self):
+        lat_order = np.argsort(self.lat_in)
+        lat_in = self.lat_in[lat_order]
+        period = 360. if _is_global(self.lon_in) else None
+        if self.method == 'bilinear':
+            lat_weights = _linear_weights(lat_in, self.lat_out)
+            self.lon_weights = _linear_weights(self.lon_in, self.lon_out, period=period)
+        elif self.method == 'bicubic':
+            lat_weights = _cubic_weights(lat_in, self.lat_out)
+            self.lon_weights = _cubic_weights(self.lon_in, self.lon_out)
+        else:
+            # Latitude cells are weighted by area, which is proportional to the difference in sin(lat)
+            def sin_edges(lat):
+                return np.sin(np.deg2rad(np.clip(_cell_edges(lat), -90., 90.)))
+            out_order = np.argsort(self.lat_out)
+            lat_weights = np.empty((len(self.lat_out), len(lat_in)))
+            lat_weights[out_order] = _overlap_weights(sin_edges(lat_in), sin_edges(self.lat_out[out_order]))
+            lon_out = self.lon_out
+            if period is not None:
+                lon_out = self.lon_in[0] + np.mod(lon_out - self.lon_in[0], period)
+            lon_order = np.argsort(lon_out)
+            self.lon_weights = np.empty((len(lon_out), len(self.lon_in)))
+            self.lon_weights[lon_order] = _overlap_weights(_cell_edges(self.lon_in), _cell_edges(lon_out[lon_order]),
+                                                           period=period)
+        # Put the weights back in the order of the input latitudes
+        self.lat_weights = np.empty_like(lat_weights)
+        self.lat_weights[:, lat_order] = lat_weights
+
+    def __call__(self, data):
+        """
+        Regrid fields.
+
+        :param data: ndarray (..., lat, lon): fields on the input grid
+        :return: ndarray (..., lat, lon): fields on the output grid. Floating-point data keep their dtype.
+        """
+        data = np.asarray(data)
+        if data.shape[-2:] != self.shape_in:
+            raise ValueError('last two dimensions of data %s do not match the input grid %s' %
+                             (data.shape[-2:], self.shape_in))
+        dtype = data.dtype if np.issubdtype(data.dtype, np.floating) else np.float64
+        result = np.matmul(np.matmul(self.lat_weights, data), self.lon_weights.T)
+        return result.astype(dtype, copy=False)
+
+    def save(self, file_name):
+        """
+        Save the weights to a .npz file. The file is written in place atomically, so that concurrent processes may share
+        it.
+
+        :param file_name: str: file path
+        """
+        temp_file = '%s.%d.tmp' % (file_name, os.getpid())
+        with open(temp_file, 'wb') as f:
+            np.savez(f, lat_in=self.lat_in, lon_in=self.lon_in, lat_out=self.lat_out, lon_out=self.lon_out,
+                     method=self.method, lat_weights=self.lat_weights, lon_weights=self.lon_weights)
+        os.replace(temp_file, file_name)
+
+    def load(self, file_name):
+        """
+        Load weights saved with save(). The file is ignored if its grids or method do not match.
+
+        :param file_name: str: file path
+        """
+        with np.load(file_name) as f:
+            for name in ['lat_in', 'lon_in', 'lat_out', 'lon_out']:
+                if f[name].shape != getattr(self, name).shape or not np.allclose(f[name], getattr(self, name)):
+                    return
+            if str(f['method']) != self.method:
+                return
+            self.lat_weights = f['lat_weights']
+            self.lon_weights = f['lon_weights']
+
+
+def _great_circle(lat1, lon1, lat2, lon2):
+    """
+    :return: great-circle distance in degrees between points, using the haversine formula
+    """
+    lat1, lon1, lat2, lon2 = [np.deg2rad(a) for a in (lat1, lon1, lat2, lon2)]
+    h = np.sin(0.5 * (lat2 - lat1)) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(0.5 * (lon2 - lon1)) ** 2
+    return np.rad2deg(2. * np.arcsin(np.sqrt(np.clip(h, 0., 1.))))
+
+
+def _unit_vectors(lat, lon):
+    """
+    :return: ndarray (..., 3): Cartesian coordinates of points on the unit sphere
+    """
+    lat, lon = np.deg2rad(lat), np.deg2rad(lon)
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+
+
+class GridLocator(object):
+    """
+    Locate many points at once on a latitude-longitude grid, e.g., for verification at stations. Distances are
+    great-circle distances, so points across the dateline or near the poles are handled correctly.
+
+    The spatial index is built once per grid. For a regular global grid with 1d, evenly spaced coordinates, the closest
+    points are found analytically from the grid spacing; otherwise, with a KD-tree of the grid points on the unit
+    sphere.
+    Bilinear interpolation weights are available for grids with 1d coordinates.
+    """
+
+    def __init__(self, lat, lon):
+        """
+        Initialize a GridLocator.
+
+        :param lat: 1d or 2d array: latitudes of the grid in degrees. If 1d, latitude may be ascending or descending.
+        :param lon: 1d or 2d array: longitudes of the grid in degrees. If 1d, must be ascending. If 2d, must match the
+            shape of lat.
+        """
+        self.lat = np.array(lat, dtype=np.float64)
+        self.lon = np.array(lon, dtype=np.float64)
+        if self.lat.ndim != self.lon.ndim or self.lat.ndim not in (1, 2):
+            raise ValueError('lat and lon must both be 1d or both be 2d')
+        if self.lat.ndim == 2 and self.lat.shape != self.lon.shape:
+            raise ValueError('2d lat and lon must have the same shape')
+        self._tree = None
+        self._regular = False
+        if self.lat.ndim == 1:
+            if np.any(np.diff(self.lon) <= 0):
+                raise ValueError('1d lon must be strictly ascending')
+            self._lat_order = np.argsort(self.lat)
+            self._lat_sorted = self.lat[self._lat_order]
+            self._period = 360. if _is_global(self.lon) else None
+            self._regular = (self._period is not None and len(self.lat) > 1 and
+                             np.allclose(np.diff(self._lat_sorted), self._lat_sorted[1] - self._lat_sorted[0]))
+        if not self._regular:
+            from scipy.spatial import cKDTree
+            lat_grid, lon_grid = (np.meshgrid(self.lat, self.lon, indexing='ij') if self.lat.ndim == 1
+                                  else (self.lat, self.lon))
+            self._tree = cKDTree(_unit_vectors(lat_grid, lon_grid).reshape((-1, 3)))
+
+    @property
+    def shape(self):
+        """
+        :return: tuple: shape of the grid
+        """
+        return self.lat.shape + self.lon.shape if self.lat.ndim == 1 else self.lat.shape
+
+    def closest(self, lat, lon, return_distance=False):
+        """
+        Find the grid points closest to points.
+
+        :param lat: float or array: latitudes of the points in degrees
+        :param lon: float or array: longitudes of the points in degrees, in any range
+        :param return_distance: bool: if True, also return the great-circle distance to the closest grid points
+        :return: tuple of index arrays into the grid, each of the shape of lat, as from np.unravel_index; and, if
+            return_distance, the distances in degrees
+        """
+        lat, lon = np.broadcast_arrays(np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64))
+        if self._regular:
+            # The closest point is in the closest column, in one of the two rows bracketing the latitude
+            lat_grid = self._lat_sorted
+            d_lat = lat_grid[1] - lat_grid[0]
+            d_lon = self.lon[1] - self.lon[0]
+            j = np.round(np.mod(lon - self.lon[0], 360.) / d_lon).astype(int) % len(self.lon)
+            i0 = np.clip(np.floor((lat - lat_grid[0]) / d_lat).astype(int), 0, len(lat_grid) - 1)
+            i1 = np.minimum(i0 + 1, len(lat_grid) - 1)
+            dist0 = _great_circle(lat, lon, lat_grid[i0], self.lon[j])
+            dist1 = _great_circle(lat, lon, lat_grid[i1], self.lon[j])
+            i = self._lat_order[np.where(dist1 < dist0, i1, i0)]
+            index = (i, j)
+            distance = np.minimum(dist0, dist1)
+        else:
+            chord, flat = self._tree.query(_unit_vectors(lat, lon))
+            index = np.unravel_index(flat, self.shape)
+            distance = np.rad2deg(2. * np.arcsin(np.clip(0.5 * chord, 0., 1.)))
+        if return_distance:
+            return index, distance
+        return index
+
+    def bilinear_weights(self, lat, lon):
+        """
+        Get the weights of bilinear interpolation from the grid to points. Requires 1d grid coordinates.
+
+        :param lat: float or array: latitudes of the points in degrees
+        :param lon: float or array: longitudes of the points in degrees
+        :return: indices, weights: ndarrays of the shape of lat with a last dimension of 4: indices of the four
+            surrounding points in the flattened grid, and their weights
+        """
+        if self.lat.ndim != 1:
+            raise ValueError('bilinear weights require 1d grid coordinates')
+        lat, lon = np.broadcast_arrays(np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64))
+        shape = lat.shape
+        i0, i1, wi = _linear_indices(self._lat_sorted, lat.ravel())
+        i0, i1 = self._lat_order[i0], self._lat_order[i1]
+        j0, j1, wj = _linear_indices(self.lon, lon.ravel(), period=self._period)
+        n_lon = len(self.lon)
+        indices = np.stack([i0 * n_lon + j0, i0 * n_lon + j1, i1 * n_lon + j0, i1 * n_lon + j1], axis=-1)
+        weights = np.stack([(1. - wi) * (1. - wj), (1. - wi) * wj, wi * (1. - wj), wi * wj], axis=-1)
+        return indices.reshape(shape + (4,)), weights.reshape(shape + (4,))
+
+    def interpolate(self, data, lat, lon):
+        """
+        Bilinearly interpolate fields to points.
+
+        :param data: ndarray (..., lat, lon): fields on the grid
+        :param lat: float or array: latitudes of the points in degrees
+        :param lon: float or array: longitudes of the points in degrees
+        :return: ndarray (..., [points]): fields at the points
+        """
+        indices, weights = self.bilinear_weights(lat, lon)
+        data = np.asarray(data)
+        flat = data.reshape(data.shape[:-2] + (-1,))
+        return np.sum(flat[..., indices] * weights, axis=-1)
@@ -9,7 +9,7 @@ Implementation of deep learning model frameworks for DLWP.
 """
 
 from .models import DLWPNeuralNet
-from .generators import DataGenerator, SmartDataGenerator, SeriesDataGenerator
+from .generators import DataGenerator, SmartDataGenerator, SeriesDataGenerator, PrefetchGenerator
 from .preprocessing import Preprocessor
 from .extensions import TimeSeriesEstimator
 from . import verify
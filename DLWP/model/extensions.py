@@ -13,8 +13,8 @@ import xarray as xr
 import pandas as pd
 from .models import DLWPNeuralNet
 from .models_torch import DLWPTorchNN
-from .generators import DataGenerator, SmartDataGenerator, SeriesDataGenerator
-from ..util import insolation
+from .generators import DataGenerator, SmartDataGenerator, SeriesDataGenerator, PrefetchGenerator
+from ..util import InsolationTable
 
 
 class TimeSeriesEstimator(object):
@@ -33,6 +33,9 @@ class TimeSeriesEstimator(object):
         """
         if not isinstance(model, (DLWPNeuralNet, DLWPTorchNN)):
             raise TypeError("'model' must be a valid instance of a DLWP model class")
+        if isinstance(generator, PrefetchGenerator):
+            # Predictions are made on the whole dataset at once, so there is nothing to prefetch
+            generator = generator.generator
         if not isinstance(generator, (DataGenerator, SmartDataGenerator, SeriesDataGenerator)):
             raise TypeError("'generator' must be a valid instance of a DLWP generator class")
         self.model = model
@@ -44,6 +47,9 @@ class TimeSeriesEstimator(object):
         self._output_sel = {}
         self._input_sel = {}
         self._dt = self.generator.ds['sample'][1] - self.generator.ds['sample'][0]
+        if self._add_insolation:
+            self._insolation_table = getattr(generator, '_insolation_table', None) or \
+                InsolationTable(self.generator.ds.lat.values, self.generator.ds.lon.values)
 
         # Generate the selections needed for inputs and outputs
         if self._uses_varlev:
@@ -209,9 +215,8 @@ class TimeSeriesEstimator(object):
             # Take care of the known insolation for added time steps
             if self._add_insolation:
                 p_da.loc[{'varlev': 'SOL'}][-es:] = \
-                    np.concatenate([insolation(p_da.sample[-es:] + n * self._dt,
-                                               self.generator.ds.lat, self.generator.ds.lon)[:, np.newaxis]
-                                    for n in range(self._input_time_steps)], axis=1)
+                    np.concatenate([self._insolation_table(p_da.sample[-es:].values + n * self._dt.values)
+                                    [:, np.newaxis] for n in range(self._input_time_steps)], axis=1)
 
             # Replace the predictors that exist in the result with the result. Any that do not exist are automatically
             # inherited from the known predictor data (or imputed data).
@@ -9,11 +9,16 @@ High-level APIs for building data generators. These produce batches of data on-t
 fit_generator() methods.
 """
 
+import os
+import json
 import warnings
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import numpy as np
 import xarray as xr
 from keras.utils import Sequence
-from ..util import delete_nan_samples, insolation
+from ..util import delete_nan_samples, valid_samples, InsolationTable
 
 
 class DataGenerator(Sequence):
@@ -22,7 +27,8 @@ class DataGenerator(Sequence):
     of the EnsembleSelector to do scaling and imputing of data.
     """
 
-    def __init__(self, model, ds, batch_size=32, shuffle=False, remove_nan=True):
+    def __init__(self, model, ds, batch_size=32, shuffle=False, remove_nan=True, cache_bytes=0, block_size=None,
+                 precompute_valid=False):
         """
         Initialize a DataGenerator.
 
@@ -31,6 +37,14 @@ class DataGenerator(Sequence):
         :param batch_size: int: number of samples to take at a time from the dataset
         :param shuffle: bool: if True, randomly select batches
         :param remove_nan: bool: if True, remove any samples with NaNs
+        :param cache_bytes: int: if > 0, read the dataset in contiguous blocks of samples and keep up to this many
+            bytes of blocks in a least-recently-used cache. Shuffling then becomes block-aware: the order of the
+            blocks is shuffled, and then the samples within each block, so that batches are read sequentially.
+        :param block_size: int: number of samples per cached block. Defaults to the chunk size of the predictors in
+            the sample dimension, or batch_size if the predictors are not chunked.
+        :param precompute_valid: bool: if True and remove_nan is True, scan the dataset for samples with NaNs once, in
+            blocks of block_size, and leave those samples out of the epoch indices instead of removing them from
+            every batch
         """
         self.model = model
         if not hasattr(ds, 'predictors') or not hasattr(ds, 'targets'):
@@ -46,8 +60,85 @@ class DataGenerator(Sequence):
         self._n_sample = ds.dims['sample']
         self._has_time_step = 'time_step' in ds.dims
 
+        # Block cache
+        self._cache_bytes = int(cache_bytes)
+        if block_size is None:
+            if ds.predictors.chunks is not None:
+                block_size = ds.predictors.chunks[0][0]
+            else:
+                block_size = (ds.predictors.encoding.get('chunksizes') or (batch_size,))[0]
+        if int(block_size) < 1:
+            raise ValueError("'block_size' must be >= 1")
+        self._block_size = int(block_size)
+        self._block_cache = OrderedDict()
+        self._cached_bytes = 0
+        self._cache_lock = threading.Lock()
+
+        # Valid-sample index
+        self._valid = None
+        if remove_nan and precompute_valid:
+            self._valid = np.empty(self._n_sample, dtype=bool)
+            for b in range(0, self._n_sample, self._block_size):
+                ds_block = self.ds.isel(sample=slice(b, b + self._block_size))
+                self._valid[b:b + self._block_size] = (valid_samples(ds_block.predictors.values) &
+                                                       valid_samples(ds_block.targets.values))
+
         self.on_epoch_end()
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_block_cache'] = OrderedDict()
+        state['_cached_bytes'] = 0
+        state['_cache_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._cache_lock = threading.Lock()
+
+    def _get_block(self, block):
+        """
+        Get the predictors and targets of a block of samples from the cache, reading them if necessary.
+
+        :param block: int: index of the block
+        :return: (ndarray, ndarray): predictors, targets
+        """
+        with self._cache_lock:
+            if block in self._block_cache:
+                self._block_cache.move_to_end(block)
+                return self._block_cache[block]
+        ds = self.ds.isel(sample=slice(block * self._block_size, (block + 1) * self._block_size))
+        data = (ds.predictors.values, ds.targets.values)
+        with self._cache_lock:
+            if block not in self._block_cache:
+                self._block_cache[block] = data
+                self._cached_bytes += data[0].nbytes + data[1].nbytes
+                while self._cached_bytes > self._cache_bytes and len(self._block_cache) > 1:
+                    evicted = self._block_cache.popitem(last=False)[1]
+                    self._cached_bytes -= evicted[0].nbytes + evicted[1].nbytes
+        return data
+
+    def _cached_samples(self, samples):
+        """
+        Gather samples from the blocks in the cache.
+
+        :param samples: 1d array: sample indices
+        :return: (ndarray, ndarray): predictors, targets
+        """
+        samples = np.asarray(samples)
+        blocks = samples // self._block_size
+        p, t = None, None
+        for block in np.unique(blocks):
+            p_block, t_block = self._get_block(block)
+            if p is None:
+                p = np.empty((len(samples),) + p_block.shape[1:], dtype=p_block.dtype)
+                t = np.empty((len(samples),) + t_block.shape[1:], dtype=t_block.dtype)
+            in_block = blocks == block
+            offsets = samples[in_block] - block * self._block_size
+            p[in_block] = p_block[offsets]
+            t[in_block] = t_block[offsets]
+        return p, t
+
     @property
     def shape(self):
         """
@@ -101,28 +192,47 @@ class DataGenerator(Sequence):
             return self.convolution_shape
 
     def on_epoch_end(self):
-        self._indices = np.arange(self._n_sample)
+        if self._valid is not None:
+            self._indices = np.flatnonzero(self._valid)
+        else:
+            self._indices = np.arange(self._n_sample)
         if self._shuffle:
-            np.random.shuffle(self._indices)
+            if self._cache_bytes > 0:
+                # Shuffle the blocks, then the samples within each block
+                block_ind = self._indices // self._block_size
+                blocks = np.split(self._indices, np.flatnonzero(np.diff(block_ind)) + 1)
+                for block in blocks:
+                    np.random.shuffle(block)
+                self._indices = np.concatenate([blocks[b] for b in np.random.permutation(len(blocks))])
+            else:
+                np.random.shuffle(self._indices)
 
     def generate(self, samples, scale_and_impute=True):
-        if len(samples) > 0:
-            ds = self.ds.isel(sample=samples)
+        if len(samples) == 0:
+            # Index all samples explicitly so that the in-place scaling below works on a copy of the data
+            samples = np.arange(self.ds.dims['sample'])
+        if self._valid is not None:
+            samples = np.asarray(samples)
+            samples = samples[self._valid[samples]]
+        if self._cache_bytes > 0:
+            p, t = self._cached_samples(samples)
+            n_sample = p.shape[0]
+            p = p.reshape((n_sample, -1))
+            t = t.reshape((n_sample, -1))
         else:
-            ds = self.ds.isel(sample=slice(None))
-        n_sample = ds.predictors.shape[0]
-        p = ds.predictors.values.reshape((n_sample, -1))
-        t = ds.targets.values.reshape((n_sample, -1))
-        ds.close()
-        ds = None
+            ds = self.ds.isel(sample=samples)
+            n_sample = ds.predictors.shape[0]
+            p = ds.predictors.values.reshape((n_sample, -1))
+            t = ds.targets.values.reshape((n_sample, -1))
+            ds.close()
+            ds = None
 
         # Remove samples with NaN; scale and impute
-        if self._remove_nan:
+        if self._remove_nan and self._valid is None:
             p, t = delete_nan_samples(p, t)
+            n_sample = p.shape[0]
         if scale_and_impute:
-            if self._impute_missing:
-                p, t = self.model.imputer_transform(p, t)
-            p, t = self.model.scaler_transform(p, t)
+            p, t = self.model.impute_scale_transform(p, t)
 
         # Format spatial shape for convolutions; also takes care of time axis
         if self._is_convolutional:
@@ -138,7 +248,7 @@ class DataGenerator(Sequence):
         """
         :return: the number of batches per epoch
         """
-        return int(np.ceil(self._n_sample / self._batch_size))
+        return int(np.ceil(len(self._indices) / self._batch_size))
 
     def __getitem__(self, index):
         """
@@ -267,9 +377,9 @@ class SmartDataGenerator(Sequence):
 
     def generate(self, samples, scale_and_impute=True):
         if len(samples) == 0:
-            samples = np.arange(self._n_sample, dtype=np.int)
+            samples = np.arange(self._n_sample, dtype=int)
         else:
-            samples = np.array(samples, dtype=np.int)
+            samples = np.array(samples, dtype=int)
         n_sample = len(samples)
         p = np.concatenate([self.da.values[samples + n, np.newaxis] for n in range(self.time_dim)], axis=1)
         p = p.reshape((n_sample, -1))
@@ -280,10 +390,9 @@ class SmartDataGenerator(Sequence):
         # Remove samples with NaN; scale and impute
         if self._remove_nan:
             p, t = delete_nan_samples(p, t)
+            n_sample = p.shape[0]
         if scale_and_impute:
-            if self._impute_missing:
-                p, t = self.model.imputer_transform(p, t)
-            p, t = self.model.scaler_transform(p, t)
+            p, t = self.model.impute_scale_transform(p, t)
 
         # Format spatial shape for convolutions; also takes care of time axis
         if self._is_convolutional:
@@ -332,7 +441,8 @@ class SeriesDataGenerator(Sequence):
     """
 
     def __init__(self, model, ds, input_sel=None, output_sel=None, input_time_steps=1, output_time_steps=1,
-                 add_insolation=False, batch_size=32, shuffle=False, remove_nan=True, load=True):
+                 add_insolation=False, batch_size=32, shuffle=False, remove_nan=True, load=True, shared_memory=False,
+                 memmap_dir=None, insolation_cache=None, precompute_valid=False):
         """
         Initialize a SeriesDataGenerator.
 
@@ -348,10 +458,26 @@ class SeriesDataGenerator(Sequence):
         :param shuffle: bool: if True, randomly select batches
         :param remove_nan: bool: if True, remove any samples with NaNs
         :param load: bool: if True, load the data in memory (highly recommended if enough system memory is available)
+        :param shared_memory: bool: if True, load the data into shared memory blocks. Copies of the generator sent to
+            worker processes (e.g., by fit_generator with use_multiprocessing=True, or by a PrefetchGenerator) attach
+            to these blocks instead of carrying their own copy of the data. Requires load=True. Call close() to release
+            the shared memory.
+        :param memmap_dir: str: if not None, serve the data from memory-mapped files in this directory instead of
+            loading it into memory, overriding 'load'. The selected input and output series are exported once to raw
+            .npy files, each with a small .json metadata file, and are re-used as long as the metadata match the
+            selection. This gives nearly the speed of loaded data for datasets larger than memory.
+        :param insolation_cache: str: path to a .npz file in which to cache the insolation lookup table between runs
+        :param precompute_valid: bool: if True and remove_nan is True, find the time steps with NaNs once and leave
+            every sample whose input or output window contains one out of the epoch indices, instead of removing them
+            from every batch
         """
         self.model = model
         if not hasattr(ds, 'predictors'):
             raise ValueError("dataset must have 'predictors' variable")
+        if shared_memory and not load:
+            raise ValueError("'shared_memory' requires 'load' to be True")
+        if shared_memory and memmap_dir is not None:
+            raise ValueError("'shared_memory' and 'memmap_dir' are mutually exclusive")
         assert int(input_time_steps) > 0
         assert int(output_time_steps) > 0
         assert int(batch_size) > 0
@@ -377,22 +503,59 @@ class SeriesDataGenerator(Sequence):
         self._output_time_steps = output_time_steps
 
         self.input_da = self.da.sel(**self._input_sel)
-        self.output_da = self.da.sel(**self._output_sel)
-        if load:
-            self.input_da.load()
-            self.output_da.load()
+        if not self._input_sel and not self._output_sel:
+            # Inputs and outputs are the same series; don't keep two copies of it
+            self.output_da = self.input_da
+        else:
+            self.output_da = self.da.sel(**self._output_sel)
+        # With loaded data, keep the series as contiguous arrays from which windows are gathered in a single take
+        self._input_data = None
+        self._output_data = None
+        self._shared_memory = {}
+        self._owns_shared_memory = bool(shared_memory)
+        self._memmap_dir = memmap_dir
+        self._memmap_files = {}
+        if load or memmap_dir is not None:
+            same_series = self.output_da is self.input_da
+            self.input_da, self._input_data = self._load(self.input_da, 'input')
+            if same_series:
+                self.output_da, self._output_data = self.input_da, self._input_data
+            else:
+                self.output_da, self._output_data = self._load(self.output_da, 'output')
+
+        # Valid-sample index from the windows of valid time steps
+        self._valid = None
+        if remove_nan and precompute_valid:
+            in_count = np.concatenate([[0], np.cumsum(~self._valid_steps(self.input_da, self._input_data))])
+            if self.output_da is self.input_da:
+                out_count = in_count
+            else:
+                out_count = np.concatenate([[0], np.cumsum(~self._valid_steps(self.output_da, self._output_data))])
+            start = np.arange(self._n_sample)
+            split = start + input_time_steps
+            self._valid = ((in_count[split] == in_count[start]) &
+                           (out_count[split + output_time_steps] == out_count[split]))
 
         self.on_epoch_end()
 
         # Pre-generate the insolation data
         self._add_insolation = int(add_insolation)
+        self._insolation_data = None
+        self._insolation_table = None
         if add_insolation:
-            sol = insolation(self.da.sample.values, self.da.lat.values, self.da.lon.values)
+            self._insolation_table = InsolationTable(self.da.lat.values, self.da.lon.values,
+                                                     cache_file=insolation_cache)
+            sol = self._insolation_table(self.da.sample.values)
             self.insolation_da = xr.DataArray(sol, coords={
                 'sample': self.da.sample,
                 'lat': self.da.lat,
                 'lon': self.da.lon
             }, dims=['sample', 'lat', 'lon'])
+            self._insolation_data = self.insolation_da.values
+            if self._owns_shared_memory:
+                self._shared_memory['insolation'], self._insolation_data = _new_shared_array(sol.shape, sol.dtype)
+                self._insolation_data[:] = sol
+                self.insolation_da = self.insolation_da.copy(data=self._insolation_data)
 
     @property
     def shape(self):
@@ -493,43 +656,179 @@ class SeriesDataGenerator(Sequence):
         else:
             return self.output_convolution_shape
 
+    # DataArray and array attributes of the series which may be held in shared memory
+    _shared_attributes = {
+        'input': ('input_da', '_input_data'),
+        'output': ('output_da', '_output_data'),
+        'insolation': ('insolation_da', '_insolation_data')
+    }
+
+    def _load(self, da, key):
+        """
+        Load a series into a contiguous array, in a new shared memory block if this generator uses shared memory, or
+        as a memory map of its exported copy if it uses a memory-mapped store.
+
+        :param da: xarray DataArray: series to load
+        :param key: str: key of the series in self._shared_memory or self._memmap_files
+        :return: (DataArray, ndarray): DataArray backed by the loaded array, and the array
+        """
+        if self._memmap_dir is not None:
+            self._memmap_files[key], data = _memmap_series(da, self._memmap_dir, key, source=_series_source(self.ds))
+        elif self._owns_shared_memory:
+            self._shared_memory[key], data = _new_shared_array(da.shape, da.dtype)
+            # Fill the block in pieces so that the full series is never held in memory twice
+            for s in range(0, da.shape[0], 1000):
+                data[s:s + 1000] = da.isel(sample=slice(s, s + 1000)).values
+        else:
+            data = np.ascontiguousarray(da.values)
+        return da.copy(data=data), data
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # The insolation is already in _insolation_data; the lookup table is only needed for predictions
+        state['_insolation_table'] = None
+        if self._shared_memory or self._memmap_files:
+            # Send the names of the shared memory blocks or memory-mapped files and the metadata of each series
+            # instead of the data. The dataset itself is not needed to generate batches.
+            state['_shared_memory'] = {}
+            for key in list(self._shared_memory.keys()) + list(self._memmap_files.keys()):
+                da_attr, data_attr = self._shared_attributes[key]
+                da, data = getattr(self, da_attr), getattr(self, data_attr)
+                if key in self._shared_memory:
+                    state['_shared_memory'][key] = (self._shared_memory[key].name, data.shape, data.dtype.str)
+                state[da_attr] = {'coords': {c: v.variable for c, v in da.coords.items()}, 'dims': da.dims,
+                                  'name': da.name, 'attrs': da.attrs}
+                state[data_attr] = None
+            if 'output' not in self._shared_memory and 'output' not in self._memmap_files:
+                state['output_da'], state['_output_data'] = None, None
+            state['ds'] = None
+            state['da'] = None
+            state['_owns_shared_memory'] = False
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._shared_memory or self._memmap_files:
+            blocks = {}
+            for key, (name, shape, dtype) in self._shared_memory.items():
+                da_attr, data_attr = self._shared_attributes[key]
+                blocks[key], data = _attach_shared_array(name, shape, dtype)
+                setattr(self, da_attr, xr.DataArray(data, **getattr(self, da_attr)))
+                setattr(self, data_attr, data)
+            self._shared_memory = blocks
+            for key, file_name in self._memmap_files.items():
+                da_attr, data_attr = self._shared_attributes[key]
+                data = np.load(file_name, mmap_mode='r')
+                setattr(self, da_attr, xr.DataArray(data, **getattr(self, da_attr)))
+                setattr(self, data_attr, data)
+            if 'output' not in blocks and 'output' not in self._memmap_files:
+                self.output_da, self._output_data = self.input_da, self._input_data
+
+    def close(self):
+        """
+        Release the shared memory blocks holding the data, if any. The generator which created the blocks also
+        removes them; the generator cannot produce data afterwards.
+        """
+        if not self._shared_memory:
+            return
+        for key in self._shared_memory.keys():
+            da_attr, data_attr = self._shared_attributes[key]
+            setattr(self, da_attr, None)
+            setattr(self, data_attr, None)
+        self.output_da, self._output_data = None, None
+        for shm in self._shared_memory.values():
+            if self._owns_shared_memory:
+                shm.unlink()
+            try:
+                shm.close()
+            except BufferError:
+                # Some array still references the block; the memory is freed when that array is garbage-collected
+                pass
+        self._shared_memory = {}
+
+    def __del__(self):
+        if getattr(self, '_owns_shared_memory', False):
+            self.close()
+
+    @staticmethod
+    def _gather(da, data, ind, out=None):
+        """
+        Gather windows of a series into an array of shape ind.shape + (feature shape of the series). If the series is
+        loaded (data is not None), the windows are taken in a single indexing operation on the contiguous array;
+        otherwise each time needed by the windows is read from the DataArray only once.
+
+        :param da: xarray DataArray: series with 'sample' as the first dimension
+        :param data: ndarray: contiguous array of da's values, or None if the data are not loaded
+        :param ind: ndarray: integer indices into the 'sample' dimension, e.g. (sample, time_step)
+        :param out: ndarray: if given, array into which the windows are placed. Its trailing dimensions may flatten
+            the non-spatial dimensions of the series, e.g. (sample, time_step, channel, y, x).
+        :return: ndarray: windows of the series
+        """
+        if data is None:
+            unique_ind, inverse = np.unique(ind, return_inverse=True)
+            data = da.isel(sample=unique_ind).values
+            ind = inverse.reshape(ind.shape)
+        if out is not None:
+            data = data.reshape((data.shape[0],) + out.shape[ind.ndim:])
+        return np.take(data, ind, axis=0, out=out)
+
+    def _valid_steps(self, da, data, block_size=1024):
+        """
+        Find the time steps of a series which do not contain NaN.
+
+        :param da: xarray DataArray: series
+        :param data: ndarray: loaded values of the series, or None
+        :param block_size: int: number of time steps to check at a time, so that neither the series (which may be
+            memory-mapped) nor its NaN mask is read into memory at once
+        :return: 1d boolean ndarray: True for valid time steps
+        """
+        n_step = da.shape[0]
+        valid = np.empty(n_step, dtype=bool)
+        for b in range(0, n_step, block_size):
+            block = data[b:b + block_size] if data is not None else da[b:b + block_size].values
+            valid[b:b + block_size] = valid_samples(block)
+        return valid
+
     def on_epoch_end(self):
-        self._indices = np.arange(self._n_sample)
+        if self._valid is not None:
+            self._indices = np.flatnonzero(self._valid)
+        else:
+            self._indices = np.arange(self._n_sample)
         if self._shuffle:
             np.random.shuffle(self._indices)
 
     def generate(self, samples, scale_and_impute=True):
         if len(samples) == 0:
-            samples = np.arange(self._n_sample, dtype=np.int)
+            samples = np.arange(self._n_sample, dtype=int)
         else:
-            samples = np.array(samples, dtype=np.int)
+            samples = np.array(samples, dtype=int)
+        if self._valid is not None:
+            samples = samples[self._valid[samples]]
         n_sample = len(samples)
-        p = np.concatenate([self.input_da.values[samples + n, np.newaxis] for n in range(self._input_time_steps)],
-                           axis=1)
-        t = np.concatenate([self.output_da.values[samples + self._input_time_steps + n, np.newaxis]
-                            for n in range(self._output_time_steps)], axis=1)
+        # Indices into the series of every time step of every window, (sample, time_step)
+        p_ind = samples[:, np.newaxis] + np.arange(self._input_time_steps)[np.newaxis, :]
+        t_ind = samples[:, np.newaxis] + np.arange(self._input_time_steps,
+                                                   self._input_time_steps + self._output_time_steps)[np.newaxis, :]
         if self._add_insolation:
-            # Pretend like we have no insolation and keep the time axis
-            self._add_insolation = False
-            keep_time = bool(self._keep_time_axis)
-            self._keep_time_axis = True
-            s = tuple(self.convolution_shape)
-            self._add_insolation = True
-            self._keep_time_axis = bool(keep_time)
-            sol = np.concatenate([self.insolation_da.values[samples + n, np.newaxis]
-                                  for n in range(self._input_time_steps)], axis=1)
-            p = p.reshape((n_sample,) + s)
-            p = np.concatenate([p, sol[:, :, np.newaxis]], axis=2)
+            # Gather inputs and insolation directly into their channels of one array, (sample, time_step, channel,
+            # y, x), instead of concatenating them afterwards
+            n_channel = int(np.prod(self.shape[1:-2]))
+            p = np.empty((n_sample, self._input_time_steps, n_channel + 1) + self.shape[-2:],
+                         dtype=self.input_da.dtype)
+            self._gather(self.input_da, self._input_data, p_ind, p[:, :, :n_channel])
+            np.take(self._insolation_data, p_ind, axis=0, out=p[:, :, n_channel])
+        else:
+            p = self._gather(self.input_da, self._input_data, p_ind)
+        t = self._gather(self.output_da, self._output_data, t_ind)
         p = p.reshape((n_sample, -1))
         t = t.reshape((n_sample, -1))
 
         # Remove samples with NaN; scale and impute
-        if self._remove_nan:
+        if self._remove_nan and self._valid is None:
             p, t = delete_nan_samples(p, t)
+            n_sample = p.shape[0]
         if scale_and_impute:
-            if self._impute_missing:
-                p, t = self.model.imputer_transform(p, t)
-            p, t = self.model.scaler_transform(p, t)
+            p, t = self.model.impute_scale_transform(p, t)
 
         # Format spatial shape for convolutions; also takes care of time axis
         if self._is_convolutional:
@@ -545,7 +844,7 @@ class SeriesDataGenerator(Sequence):
         """
         :return: the number of batches per epoch
         """
-        return int(np.ceil(self._n_sample / self._batch_size))
+        return int(np.ceil(len(self._indices) / self._batch_size))
 
     def __getitem__(self, index):
         """
@@ -564,3 +863,258 @@ class SeriesDataGenerator(Sequence):
         X, y = self.generate(indexes)
 
         return X, y
+
+
+def _series_source(ds):
+    """
+    Identify the data behind a series Dataset, so that copies exported from it are rebuilt when the data change: the
+    path, size, and modification time of its source file (totals over the files of a zarr directory), and the values
+    of its mean, std, and renormalization variables.
+
+    :param ds: xarray Dataset
+    :return: dict: JSON-serializable description of the source
+    """
+    source = {}
+    path = ds.encoding.get('source')
+    if path is not None and os.path.exists(path):
+        if os.path.isdir(path):
+            size, mtime = 0, os.stat(path).st_mtime
+            for root, dirs, files in os.walk(path):
+                for file in files:
+                    stat = os.stat(os.path.join(root, file))
+                    size += stat.st_size
+                    mtime = max(mtime, stat.st_mtime)
+        else:
+            stat = os.stat(path)
+            size, mtime = stat.st_size, stat.st_mtime
+        source['file'] = {'path': os.path.abspath(path), 'size': size, 'mtime': mtime}
+    for name in ['mean', 'std', 'renorm_mean', 'renorm_std']:
+        if name in ds.variables:
+            source[name] = np.asarray(ds[name].values, dtype=np.float64).ravel().tolist()
+    return source
+
+
+def _memmap_series(da, directory, name, source=None):
+    """
+    Open the memory-mapped copy of a series stored in directory as name.npy, with its metadata in name.json. The copy
+    is (re-)exported from da, a block of samples at a time, if it does not exist or if its metadata do not match da
+    and source.
+
+    :param da: xarray DataArray: series with 'sample' as the first dimension
+    :param directory: str: directory of the store
+    :param name: str: base name of the files of the series
+    :param source: dict: description of the data behind da, as from _series_source
+    :return: (str, ndarray): path to the .npy file, and the read-only memory-mapped array
+    """
+    file_name = os.path.join(directory, '%s.npy' % name)
+    meta_file_name = os.path.join(directory, '%s.json' % name)
+    meta = {
+        'dims': list(da.dims),
+        'shape': list(da.shape),
+        'dtype': da.dtype.str,
+        'coords': {d: [str(v) for v in da[d].values] for d in da.dims if d != 'sample' and d in da.coords},
+        'sample': [str(da.sample.values[0]), str(da.sample.values[-1])],
+        'source': source or {}
+    }
+    try:
+        with open(meta_file_name, 'r') as f:
+            exists = json.load(f) == meta and os.path.isfile(file_name)
+    except (IOError, ValueError):
+        exists = False
+    if not exists:
+        os.makedirs(directory, exist_ok=True)
+        if os.path.isfile(meta_file_name):
+            os.remove(meta_file_name)
+        data = np.lib.format.open_memmap(file_name, mode='w+', dtype=da.dtype, shape=da.shape)
+        for s in range(0, da.shape[0], 1000):
+            data[s:s + 1000] = da.isel(sample=slice(s, s + 1000)).values
+        data.flush()
+        del data
+        # Write the metadata last, so that an incomplete export is never re-used
+        with open(meta_file_name, 'w') as f:
+            json.dump(meta, f)
+    return file_name, np.load(file_name, mmap_mode='r')
+
+
+def _new_shared_array(shape, dtype):
+    """
+    Create a new shared memory block and an array backed by it.
+
+    :param shape: tuple: shape of the array
+    :param dtype: dtype of the array
+    :return: (SharedMemory, ndarray)
+    """
+    from multiprocessing import shared_memory
+    dtype = np.dtype(dtype)
+    shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _attach_shared_array(name, shape, dtype):
+    """
+    Attach to an existing shared memory block and return an array backed by it.
+
+    :param name: str: name of the shared memory block
+    :param shape: tuple: shape of the array
+    :param dtype: dtype of the array
+    :return: (SharedMemory, ndarray)
+    """
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+
+class PrefetchGenerator(Sequence):
+    """
+    Wrapper around a DLWP generator which builds upcoming batches in the background, on a pool of threads or
+    processes, while the model works on the current batch. Batches are returned in exactly the order the wrapped
+    generator would return them, so shuffling is unaffected by prefetching. Attributes not defined here, such as the
+    shape properties, are those of the wrapped generator.
+    """
+
+    def __init__(self, generator, max_queue_size=4, workers=2, use_multiprocessing=False, seed=None):
+        """
+        Initialize a PrefetchGenerator.
+
+        :param generator: DataGenerator, SmartDataGenerator, or SeriesDataGenerator instance
+        :param max_queue_size: int: number of batches to build ahead of the one being requested
+        :param workers: int: number of threads or processes building batches
+        :param use_multiprocessing: bool: if True, build batches in a process pool. The generator is sent to each
+            worker process once, when the pool starts, so any data it has loaded in memory is copied to every worker.
+            A SeriesDataGenerator must therefore serve its data from shared memory (shared_memory=True) or from
+            memory-mapped files (memmap_dir), or not load it at all; a SeriesDataGenerator holding loaded data of
+            its own is refused.
+        :param seed: int: if not None, the shuffling done by the generator at the end of each epoch is seeded with
+            seed + epoch, making the order of batches reproducible from run to run
+        """
+        if not isinstance(generator, (DataGenerator, SmartDataGenerator, SeriesDataGenerator)):
+            raise TypeError("'generator' must be a valid instance of a DLWP generator class")
+        if int(max_queue_size) < 1:
+            raise ValueError("'max_queue_size' must be >= 1")
+        if int(workers) < 1:
+            raise ValueError("'workers' must be >= 1")
+        if use_multiprocessing and isinstance(generator, SeriesDataGenerator) and generator._input_data is not None \
+                and not generator._shared_memory and not generator._memmap_files:
+            raise ValueError("'use_multiprocessing' would copy the data loaded by the generator to every worker; "
+                             "use a SeriesDataGenerator with shared_memory=True or memmap_dir instead")
+        self.generator = generator
+        self._max_queue_size = int(max_queue_size)
+        self._workers = int(workers)
+        self._use_multiprocessing = use_multiprocessing
+        self._seed = seed
+        self._epoch = 0
+        self._executor = None
+        self._futures = {}
+        self._lock = threading.Lock()
+
+        if self._seed is not None:
+            self._shuffle_generator()
+
+    def __getattr__(self, item):
+        # Only called for attributes not found on the wrapper itself
+        if item == 'generator':
+            raise AttributeError(item)
+        return getattr(self.generator, item)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_executor'] = None
+        state['_futures'] = {}
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _start(self):
+        if self._executor is None:
+            if self._use_multiprocessing:
+                self._executor = ProcessPoolExecutor(max_workers=self._workers, initializer=_init_prefetch_worker,
+                                                     initargs=(self.generator,))
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self._workers)
+
+    def _submit(self, index):
+        batch_size = self.generator._batch_size
+        indexes = self.generator._indices[index * batch_size:(index + 1) * batch_size]
+        if self._use_multiprocessing:
+            return self._executor.submit(_prefetch_generate, indexes)
+        else:
+            return self._executor.submit(self.generator.generate, indexes)
+
+    def _cancel(self):
+        for future in self._futures.values():
+            future.cancel()
+        self._futures = {}
+
+    def _shuffle_generator(self):
+        # Seed the generator's shuffle without disturbing the global random state
+        state = np.random.get_state()
+        np.random.seed(self._seed + self._epoch)
+        self.generator.on_epoch_end()
+        np.random.set_state(state)
+
+    def on_epoch_end(self):
+        with self._lock:
+            # Batches queued for this epoch used the old order, so they are discarded before re-shuffling
+            self._cancel()
+            self._epoch += 1
+            if self._seed is not None:
+                self._shuffle_generator()
+            else:
+                self.generator.on_epoch_end()
+
+    def close(self):
+        """
+        Stop the workers building batches.
+        """
+        with self._lock:
+            self._cancel()
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+    def __len__(self):
+        """
+        :return: the number of batches per epoch
+        """
+        return len(self.generator)
+
+    def __getitem__(self, index):
+        """
+        Get one batch of data, and queue up the batches following it
+        :param index: index of batch
+        :return: (ndarray, ndarray): predictors, targets
+        """
+        n_batch = len(self)
+        if int(index) < 0:
+            index = n_batch + index
+        if index < 0 or index >= n_batch:
+            raise IndexError
+        with self._lock:
+            self._start()
+            future = self._futures.pop(index, None)
+            if future is None:
+                future = self._submit(index)
+            # Forget batches which were skipped over
+            for i in [i for i in self._futures.keys() if i < index]:
+                self._futures.pop(i).cancel()
+            for i in range(index + 1, min(index + 1 + self._max_queue_size, n_batch)):
+                if i not in self._futures:
+                    self._futures[i] = self._submit(i)
+
+        return future.result()
+
+
+# Generator held by each worker process of a PrefetchGenerator
+_prefetch_worker_generator = None
+
+
+def _init_prefetch_worker(generator):
+    global _prefetch_worker_generator
+    _prefetch_worker_generator = generator
+
+
+def _prefetch_generate(samples):
+    return _prefetch_worker_generator.generate(samples)
@@ -14,7 +14,7 @@ import numpy as np
 import keras.models
 from keras.utils import multi_gpu_model
 
-from .generators import DataGenerator, SmartDataGenerator, SeriesDataGenerator
+from .generators import DataGenerator, SmartDataGenerator, SeriesDataGenerator, PrefetchGenerator
 from .. import util
 
 
@@ -51,6 +51,7 @@ class DLWPNeuralNet(object):
         self.impute = impute_missing
         self.imputer = None
         self.imputer_y = None
+        self._impute_scale_parameters = None
 
         self.base_model = None
         self.model = None
@@ -120,6 +121,7 @@ class DLWPNeuralNet(object):
         return a
 
     def scaler_fit(self, X, y, **kwargs):
+        self._impute_scale_parameters = None
         if self.scaler_type is not None:
             scaler_class = util.get_from_class('sklearn.preprocessing', self.scaler_type)
             self.scaler = scaler_class(**kwargs)
@@ -150,6 +152,7 @@ class DLWPNeuralNet(object):
             return X_transform.reshape(X_shape)
 
     def imputer_fit(self, X, y):
+        self._impute_scale_parameters = None
         imputer_class = util.get_from_class('sklearn.preprocessing', 'Imputer')
         self.imputer = imputer_class(missing_values=np.nan, strategy="mean", axis=0, copy=False)
         self.imputer_y = imputer_class(missing_values=np.nan, strategy="mean", axis=0, copy=False)
@@ -169,6 +172,17 @@ class DLWPNeuralNet(object):
         else:
             return X_transform.reshape(X_shape)
 
+    def impute_scale_transform(self, X, y=None):
+        """
+        Apply the Imputer (if imputing) and the Scaler to the predictors, and optionally the targets, in place. See
+        util.impute_scale_transform.
+
+        :param X: ndarray: predictor data; may be overwritten
+        :param y: ndarray: target data; may be overwritten
+        :return: X[, y]: transformed arrays
+        """
+        return util.impute_scale_transform(self, X, y)
+
     def init_fit(self, predictors, targets):
         """
         Initialize the Imputer and Scaler of the model manually. This is useful for fitting the data pre-processors
@@ -211,16 +225,29 @@ class DLWPNeuralNet(object):
             kwargs['validation_data'] = (predictors_test_scaled, targets_test_scaled)
         self.model.fit(predictors_scaled, targets_scaled, **kwargs)
 
+    def init_fit_generator(self, data, batch_size=32):
+        """
+        Initialize the Imputer and Scaler of the model from data which are too large to fit in memory, reading one
+        batch at a time. The fitted pre-processors are the same as from init_fit on all of the data. StandardScaler
+        and the Imputer need only one pass over the data; other scalers must support partial_fit.
+
+        :param data: a DLWP data generator (batches are generated without scaling), or an xarray Dataset with a
+            'predictors' variable and, unless the targets are the predictors, a 'targets' variable
+        :param batch_size: int: number of samples to read at a time from a Dataset
+        """
+        util.streaming_init_fit(self, data, batch_size=batch_size)
+
     def fit_generator(self, generator, **kwargs):
         """
         Fit the DLWPNeuralNet model using a generator. The generator becomes responsible for scaling and imputing
         the predictor/target data.
 
-        :param generator: a generator for producing batches of data (see Keras docs), e.g., DataGenerator below
+        :param generator: a generator for producing batches of data (see Keras docs), e.g., DataGenerator below, or a
+            PrefetchGenerator wrapping one
         :param kwargs: passed to the model's fit_generator() method
         """
         # If generator is a DataGenerator below, check that we have called init_fit
-        if isinstance(generator, (DataGenerator, SmartDataGenerator, SeriesDataGenerator)):
+        if isinstance(generator, (DataGenerator, SmartDataGenerator, SeriesDataGenerator, PrefetchGenerator)):
             if not self._is_init_fit:
                 raise AttributeError('DLWPNeuralNet has not been initialized for fitting with init_fit()')
         self.model.fit_generator(generator, **kwargs)
@@ -242,7 +269,8 @@ class DLWPNeuralNet(object):
         else:
             return predicted
 
-    def predict_timeseries(self, predictors, time_steps, step_sequence=False, keep_time_dim=False, **kwargs):
+    def predict_timeseries(self, predictors, time_steps, step_sequence=False, keep_time_dim=False, chunk_size=None,
+                           out=None, **kwargs):
         """
         Make a timeseries prediction with the DLWPNeuralNet model. Also performs input feature scaling. Forward predict
         time_steps number of time steps, intelligently using the time dimension to run the model time_steps/time_dim
@@ -250,6 +278,10 @@ class DLWPNeuralNet(object):
         use only one predicted time step (the other inputs are copied from the previous input) at a time. If the model
         is not recurrent, then it is assumed that the second dimension can be reshaped to (self.time_dim, num_channels).
 
+        The samples are predicted in chunks of chunk_size, and each step is written into the output as it is predicted,
+        so that only one chunk of inputs is held in memory. With StandardScaler, RobustScaler, or MaxAbsScaler, the
+        inputs are scaled once and stay in scaled space between steps; other scalers transform the data at every step.
+
         :param predictors: ndarray: predictor data
         :param time_steps: int: number of time steps to predict forward
         :param step_sequence: bool: if True, takes one step at a time in a time series sequence. That is, if a model
@@ -257,6 +289,9 @@ class DLWPNeuralNet(object):
             last prediction as inputs.
         :param keep_time_dim: if True, keep the time_step dimension in the output, otherwise integrates it into the
             forecast_hour (first) dimension
+        :param chunk_size: int: number of samples to predict at a time. If None, predict all samples at once.
+        :param out: ndarray: array, e.g., a numpy memmap, into which to write the prediction. Must have the shape of
+            the returned array. If None, a new float32 array is returned.
         :param kwargs: passed to Keras 'predict' method
         :return: ndarray: model prediction; first dim is time
         """
@@ -265,38 +300,73 @@ class DLWPNeuralNet(object):
             raise ValueError("time_steps must be an int > 0")
         if not step_sequence:
             time_steps = int(np.ceil(1. * time_steps / self.time_dim))
-        time_series = np.full((time_steps,) + predictors.shape, np.nan, dtype=np.float32)
-        p = predictors.copy()
-        sample_dim = p.shape[0]
+        sample_dim = predictors.shape[0]
         if self.is_recurrent:
-            feature_shape = p.shape[2:]
+            feature_shape = predictors.shape[2:]
         else:
-            feature_shape = p.shape[1:]
-        for t in range(time_steps):
-            if 'verbose' in kwargs and kwargs['verbose'] > 0:
-                print('Time step %d/%d' % (t+1, time_steps))
-            if step_sequence:
-                pr = self.predict(p, **kwargs)
-                pr_shape = pr.shape[:]
-                if not self.is_recurrent:
-                    pr = pr.reshape((sample_dim, self.time_dim, -1) + feature_shape[1:])
-                    p = p.reshape((sample_dim, self.time_dim, -1) + feature_shape[1:])
-                p = np.concatenate((p[:, 1:], pr[:, [0]]), axis=1)
-                if not self.is_recurrent:
-                    p = p.reshape(predictors.shape)
-                    pr = pr.reshape(pr_shape)
-                time_series[t, ...] = 1. * pr  # step, sample, [time_step,] (features,)
-            else:
-                p = 1. * self.predict(p, **kwargs)
-                time_series[t, ...] = 1. * p  # step, sample, [time_step,] (features,)
-        time_series = time_series.reshape((time_steps, sample_dim, self.time_dim, -1) + feature_shape[1:])
-        if not keep_time_dim:
-            if step_sequence:
-                time_series = time_series[:, :, 0]
-            else:
-                time_series = time_series.transpose((0, 2, 1) + tuple(range(3, 3 + len(feature_shape))))
-                time_series = time_series.reshape((time_steps * self.time_dim, sample_dim, -1) + feature_shape[1:])
-        return time_series
+            feature_shape = predictors.shape[1:]
+        # Shape of a sample with a separate time step dimension
+        step_shape = predictors[:1].reshape((1, self.time_dim, -1) + feature_shape[1:]).shape[1:]
+        if keep_time_dim:
+            out_shape = (time_steps, sample_dim) + step_shape
+        elif step_sequence:
+            out_shape = (time_steps, sample_dim) + step_shape[1:]
+        else:
+            out_shape = (time_steps * self.time_dim, sample_dim) + step_shape[1:]
+        if out is None:
+            out = np.full(out_shape, np.nan, dtype=np.float32)
+        elif tuple(out.shape) != out_shape:
+            raise ValueError("shape of 'out' %s does not match the prediction shape %s" % (tuple(out.shape), out_shape))
+        chunk_size = sample_dim if chunk_size is None else int(chunk_size)
+        if chunk_size < 1:
+            raise ValueError("'chunk_size' must be >= 1")
+        scale_parameters = util.rollout_scale_parameters(self, int(np.prod(predictors.shape[1:])),
+                                                         step_sequence=step_sequence)
+        verbose = kwargs.get('verbose', 0)
+
+        for start in range(0, sample_dim, chunk_size):
+            chunk = slice(start, min(start + chunk_size, sample_dim))
+            p = np.array(predictors[chunk])
+            if not np.issubdtype(p.dtype, np.floating):
+                p = p.astype(np.float32)
+            n_sample = p.shape[0]
+            if scale_parameters is not None:
+                y_scale, y_center, gain, offset = scale_parameters
+                p = self.impute_scale_transform(p)
+            for t in range(time_steps):
+                if verbose > 0:
+                    print('Time step %d/%d' % (t + 1, time_steps))
+                if scale_parameters is None:
+                    pr = self.predict(p, **kwargs)
+                    result = pr
+                else:
+                    pr = self.model.predict(p, **kwargs)
+                    result = pr.reshape((n_sample, -1))
+                    if y_scale is not None:
+                        result = result * y_scale
+                    if y_center is not None:
+                        result = result + y_center
+                result = result.reshape((n_sample,) + step_shape)
+                if keep_time_dim:
+                    out[t, chunk] = result
+                elif step_sequence:
+                    out[t, chunk] = result[:, 0]
+                else:
+                    out[t * self.time_dim:(t + 1) * self.time_dim, chunk] = result.swapaxes(0, 1)
+                # Inputs for the next step
+                if step_sequence:
+                    p_steps = p.reshape((n_sample,) + step_shape)
+                    p_steps[:, :-1] = p_steps[:, 1:]
+                    p_steps[:, -1] = pr.reshape((n_sample,) + step_shape)[:, 0]
+                else:
+                    p = np.asarray(pr, dtype=p.dtype).reshape(p.shape)
+                if scale_parameters is not None:
+                    p_flat = p.reshape((n_sample, -1))
+                    if gain is not None:
+                        np.multiply(p_flat, gain, out=p_flat, casting='unsafe')
+                    if offset is not None:
+                        np.add(p_flat, offset, out=p_flat, casting='unsafe')
+        return out
 
     def evaluate(self, predictors, targets, **kwargs):
         """
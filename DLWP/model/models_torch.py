@@ -21,6 +21,43 @@ try:
 
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
+    class _ScaledRolloutStep(nn.Module):
+        """
+        One step of a time series prediction of a DLWPTorchNN model in scaled space, with the scaling fused in as
+        per-feature affine maps (see util.rollout_scale_parameters). Returns the scaled inputs of the next step and the
+        unscaled prediction.
+        """
+
+        def __init__(self, model, step_shape, step_sequence, y_scale=None, y_center=None, gain=None, offset=None,
+                     dtype=None):
+            super(_ScaledRolloutStep, self).__init__()
+            self.model = model
+            self.step_shape = tuple(step_shape)
+            self.step_sequence = step_sequence
+            for name, value in [('y_scale', y_scale), ('y_center', y_center), ('gain', gain), ('offset', offset)]:
+                self.register_buffer(name, None if value is None else torch.as_tensor(value, dtype=dtype))
+
+        def forward(self, x):
+            n_sample = x.shape[0]
+            predicted = self.model(x)
+            result = predicted.reshape((n_sample, -1))
+            if self.y_scale is not None:
+                result = result * self.y_scale
+            if self.y_center is not None:
+                result = result + self.y_center
+            if self.step_sequence:
+                steps = x.reshape((n_sample,) + self.step_shape)
+                predicted = predicted.reshape((n_sample,) + self.step_shape)
+                x_next = torch.cat((steps[:, 1:], predicted[:, :1]), dim=1)
+            else:
+                x_next = predicted
+            x_next = x_next.reshape((n_sample, -1))
+            if self.gain is not None:
+                x_next = x_next * self.gain
+            if self.offset is not None:
+                x_next = x_next + self.offset
+            return x_next.reshape(x.shape), result.reshape((n_sample,) + self.step_shape)
+
 except ImportError:
     warnings.warn('DLWPTorchNN is not available because PyTorch is not installed.')
 
@@ -59,6 +96,7 @@ class DLWPTorchNN(object):
         self.impute = impute_missing
         self.imputer = None
         self.imputer_y = None
+        self._impute_scale_parameters = None
 
         if scaler_type is None:
             self._is_init_fit = True
@@ -168,6 +206,7 @@ class DLWPTorchNN(object):
         return a
 
     def scaler_fit(self, X, y, **kwargs):
+        self._impute_scale_parameters = None
         if self.scaler_type is not None:
             scaler_class = util.get_from_class('sklearn.preprocessing', self.scaler_type)
             self.scaler = scaler_class(**kwargs)
@@ -198,6 +237,7 @@ class DLWPTorchNN(object):
             return X_transform.reshape(X_shape)
 
     def imputer_fit(self, X, y):
+        self._impute_scale_parameters = None
         imputer_class = util.get_from_class('sklearn.preprocessing', 'Imputer')
         self.imputer = imputer_class(missing_values=np.nan, strategy="mean", axis=0, copy=False)
         self.imputer_y = imputer_class(missing_values=np.nan, strategy="mean", axis=0, copy=False)
@@ -217,6 +257,17 @@ class DLWPTorchNN(object):
         else:
             return X_transform.reshape(X_shape)
 
+    def impute_scale_transform(self, X, y=None):
+        """
+        Apply the Imputer (if imputing) and the Scaler to the predictors, and optionally the targets, in place. See
+        util.impute_scale_transform.
+
+        :param X: ndarray: predictor data; may be overwritten
+        :param y: ndarray: target data; may be overwritten
+        :return: X[, y]: transformed arrays
+        """
+        return util.impute_scale_transform(self, X, y)
+
     def init_fit(self, predictors, targets):
         """
         Initialize the Imputer and Scaler of the model manually. This is useful for fitting the data pre-processors
@@ -231,6 +282,18 @@ class DLWPTorchNN(object):
         self.scaler_fit(predictors, targets)
         self._is_init_fit = True
 
+    def init_fit_generator(self, data, batch_size=32):
+        """
+        Initialize the Imputer and Scaler of the model from data which are too large to fit in memory, reading one
+        batch at a time. The fitted pre-processors are the same as from init_fit on all of the data. StandardScaler
+        and the Imputer need only one pass over the data; other scalers must support partial_fit.
+
+        :param data: a DLWP data generator (batches are generated without scaling), or an xarray Dataset with a
+            'predictors' variable and, unless the targets are the predictors, a 'targets' variable
+        :param batch_size: int: number of samples to read at a time from a Dataset
+        """
+        util.streaming_init_fit(self, data, batch_size=batch_size)
+
     def fit_generator(self, generator, epochs=1, min_epochs=None, validation_generator=None,
                       early_stop=None, lr_schedule=None, verbose=0):
         self.history['loss'] = []
@@ -264,6 +327,9 @@ class DLWPTorchNN(object):
                 if verbose > 1:
                     print('%d/%d loss: %0.4f - error: %0.4f' %
                           (b + 1, n_d, running_loss, running_error), end='\r')
+            # Let the generator re-shuffle (and discard any prefetched batches) for the next epoch, as Keras does
+            if hasattr(generator, 'on_epoch_end'):
+                generator.on_epoch_end()
             # Calculate and print metrics
             print_line = ''
             self.history['loss'].append(running_loss)
@@ -298,28 +364,96 @@ class DLWPTorchNN(object):
             print('')
         return self.history
 
-    def predict(self, predictors):
+    @staticmethod
+    def set_num_threads(num_threads=None, num_interop_threads=None):
         """
-        Make a prediction with the DLWPTorchNN model. Also performs input feature scaling.
+        Set the number of CPU threads used by torch. The number of inter-op threads may only be set before torch runs
+        any parallel work; otherwise a warning is issued and it is unchanged.
 
-        :param predictors: ndarray: predictor data
-        :return: ndarray: model prediction
+        :param num_threads: int: number of threads for intra-op parallelism, e.g., within a matrix product. If None,
+            unchanged.
+        :param num_interop_threads: int: number of threads for inter-op parallelism. If None, unchanged.
         """
+        if num_threads is not None:
+            torch.set_num_threads(int(num_threads))
+        if num_interop_threads is not None:
+            try:
+                torch.set_num_interop_threads(int(num_interop_threads))
+            except RuntimeError as e:
+                warnings.warn("unable to set the number of inter-op threads ('%s')" % str(e))
+
+    def _predict_batch(self, predictors):
         if self.impute:
             predictors = self.imputer_transform(predictors)
         p = self.scaler_transform(predictors)
-        all_p = []
         with torch.no_grad():
             p = torch.tensor(p).to(device)
             predicted = self.model(p).cpu().numpy()
-            all_p.append(predicted)
-        all_p = np.array(all_p).reshape((-1,) + predicted.shape[1:])
         if self.scale_targets and self.scaler_type is not None:
-            return self.scaler_y.inverse_transform(all_p)
+            return self.scaler_y.inverse_transform(predicted)
         else:
-            return all_p
+            return predicted
+
+    def predict_batches(self, predictors, batch_size=32, num_threads=None):
+        """
+        Iterate over the predictions of the DLWPTorchNN model for consecutive batches of samples. Also performs input
+        feature scaling. Only one batch of predictors is read at a time, so predictors may be, e.g., a numpy memmap of
+        data which do not fit in memory.
 
-    def predict_timeseries(self, predictors, time_steps, step_sequence=False, keep_time_dim=False, verbose=0):
+        :param predictors: ndarray: predictor data
+        :param batch_size: int: number of samples per batch
+        :param num_threads: int: if not None, the number of threads torch uses while iterating; the previous number is
+            restored when the iteration ends
+        :return: iterator of ndarray: model predictions for each batch
+        """
+        batch_size = int(batch_size)
+        if batch_size < 1:
+            raise ValueError("'batch_size' must be >= 1")
+        return self._iterate_predictions(predictors, batch_size, num_threads)
+
+    def _iterate_predictions(self, predictors, batch_size, num_threads):
+        # Generator of the predictions for predict_batches, which checks the arguments when it is called
+        previous_threads = None
+        if num_threads is not None:
+            previous_threads = torch.get_num_threads()
+            torch.set_num_threads(int(num_threads))
+        try:
+            for start in range(0, predictors.shape[0], batch_size):
+                yield self._predict_batch(np.asarray(predictors[start:start + batch_size]))
+        finally:
+            if previous_threads is not None:
+                torch.set_num_threads(previous_threads)
+
+    def predict(self, predictors, batch_size=None, num_threads=None):
+        """
+        Make a prediction with the DLWPTorchNN model. Also performs input feature scaling.
+
+        :param predictors: ndarray: predictor data
+        :param batch_size: int: if not None, predict this many samples at a time, so that the memory used by the model
+            does not grow with the number of samples
+        :param num_threads: int: if not None, the number of threads torch uses for this prediction
+        :return: ndarray: model prediction
+        """
+        n_sample = predictors.shape[0]
+        if n_sample == 0:
+            return self._predict_batch(predictors)
+        if batch_size is None:
+            batch_size = n_sample
+        result = None
+        start = 0
+        for predicted in self.predict_batches(predictors, batch_size=batch_size, num_threads=num_threads):
+            if result is None and predicted.shape[0] == n_sample:
+                # All samples in one batch
+                result = predicted
+            else:
+                if result is None:
+                    result = np.empty((n_sample,) + predicted.shape[1:], dtype=predicted.dtype)
+                result[start:start + predicted.shape[0]] = predicted
+            start += predicted.shape[0]
+        return result
+
+    def predict_timeseries(self, predictors, time_steps, step_sequence=False, keep_time_dim=False, chunk_size=None,
+                           out=None, output_steps=None, verbose=0):
         """
         Make a timeseries prediction with the DLWPTorchNN model. Also performs input feature scaling. Forward predict
         time_steps number of time steps, intelligently using the time dimension to run the model time_steps/time_dim
@@ -327,6 +461,11 @@ class DLWPTorchNN(object):
         use only one predicted time step (the other inputs are copied from the previous input) at a time. If the model
         is not recurrent, then it is assumed that the second dimension can be reshaped to (self.time_dim, num_channels).
 
+        The samples are predicted in chunks of chunk_size. With StandardScaler, RobustScaler, or MaxAbsScaler, each
+        chunk is scaled once and moved to the device, and the inputs stay there as scaled tensors for all steps, with
+        the scaling of the predictions done on the device; only the requested output steps are copied back to host
+        memory. Other scalers transform the data on the host at every step.
+
         :param predictors: ndarray: predictor data
         :param time_steps: int: number of time steps to predict forward
         :param step_sequence: bool: if True, takes one step at a time in a time series sequence. That is, if a model
@@ -334,6 +473,11 @@ class DLWPTorchNN(object):
             last prediction as inputs.
         :param keep_time_dim: if True, keep the time_step dimension in the output, otherwise integrates it into the
             forecast_hour (first) dimension
+        :param chunk_size: int: number of samples to predict at a time. If None, predict all samples at once.
+        :param out: ndarray: array, e.g., a numpy memmap, into which to write the prediction. Must have the shape of
+            the returned array. If None, a new float32 array is returned.
+        :param output_steps: iterable of int: indices along the first (time) dimension of the full output to return.
+            If None, return all steps.
         :param verbose: bool or int: print progress
         :return: ndarray: model prediction; first dim is time
         """
@@ -342,38 +486,74 @@ class DLWPTorchNN(object):
             raise ValueError("time_steps must be an int > 0")
         if not step_sequence:
             time_steps = int(np.ceil(1. * time_steps / self.time_dim))
-        time_series = np.full((time_steps,) + predictors.shape, np.nan, dtype=np.float32)
-        p = predictors.copy()
-        sample_dim = p.shape[0]
+        sample_dim = predictors.shape[0]
         if self.is_recurrent:
-            feature_shape = p.shape[2:]
+            feature_shape = predictors.shape[2:]
         else:
-            feature_shape = p.shape[1:]
-        for t in range(time_steps):
-            if verbose:
-                print('Time step %d/%d' % (t+1, time_steps))
-            if step_sequence:
-                pr = self.predict(p)
-                pr_shape = pr.shape[:]
-                if not self.is_recurrent:
-                    pr = pr.reshape((sample_dim, self.time_dim, -1) + feature_shape[1:])
-                    p = p.reshape((sample_dim, self.time_dim, -1) + feature_shape[1:])
-                p = np.concatenate((p[:, 1:], pr[:, [0]]), axis=1)
-                if not self.is_recurrent:
-                    p = p.reshape(predictors.shape)
-                    pr = pr.reshape(pr_shape)
-                time_series[t, ...] = 1. * pr  # step, sample, [time_step,] (features,)
-            else:
-                p = 1. * self.predict(p)
-                time_series[t, ...] = 1. * p  # step, sample, [time_step,] (features,)
-        time_series = time_series.reshape((time_steps, sample_dim, self.time_dim, -1) + feature_shape[1:])
-        if not keep_time_dim:
-            if step_sequence:
-                time_series = time_series[:, :, 0]
-            else:
-                time_series = time_series.transpose((0, 2, 1) + tuple(range(3, 3 + len(feature_shape))))
-                time_series = time_series.reshape((time_steps * self.time_dim, sample_dim, -1) + feature_shape[1:])
-        return time_series
+            feature_shape = predictors.shape[1:]
+        # Shape of a sample with a separate time step dimension
+        step_shape = predictors[:1].reshape((1, self.time_dim, -1) + feature_shape[1:]).shape[1:]
+
+        # Model step and time step of the prediction for each output time index
+        if keep_time_dim:
+            out_shape = step_shape
+            out_times = [(t, None) for t in range(time_steps)]
+        elif step_sequence:
+            out_shape = step_shape[1:]
+            out_times = [(t, 0) for t in range(time_steps)]
+        else:
+            out_shape = step_shape[1:]
+            out_times = [(t, k) for t in range(time_steps) for k in range(self.time_dim)]
+        if output_steps is not None:
+            try:
+                out_times = [out_times[i] for i in output_steps]
+            except IndexError:
+                raise ValueError("'output_steps' must be indices less than %d" % len(out_times))
+        out_shape = (len(out_times), sample_dim) + out_shape
+        if out is None:
+            out = np.full(out_shape, np.nan, dtype=np.float32)
+        elif tuple(out.shape) != out_shape:
+            raise ValueError("shape of 'out' %s does not match the prediction shape %s" % (tuple(out.shape), out_shape))
+        out_index = [[] for t in range(time_steps)]
+        for i, (t, k) in enumerate(out_times):
+            out_index[t].append((i, k))
+        last_step = max(t for t, k in out_times) + 1 if len(out_times) > 0 else 0
+        chunk_size = sample_dim if chunk_size is None else int(chunk_size)
+        if chunk_size < 1:
+            raise ValueError("'chunk_size' must be >= 1")
+        scale_parameters = util.rollout_scale_parameters(self, int(np.prod(predictors.shape[1:])),
+                                                         step_sequence=step_sequence)
+
+        for start in range(0, sample_dim, chunk_size):
+            chunk = slice(start, min(start + chunk_size, sample_dim))
+            p = np.array(predictors[chunk])
+            if not np.issubdtype(p.dtype, np.floating):
+                p = p.astype(np.float32)
+            n_sample = p.shape[0]
+            if scale_parameters is not None:
+                p = torch.as_tensor(self.impute_scale_transform(p)).to(device)
+                rollout_step = _ScaledRolloutStep(self.model, step_shape, step_sequence, *scale_parameters,
+                                                  dtype=p.dtype).to(device)
+            with torch.no_grad():
+                for t in range(last_step):
+                    if verbose:
+                        print('Time step %d/%d' % (t + 1, time_steps))
+                    if scale_parameters is None:
+                        result = self.predict(p).reshape((n_sample,) + step_shape)
+                        if step_sequence:
+                            p_steps = p.reshape((n_sample,) + step_shape)
+                            p = np.concatenate((p_steps[:, 1:], result[:, :1]), axis=1).reshape(p.shape)
+                        else:
+                            p = result.reshape(p.shape)
+                    else:
+                        p, result = rollout_step(p)
+                    if len(out_index[t]) > 0:
+                        positions, slots = zip(*out_index[t])
+                        selected = result[:, None] if keep_time_dim else result[:, list(slots)]
+                        if scale_parameters is not None:
+                            selected = selected.cpu().numpy()
+                        out[list(positions), chunk] = selected.swapaxes(0, 1)
+        return out
 
     def _error(self, x, y):
         return self.metric(x, y).item()
@@ -11,9 +11,12 @@ Tools for pre-processing model input data into training/validation/testing data.
 import numpy as np
 import netCDF4 as nc
 import xarray as xr
+from xarray.backends.locks import HDF5_LOCK
 import os
+import time
 import warnings
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 # netCDF fill value
 fill_value = np.array(nc.default_fillvals['f4']).astype(np.float32)
@@ -61,8 +64,8 @@ class Preprocessor(object):
         return (int(np.prod(self.data.predictors.shape[1:-2])),) + self.data.predictors.shape[-2:]
 
     def data_to_samples(self, time_step=1, batch_samples=100, variables='all', levels='all',
-                        pairwise=False, scale_variables=False, chunk_size=64, in_memory=False, to_zarr=False,
-                        overwrite=False, verbose=False):
+                        pairwise=False, scale_variables=False, chunk_size=64, chunk_layout=None, in_memory=False,
+                        to_zarr=False, overwrite=False, workers=4, verbose=False):
         """
         Convert the data referenced by the data_obj in __init__ to samples ready for ingestion in a DLWP model. Write
         samples in batches of size batch_samples. The parameter scale_variables determines whether individual
@@ -76,11 +79,14 @@ class Preprocessor(object):
             variable-level pairing specified here. The lists of variables and levels must be the same length.
         :param scale_variables: bool: if True, apply de-mean and scaling on a variable/level basis
         :param chunk_size: int: size of the chunks in the sample (time) dimension)
+        :param chunk_layout: str: if not None, choose the chunk shape and compression of the output for the way it will
+            be read: 'training', 'verification', or 'timeseries' (see layout_chunks)
         :param in_memory: bool: if True, speeds up operations by performing them in memory (may require lots of RAM)
         :param to_zarr: bool: if True, writes the resulting data structure to a zarr group in addition to the netCDF
             file. Zarr groups use efficient compression and may be significantly faster in training than netCDF files,
             and can be read just like netCDF with xarray.
         :param overwrite: bool: if True, overwrites any existing output files, otherwise, raises an error
+        :param workers: int: number of threads used to read batches of data when computing the scaling parameters
         :param verbose: bool: print progress statements
         :return: opens Dataset on self.data
         """
@@ -152,6 +158,14 @@ class Preprocessor(object):
             means = np.zeros((n_var, n_level), dtype=np.float32)
             stds = np.ones((n_var, n_level), dtype=np.float32)
 
+        # Dimensions and chunks of predictors and targets
+        if pairwise:
+            dims = ('sample', 'time_step', 'varlev', 'lat', 'lon')
+        else:
+            dims = ('sample', 'time_step', 'variable', 'level', 'lat', 'lon')
+        chunks, compression = layout_chunks(chunk_layout, (n_sample, time_step) + means.shape + (n_lat, n_lon),
+                                            chunk_size)
+
         # Sort into predictors and targets. If in_memory is false, write to netCDF.
         if not in_memory:
             if os.path.isfile(self._predictor_file) and not overwrite:
@@ -219,19 +233,13 @@ class Preprocessor(object):
             nc_fid.variables['sample'][:] = nc.date2num(times, time_units)
 
             # Create predictors and targets variables
-            if pairwise:
-                dims = ('sample', 'time_step', 'varlev', 'lat', 'lon')
-                chunks = (chunk_size, 1, 1, n_lat, n_lon)
-            else:
-                dims = ('sample', 'time_step', 'variable', 'level', 'lat', 'lon')
-                chunks = (chunk_size, 1, 1, 1, n_lat, n_lon)
-            predictors = nc_fid.createVariable('predictors', np.float32, dims, chunksizes=chunks)
+            predictors = nc_fid.createVariable('predictors', np.float32, dims, chunksizes=chunks, **compression)
             predictors.setncatts({
                 'long_name': 'Predictors',
                 'units': 'N/A',
                 '_FillValue': fill_value
             })
-            targets = nc_fid.createVariable('targets', np.float32, dims, chunksizes=chunks)
+            targets = nc_fid.createVariable('targets', np.float32, dims, chunksizes=chunks, **compression)
             targets.setncatts({
                 'long_name': 'Targets',
                 'units': 'N/A',
@@ -251,21 +259,62 @@ class Preprocessor(object):
 
         # Fill in the data. Go through time steps. Iterate by variable and level for scaling.
         if pairwise:
-            for vl, vl_name in enumerate(var_lev):
-                sel_kw = {} if (variables[vl] in var_no_lev) else {'level': levels[vl]}
+            if scale_variables:
                 if verbose:
-                    print('Preprocessor.data_to_samples: variable/level pair %s of %s (%s)' %
-                          (vl + 1, len(var_lev), vl_name))
-                if scale_variables:
-                    if verbose:
-                        print('Preprocessor.data_to_samples: calculating mean and std')
-                    v_mean = mean_by_batch(ds[variables[vl]].sel(**sel_kw), batch_samples)
-                    v_std = std_by_batch(ds[variables[vl]].sel(**sel_kw), batch_samples, mean=v_mean)
-                    means[vl] = 1. * v_mean
-                    stds[vl] = 1. * v_std
-                else:
-                    v_mean = 0.0
-                    v_std = 1.0
+                    print('Preprocessor.data_to_samples: calculating mean and std')
+                v_means, v_stds = mean_std_by_batch([ds[v].sel(**({} if v in var_no_lev else {'level': l}))
+                                                     for v, l in zip(variables, levels)], batch_samples,
+                                                    workers=workers)
+                means[:] = v_means
+                stds[:] = v_stds
+            else:
+                v_means, v_stds = [0.0] * n_var, [1.0] * n_var
+            # Index in the output, DataArray, mean, std, and description of each variable/level
+            fields = [((vl,), ds[variables[vl]].sel(**({} if variables[vl] in var_no_lev else {'level': levels[vl]})),
+                       v_means[vl], v_stds[vl], 'variable/level pair %s of %s (%s)' % (vl + 1, len(var_lev), vl_name))
+                      for vl, vl_name in enumerate(var_lev)]
+        else:
+            if scale_variables:
+                if verbose:
+                    print('Preprocessor.data_to_samples: calculating mean and std')
+                v_means, v_stds = mean_std_by_batch([ds[var].sel(level=lev) for var in variables for lev in levels],
+                                                    batch_samples, workers=workers)
+                v_means = v_means.reshape((n_var, n_level))
+                v_stds = v_stds.reshape((n_var, n_level))
+                means[:] = v_means
+                stds[:] = v_stds
+            else:
+                v_means, v_stds = np.zeros((n_var, n_level)), np.ones((n_var, n_level))
+            fields = [((v, l), ds[var].sel(level=lev), v_means[v, l], v_stds[v, l],
+                       'variable %s of %s (%s); level %s of %s (%s)' %
+                       (v + 1, len(variables), var, l + 1, len(levels), lev))
+                      for v, var in enumerate(variables) for l, lev in enumerate(levels)]
+
+        if not in_memory and chunk_layout in ['training', 'timeseries']:
+            # The compressed chunks of these layouts span every time step and variable/level ('training') or many
+            # batches of samples ('timeseries'), so assemble each chunk-aligned block of samples in memory and write it
+            # in a single assignment, instead of re-compressing every chunk once per time step and variable/level
+            write_samples = chunks[0] * max(1, batch_samples // chunks[0])
+            starts = list(range(0, n_sample, write_samples))
+            for i, s in enumerate(starts):
+                if verbose:
+                    print('Preprocessor.data_to_samples: writing batch %s of %s' % (i + 1, len(starts)))
+                n = min(write_samples, n_sample - s)
+                p_block = np.empty((n,) + tuple(predictors.shape[1:]), dtype=np.float32)
+                t_block = np.empty_like(p_block)
+                for index, da, v_mean, v_std, _ in fields:
+                    for t in range(time_step):
+                        p_block[(slice(None), t) + index] = (da.isel(time=slice(s + t, s + t + n)).values
+                                                             - v_mean) / v_std
+                        t_block[(slice(None), t) + index] = (da.isel(time=slice(s + t + time_step,
+                                                                                s + t + time_step + n)).values
+                                                             - v_mean) / v_std
+                predictors[s:s + n] = p_block
+                targets[s:s + n] = t_block
+        else:
+            for index, da, v_mean, v_std, description in fields:
+                if verbose:
+                    print('Preprocessor.data_to_samples: %s' % description)
                 for i, s in enumerate(list(range(0, n_sample, batch_samples))):
                     if verbose:
                         print('Preprocessor.data_to_samples: writing batch %s of %s'
@@ -275,36 +324,8 @@ class Preprocessor(object):
                         idxp = slice(s + t, min(s + t + batch_samples, n_sample + t))
                         idxt = slice(s + t + time_step,
                                      min(s + t + time_step + batch_samples, n_sample + t + time_step))
-                        predictors[idx, t, vl, ...] = (ds[variables[vl]].isel(time=idxp).sel(**sel_kw).values
-                                                       - v_mean) / v_std
-                        targets[idx, t, vl, ...] = (ds[variables[vl]].isel(time=idxt).sel(**sel_kw).values
-                                                    - v_mean) / v_std
-        else:
-            for v, var in enumerate(variables):
-                for l, lev in enumerate(levels):
-                    if verbose:
-                        print('Preprocessor.data_to_samples: variable %s of %s (%s); level %s of %s (%s)' %
-                              (v+1, len(variables), var, l+1, len(levels), lev))
-                    if scale_variables:
-                        if verbose:
-                            print('Preprocessor.data_to_samples: calculating mean and std')
-                        v_mean = mean_by_batch(ds[var].sel(level=lev), batch_samples)
-                        v_std = std_by_batch(ds[var].sel(level=lev), batch_samples, mean=v_mean)
-                        means[v, l] = 1. * v_mean
-                        stds[v, l] = 1. * v_std
-                    else:
-                        v_mean = 0.0
-                        v_std = 1.0
-                    for i, s in enumerate(list(range(0, n_sample, batch_samples))):
-                        if verbose:
-                            print('Preprocessor.data_to_samples: writing batch %s of %s'
-                                  % (i+1, n_sample//batch_samples+1))
-                        idx = slice(s, min(s+batch_samples, n_sample))
-                        for t in range(time_step):
-                            idxp = slice(s+t, min(s+t+batch_samples, n_sample+t))
-                            idxt = slice(s+t+time_step, min(s+t+time_step+batch_samples, n_sample+t+time_step))
-                            predictors[idx, t, v, l, ...] = (ds[var].isel(time=idxp, level=l).values - v_mean) / v_std
-                            targets[idx, t, v, l, ...] = (ds[var].isel(time=idxt, level=l).values - v_mean) / v_std
+                        predictors[(idx, t) + index] = (da.isel(time=idxp).values - v_mean) / v_std
+                        targets[(idx, t) + index] = (da.isel(time=idxt).values - v_mean) / v_std
 
         if not in_memory:
             # Create means and stds variables
@@ -425,7 +446,10 @@ class Preprocessor(object):
             if verbose:
                 print('Preprocessor.data_to_samples: writing to zarr group %s...' % zarr_file)
             try:
-                result_ds.to_zarr(zarr_file, mode='w' if overwrite else 'w-')
+                if chunk_layout is not None:
+                    result_ds = result_ds.chunk(dict(zip(dims, chunks)))
+                result_ds.to_zarr(zarr_file, mode='w' if overwrite else 'w-',
+                                  encoding={v: _zarr_encoding(compression) for v in ('predictors', 'targets')})
                 success = True
             except AttributeError:
                 warnings.warn("xarray version must be >= 0.12.0 (got %s) to export to zarr; falling back to netCDF"
@@ -440,7 +464,8 @@ class Preprocessor(object):
         self.data = result_ds
 
     def data_to_series(self, batch_samples=100, variables='all', levels='all', pairwise=False, scale_variables=False,
-                       chunk_size=64, in_memory=False, to_zarr=False, overwrite=False, verbose=False):
+                       chunk_size=64, chunk_layout=None, in_memory=False, to_zarr=False, overwrite=False, append=False,
+                       derived=None, workers=4, verbose=False):
         """
         Convert the data referenced by the data_obj in __init__ to a continuous time series of formatted data. This
         series of data is appropriate for use in a SeriesDataGenerator object during model training. Write data
@@ -448,18 +473,31 @@ class Preprocessor(object):
         scale_variables determines whether individual variable/level combinations are scaled and de-meaned by their
         spatially-averaged values.
 
-        :param batch_samples: int: number of samples in the time dimension to read and process at once
+        :param batch_samples: int: number of samples in the time dimension to read and process at once; rounded to a
+            multiple of the chunk size in the sample dimension so that whole chunks are written at once
         :param variables: iter: list of variables to process; may be 'all' for all variables available
         :param levels: iter: list of integer pressure levels (mb); may be 'all'
         :param pairwise: bool: if True, creates a Dataset with one less dimension and creates a variable at each
             variable-level pairing specified here. The lists of variables and levels must be the same length.
         :param scale_variables: bool: if True, apply de-mean and scaling on a variable/level basis
         :param chunk_size: int: size of the chunks in the sample (time) dimension)
+        :param chunk_layout: str: if not None, choose the chunk shape and compression of the output for the way it will
+            be read: 'training', 'verification', or 'timeseries' (see layout_chunks)
         :param in_memory: bool: if True, speeds up operations by performing them in memory (may require lots of RAM)
         :param to_zarr: bool: if True, writes the resulting data structure to a zarr group in addition to the netCDF
             file. Zarr groups use efficient compression and may be significantly faster in training than netCDF files,
             and can be read just like netCDF with xarray.
         :param overwrite: bool: if True, overwrites any existing output files, otherwise, raises an error
+        :param append: bool: if True, append the samples of the data_obj later than the last sample in the existing
+            predictor file (and zarr group, if to_zarr) instead of creating new files. The new samples are normalized
+            with the mean and std already in the file, and the running statistics in the file are updated; call
+            renormalize() to use them.
+        :param derived: dict: variable/level pairs derived from others, added after the pairs given by variables and
+            levels, as {name: (function, [input variable/level pairs])}. The function takes the unscaled input arrays
+            for a batch of samples and returns the derived array; it is applied as the data are read, so derived
+            variables are scaled and written in the same passes over the data. Requires pairwise. For example,
+            {'THICK/300-700': (np.subtract, ['HGT/300', 'HGT/700'])}.
+        :param workers: int: number of threads used to read and normalize batches of data
         :param verbose: bool: print progress statements
         :return: opens Dataset on self.data
         """
@@ -502,6 +540,11 @@ class Preprocessor(object):
             if len(variables) != len(levels):
                 raise ValueError('for pairwise variable/level pairs, len(variables) must equal len(levels)')
             var_lev = ['/'.join([v, str(l)]) for v, l in zip(variables, levels)]
+        derived = derived or {}
+        if len(derived) > 0:
+            if not pairwise:
+                raise ValueError('derived variables require pairwise variable/level pairs')
+            var_lev = var_lev + list(derived.keys())
 
         # Get the exact dataset we want (index times, variables, and levels)
         all_dates = self.raw_data.dataset_dates
@@ -515,11 +558,32 @@ class Preprocessor(object):
         for v in vars_available:
             if v not in variables:
                 ds = ds.drop(v)
-        n_sample, n_var, n_level, n_lat, n_lon = (len(all_dates), len(variables), len(levels),
+        n_sample, n_var, n_level, n_lat, n_lon = (len(all_dates), len(var_lev) if pairwise else len(variables),
+                                                  len(levels),
                                                   ds.dims['lat'], ds.dims['lon'])
         if n_sample < 1:
             raise ValueError('too many time steps for time dimension')
 
+        # Select each variable/level in the order of the output array
+        if pairwise:
+            arrays = [ds[v].sel(**({} if v in var_no_lev else {'level': l})) for v, l in zip(variables, levels)]
+        else:
+            arrays = [ds[var].sel(level=lev) for var in variables for lev in levels]
+        for function, inputs in derived.values():
+            arrays.append(DerivedArray(function, [self._varlev_array(vl, all_dates) for vl in inputs]))
+
+        if append:
+            if in_memory:
+                raise ValueError("cannot append to predictors in memory")
+            files = [] if self._predictor_file.endswith('.zarr') else [self._predictor_file]
+            if to_zarr or self._predictor_file.endswith('.zarr'):
+                files.append('.'.join(self._predictor_file.split('.')[:-1]) + '.zarr')
+            self._append_series(files, ds['time'].values, arrays, var_lev if pairwise else (variables, levels),
+                                batch_samples, chunk_size, workers, verbose)
+            self._predictor_file = files[-1]
+            self.open()
+            return
+
         # Arrays for scaling parameters
         if pairwise:
             means = np.zeros((n_var,), dtype=np.float32)
@@ -528,6 +592,13 @@ class Preprocessor(object):
             means = np.zeros((n_var, n_level), dtype=np.float32)
             stds = np.ones((n_var, n_level), dtype=np.float32)
 
+        # Dimensions and chunks of the predictors
+        if pairwise:
+            dims = ('sample', 'varlev', 'lat', 'lon')
+        else:
+            dims = ('sample', 'variable', 'level', 'lat', 'lon')
+        chunks, compression = layout_chunks(chunk_layout, (n_sample,) + means.shape + (n_lat, n_lon), chunk_size)
+
         # Sort into predictors and targets. If in_memory is false, write to netCDF.
         if not in_memory:
             if os.path.isfile(self._predictor_file) and not overwrite:
@@ -594,13 +665,7 @@ class Preprocessor(object):
             nc_fid.variables['sample'][:] = nc.date2num(times, time_units)
 
             # Create predictors and targets variables
-            if pairwise:
-                dims = ('sample', 'varlev', 'lat', 'lon')
-                chunks = (chunk_size, 1, n_lat, n_lon)
-            else:
-                dims = ('sample', 'variable', 'level', 'lat', 'lon')
-                chunks = (chunk_size, 1, 1, n_lat, n_lon)
-            predictors = nc_fid.createVariable('predictors', np.float32, dims, chunksizes=chunks)
+            predictors = nc_fid.createVariable('predictors', np.float32, dims, chunksizes=chunks, **compression)
             predictors.setncatts({
                 'long_name': 'Predictors',
                 'units': 'N/A',
@@ -617,51 +682,77 @@ class Preprocessor(object):
             else:
                 predictors = np.full((n_sample, n_var, n_level, n_lat, n_lon), np.nan, dtype=np.float32)
 
-        # Fill in the data. Go through time steps. Iterate by variable and level for scaling.
-        if pairwise:
-            for vl, vl_name in enumerate(var_lev):
-                sel_kw = {} if (variables[vl] in var_no_lev) else {'level': levels[vl]}
-                if verbose:
-                    print('Preprocessor.data_to_samples: variable/level pair %s of %s (%s)' %
-                          (vl + 1, len(var_lev), vl_name))
-                if scale_variables:
-                    if verbose:
-                        print('Preprocessor.data_to_samples: calculating mean and std')
-                    v_mean = mean_by_batch(ds[variables[vl]].sel(**sel_kw), batch_samples)
-                    v_std = std_by_batch(ds[variables[vl]].sel(**sel_kw), batch_samples, mean=v_mean)
-                    means[vl] = 1. * v_mean
-                    stds[vl] = 1. * v_std
-                else:
-                    v_mean = 0.0
-                    v_std = 1.0
-                for i, s in enumerate(list(range(0, n_sample, batch_samples))):
-                    if verbose:
-                        print('Preprocessor.data_to_samples: writing batch %s of %s'
-                              % (i + 1, n_sample // batch_samples + 1))
-                    idx = slice(s, min(s + batch_samples, n_sample))
-                    predictors[idx, vl, ...] = (ds[variables[vl]].isel(time=idx).sel(**sel_kw).values - v_mean) / v_std
+        # Scaling parameters, and the running statistics needed to append data later
+        moments = {}
+        if scale_variables:
+            if verbose:
+                print('Preprocessor.data_to_series: calculating mean and std')
+            v_counts, v_means, v_m2 = moments_by_batch(arrays, batch_samples, workers=workers)
+            v_stds = np.sqrt(v_m2 / v_counts)
+            means[:] = v_means.reshape(means.shape)
+            stds[:] = v_stds.reshape(stds.shape)
+            moments = _moment_variables(dims[1:-2], v_counts.reshape(means.shape), v_means.reshape(means.shape),
+                                        v_m2.reshape(means.shape))
         else:
-            for v, var in enumerate(variables):
-                for l, lev in enumerate(levels):
-                    if verbose:
-                        print('Preprocessor.data_to_samples: variable %s of %s (%s); level %s of %s (%s)' %
-                              (v+1, len(variables), var, l+1, len(levels), lev))
-                    if scale_variables:
-                        if verbose:
-                            print('Preprocessor.data_to_samples: calculating mean and std')
-                        v_mean = mean_by_batch(ds[var].sel(level=lev), batch_samples)
-                        v_std = std_by_batch(ds[var].sel(level=lev), batch_samples, mean=v_mean)
-                        means[v, l] = 1. * v_mean
-                        stds[v, l] = 1. * v_std
-                    else:
-                        v_mean = 0.0
-                        v_std = 1.0
-                    for i, s in enumerate(list(range(0, n_sample, batch_samples))):
-                        if verbose:
-                            print('Preprocessor.data_to_samples: writing batch %s of %s'
-                                  % (i+1, n_sample//batch_samples+1))
-                        idx = slice(s, min(s+batch_samples, n_sample))
-                        predictors[idx, v, l, ...] = (ds[var].isel(time=idx, level=l).values - v_mean) / v_std
+            v_means, v_stds = np.zeros(len(arrays)), np.ones(len(arrays))
+
+        # Create the zarr group, with the predictors to be filled in below
+        targets = [predictors]
+        if to_zarr:
+            import dask.array
+            import zarr
+            zarr_file = '.'.join(self._predictor_file.split('.')[:-1]) + '.zarr'
+            if os.path.exists(zarr_file) and not overwrite:
+                raise IOError('zarr group path %s exists' % zarr_file)
+            if verbose:
+                print('Preprocessor.data_to_series: creating zarr group %s' % zarr_file)
+            template = xr.Dataset({
+                'predictors': (dims, dask.array.full((n_sample,) + means.shape + (n_lat, n_lon), np.nan,
+                                                     dtype=np.float32,
+                                                     chunks=chunks if chunk_layout is not None else
+                                                     (chunk_size,) + means.shape + (n_lat, n_lon)), {
+                    'long_name': 'Predictors',
+                    'units': 'N/A'
+                }),
+                'mean': (dims[1:-2], means, {
+                    'long_name': 'Global mean of variables at levels',
+                    'units': 'N/A',
+                }),
+                'std': (dims[1:-2], stds, {
+                    'long_name': 'Global std deviation of variables at levels',
+                    'units': 'N/A',
+                })
+            }, coords=dict({
+                'sample': ('sample', ds['time'].values, {
+                    'long_name': 'Sample start time'
+                }),
+                'lat': ('lat', ds['lat'].values, {
+                    'long_name': 'Latitude',
+                    'units': 'degrees_north'
+                }),
+                'lon': ('lon', ds['lon'].values, {
+                    'long_name': 'Longitude',
+                    'units': 'degrees_east'
+                }),
+            }, **({'varlev': ('varlev', var_lev)} if pairwise else {
+                'variable': ('variable', variables),
+                'level': ('level', levels, {
+                    'long_name': 'Pressure level',
+                    'units': 'hPa'
+                })
+            })), attrs={
+                'description': 'Training data for DLWP',
+                'scaling': 'True' if scale_variables else 'False',
+                'pairwise': 'True' if pairwise else 'False'
+            })
+            template = template.assign(**moments)
+            template.to_zarr(zarr_file, mode='w' if overwrite else 'w-', compute=False,
+                             encoding={'predictors': _zarr_encoding(compression)})
+            targets.append(zarr.open_group(zarr_file, mode='r+')['predictors'])
+
+        # Fill in the data, a block of whole chunks at a time
+        block_size = max(1, int(round(batch_samples / chunks[0]))) * chunks[0]
+        write_blocks(targets, arrays, v_means, v_stds, block_size, workers=workers, verbose=verbose)
 
         if not in_memory:
             # Create means and stds variables
@@ -694,6 +785,12 @@ class Preprocessor(object):
                 })
                 nc_var[:] = stds
 
+            # Running statistics
+            for name, (m_dims, values, attrs) in moments.items():
+                nc_var = nc_fid.createVariable(name, values.dtype, m_dims)
+                nc_var.setncatts(attrs)
+                nc_var[:] = values
+
             # Close and re-open as xarray Dataset
             nc_fid.close()
             result_ds = xr.open_dataset(self._predictor_file)
@@ -766,31 +863,256 @@ class Preprocessor(object):
                     'scaling': 'True' if scale_variables else 'False',
                     'pairwise': 'False'
                 })
+            result_ds = result_ds.assign(**moments)
 
         result_ds = result_ds.chunk({'sample': chunk_size})
 
         if to_zarr:
-            zarr_file = '.'.join(self._predictor_file.split('.')[:-1]) + '.zarr'
-            if verbose:
-                print('Preprocessor.data_to_samples: writing to zarr group %s...' % zarr_file)
-            try:
-                result_ds.to_zarr(zarr_file, mode='w' if overwrite else 'w-')
-                success = True
-            except AttributeError:
-                warnings.warn("xarray version must be >= 0.12.0 (got %s) to export to zarr; falling back to netCDF"
-                              % xr.__version__)
-                success = False
-            except ValueError:
-                raise IOError('zarr group path %s exists' % zarr_file)
-            if success:
-                self._predictor_file = zarr_file
-                result_ds = xr.open_zarr(zarr_file)
+            self._predictor_file = zarr_file
+            result_ds = xr.open_zarr(zarr_file)
 
         self.data = result_ds
 
+    def _varlev_array(self, var_lev, dates):
+        """
+        Select a variable/level pair, given as 'VAR/level', from the raw data.
+
+        :param var_lev: str: variable/level pair
+        :param dates: list of dates to select
+        :return: xarray DataArray
+        """
+        var, lev = var_lev.rsplit('/', 1)
+        if var not in self.raw_data.Dataset.data_vars:
+            raise ValueError("variable '%s' is not in the raw data" % var)
+        da = self.raw_data.Dataset[var].sel(time=dates)
+        if 'level' in da.dims:
+            da = da.sel(level=float(lev))
+        return da
+
+    def _append_series(self, files, times, arrays, names, batch_samples, chunk_size, workers, verbose):
+        """
+        Append the samples of arrays later than the last sample in each of the series files.
+
+        :param files: list of str: netCDF files and/or zarr groups written by data_to_series
+        :param times: ndarray: datetime64 times of arrays
+        :param arrays: list of DataArrays: each variable/level of the series
+        :param names: list of varlev names, or tuple of (variables, levels)
+        """
+        first = files[0]
+        existing = xr.open_zarr(first) if first.endswith('.zarr') else xr.open_dataset(first)
+        if isinstance(names, tuple):
+            match = (list(existing['variable'].values) == list(names[0]) and
+                     np.allclose(existing['level'].values, np.array(names[1], dtype=np.float32)))
+        else:
+            match = 'varlev' in existing.dims and list(existing['varlev'].values) == list(names)
+        if not match:
+            existing.close()
+            raise ValueError("variables and levels do not match those in '%s'" % first)
+        n_old = existing.dims['sample']
+        new = times > existing['sample'].values[-1]
+        means = existing['mean'].values.ravel().astype(np.float64)
+        stds = existing['std'].values.ravel().astype(np.float64)
+        old_moments = None
+        if all(name in existing.variables for name in _moment_names):
+            old_moments = [existing[name].values for name in _moment_names]
+        existing.close()
+        if not np.any(new):
+            warnings.warn("no samples later than those in '%s' to append" % first)
+            return
+        first_new = int(np.argmax(new))
+        times = times[first_new:]
+        arrays = [a.isel(time=slice(first_new, None)) for a in arrays]
+        if verbose:
+            print('Preprocessor.data_to_series: appending %d samples to %d existing samples' % (len(times), n_old))
+
+        # Extend the sample dimension of each output
+        targets = []
+        handles = []
+        for file in files:
+            if file.endswith('.zarr'):
+                import zarr
+                # The consolidated metadata would keep the old shapes of the arrays after resizing; it is rewritten
+                # once the append is done
+                group = _open_zarr_group(file)
+                sample = group['sample']
+                sample.resize((n_old + len(times),))
+                sample[n_old:] = _encode_times(times, sample.attrs['units'], sample.attrs.get('calendar', 'standard'),
+                                               sample.dtype)
+                predictors = group['predictors']
+                predictors.resize((n_old + len(times),) + predictors.shape[1:])
+                targets.append(predictors)
+                handles.append(group)
+            else:
+                nc_fid = nc.Dataset(file, 'a')
+                nc_fid.variables['sample'][n_old:] = _encode_times(times, nc_fid.variables['sample'].units,
+                                                                   'standard', nc_fid.variables['sample'].dtype)
+                targets.append(nc_fid.variables['predictors'])
+                handles.append(nc_fid)
+
+        try:
+            if files[0].endswith('.zarr'):
+                sample_chunk = targets[0].chunks[0]
+            else:
+                sample_chunk = targets[0].chunking()
+                sample_chunk = chunk_size if sample_chunk == 'contiguous' else sample_chunk[0]
+            block_size = max(1, int(round(batch_samples / sample_chunk))) * sample_chunk
+            block_moments = write_blocks(targets, arrays, means, stds, block_size, workers=workers, verbose=verbose,
+                                         offset=n_old, moments=old_moments is not None)
+
+            # Update the running statistics with those of the new data, taken as the data were written
+            if old_moments is not None:
+                shape = old_moments[0].shape
+                new_moments = combine_moments([m.ravel() for m in old_moments], block_moments)
+                for handle in handles:
+                    for name, values in zip(_moment_names, new_moments):
+                        handle[name][:] = values.reshape(shape)
+        finally:
+            for handle in handles:
+                if isinstance(handle, nc.Dataset):
+                    handle.close()
+        for file in files:
+            if file.endswith('.zarr'):
+                import zarr
+                zarr.consolidate_metadata(file)
+
+    def add_derived(self, derived, batch_samples=100, workers=4, verbose=False):
+        """
+        Add variable/level pairs derived from others to the existing series zarr group at self._predictor_file,
+        without rewriting the variable/level pairs already in it. The varlev dimension of the group is extended and
+        only the new pairs are written, normalized with their own mean and std if the series is scaled. The inputs
+        are read from the series itself, unscaled, or from the data_obj if they are not in the series. The varlev
+        dimension of a netCDF file cannot be extended in place, so netCDF series must be given their derived pairs
+        when they are created with data_to_series(derived=...).
+
+        :param derived: dict: variable/level pairs derived from others, as {name: (function, [input variable/level
+            pairs])}; see data_to_series
+        :param batch_samples: int: number of samples in the time dimension to read and process at once; rounded to a
+            multiple of the chunk size in the sample dimension
+        :param workers: int: number of threads used to read and normalize batches of data
+        :param verbose: bool: print progress statements
+        :return: opens Dataset on self.data
+        """
+        if not self._predictor_file.endswith('.zarr'):
+            raise ValueError("derived variables can only be added to an existing zarr group; the varlev dimension of "
+                             "netCDF file '%s' cannot be extended without rewriting it" % self._predictor_file)
+        if self.data is not None:
+            self.close()
+        ds = xr.open_zarr(self._predictor_file)
+        if 'varlev' not in ds.dims:
+            ds.close()
+            raise ValueError('derived variables require pairwise variable/level pairs')
+        var_lev = [str(v) for v in ds['varlev'].values]
+        duplicates = [name for name in derived.keys() if name in var_lev]
+        if len(duplicates) > 0:
+            ds.close()
+            raise ValueError("variable/level pairs %s are already in '%s'" % (duplicates, self._predictor_file))
+
+        # Derived arrays of unscaled inputs
+        arrays = []
+        for function, inputs in derived.values():
+            input_arrays = []
+            for vl in inputs:
+                if vl in var_lev:
+                    da = ds['predictors'].sel(varlev=vl) * ds['std'].sel(varlev=vl) + ds['mean'].sel(varlev=vl)
+                    input_arrays.append(da.rename({'sample': 'time'}))
+                elif self.raw_data is not None:
+                    input_arrays.append(self._varlev_array(vl, ds['sample'].values))
+                else:
+                    ds.close()
+                    raise ValueError("input '%s' is not in '%s' and no data_obj was supplied at initialization"
+                                     % (vl, self._predictor_file))
+            arrays.append(DerivedArray(function, input_arrays))
+
+        moments = None
+        if ds.attrs.get('scaling', 'False') == 'True':
+            if verbose:
+                print('Preprocessor.add_derived: calculating mean and std')
+            moments = moments_by_batch(arrays, batch_samples, workers=workers)
+            means, stds = moments[1], np.sqrt(moments[2] / moments[0])
+        else:
+            means, stds = np.zeros(len(arrays)), np.ones(len(arrays))
+
+        # Extend the varlev dimension of every array of the group. The new variable/level pairs fall in new chunks, so
+        # the chunks of the existing pairs are not touched.
+        group = _open_zarr_group(self._predictor_file)
+        n_old, n_new = len(var_lev), len(var_lev) + len(arrays)
+        for name, array in list(group.arrays()):
+            dims = list(array.attrs.get('_ARRAY_DIMENSIONS', []))
+            if 'varlev' in dims and name != 'varlev':
+                axis = dims.index('varlev')
+                array.resize(array.shape[:axis] + (n_new,) + array.shape[axis + 1:])
+        # The names are stored as fixed-width strings, so the small coordinate is rewritten
+        attrs = group['varlev'].attrs.asdict()
+        names = np.array(var_lev + list(derived.keys()))
+        group.array('varlev', names, chunks=names.shape, overwrite=True)
+        group['varlev'].attrs.update(attrs)
+        group['mean'][n_old:] = means
+        group['std'][n_old:] = stds
+        if moments is not None and all(name in group for name in _moment_names):
+            for name, values in zip(_moment_names, moments):
+                group[name][n_old:] = values
+        if 'renorm_mean' in group:
+            # New pairs are already normalized with the statistics of all of the samples
+            group['renorm_mean'][n_old:] = means
+            group['renorm_std'][n_old:] = stds
+
+        if verbose:
+            print('Preprocessor.add_derived: writing %d variable/level pairs' % len(arrays))
+        try:
+            predictors = group['predictors']
+            block_size = max(1, int(round(batch_samples / predictors.chunks[0]))) * predictors.chunks[0]
+            write_blocks([_VarlevSlice(predictors, n_old, n_new)], arrays, means, stds, block_size, workers=workers,
+                         verbose=verbose)
+        finally:
+            ds.close()
+        import zarr
+        zarr.consolidate_metadata(self._predictor_file)
+        self.open()
+
+    def renormalize(self):
+        """
+        Change the normalization of the predictors to the mean and standard deviation of all of the data in the
+        predictor file, including any appended samples. Only the small 'renorm_mean' and 'renorm_std' variables are
+        written: the predictors on disk are unchanged, and are remapped lazily whenever the file is opened.
+        """
+        if self.data is not None:
+            self.close()
+        if self._predictor_file.endswith('.zarr'):
+            ds = xr.open_zarr(self._predictor_file)
+        else:
+            ds = xr.open_dataset(self._predictor_file)
+        if not all(name in ds.variables for name in _moment_names):
+            ds.close()
+            raise ValueError("predictor file '%s' has no running statistics to renormalize with; it must be created "
+                             "by data_to_series with scale_variables=True" % self._predictor_file)
+        count, mean, m2 = [ds[name].values for name in _moment_names]
+        renorm = xr.Dataset({
+            'renorm_mean': (ds['mean'].dims, mean.astype(np.float32), {
+                'long_name': 'Global mean of variables at levels after renormalization',
+                'units': 'N/A',
+            }),
+            'renorm_std': (ds['std'].dims, np.sqrt(m2 / count).astype(np.float32), {
+                'long_name': 'Global std deviation of variables at levels after renormalization',
+                'units': 'N/A',
+            })
+        })
+        ds.close()
+        if self._predictor_file.endswith('.zarr'):
+            renorm.to_zarr(self._predictor_file, mode='a')
+        else:
+            nc_fid = nc.Dataset(self._predictor_file, 'a')
+            for name, var in renorm.data_vars.items():
+                if name not in nc_fid.variables:
+                    nc_fid.createVariable(name, np.float32, var.dims)
+                nc_fid.variables[name].setncatts(var.attrs)
+                nc_fid.variables[name][:] = var.values
+            nc_fid.close()
+        self.open()
+
     def open(self, **kwargs):
         """
-        Open the dataset pointed to by the instance's _predictor_file attribute onto self.data
+        Open the dataset pointed to by the instance's _predictor_file attribute onto self.data. If the file has been
+        renormalized, the predictors are remapped lazily to the new mean and std.
 
         :param kwargs: passed to xarray.open_dataset() or xarray.open_zarr()
         """
@@ -798,6 +1120,8 @@ class Preprocessor(object):
             self.data = xr.open_zarr(self._predictor_file, **kwargs)
         else:
             self.data = xr.open_dataset(self._predictor_file, **kwargs)
+        if 'renorm_mean' in self.data.variables:
+            self.data = renormalized(self.data)
 
     def close(self):
         """
@@ -823,6 +1147,293 @@ class Preprocessor(object):
             self.data.to_netcdf(predictor_file)
 
 
+# Target size in bytes of the chunks chosen by layout_chunks, and the largest block of samples written at once
+chunk_bytes = 8 * 2 ** 20
+block_bytes = 2 ** 29
+
+
+def layout_chunks(layout, shape, chunk_size=64, itemsize=4):
+    """
+    Choose the chunk shape and compression of a predictor array for the way it will be read:
+
+    - 'training': batches of consecutive samples with all variables, levels, and time steps, as read by the data
+        generators. Chunks hold every variable/level for up to chunk_size samples, with light compression.
+    - 'verification': individual variable/level maps for blocks of samples. Chunks hold one variable/level for
+        chunk_size samples.
+    - 'timeseries': long time series at individual grid points. Chunks hold one variable/level on a small tile of
+        the grid for as many samples as fit in a block of written data.
+    - None: the chunks of 'verification', without compression, as in earlier versions.
+
+    :param layout: str: access pattern, one of the above
+    :param shape: tuple: shape of the array: (sample, [time_step,] [variable, level | varlev], lat, lon)
+    :param chunk_size: int: number of samples per chunk for the 'training' and 'verification' layouts
+    :param itemsize: int: number of bytes per value
+    :return: tuple, dict: chunk shape; keyword arguments for compression in netCDF4.Dataset.createVariable
+    """
+    n_sample, middle, spatial = shape[0], tuple(shape[1:-2]), tuple(shape[-2:])
+    if layout is None or layout == 'verification':
+        chunks = (chunk_size,) + (1,) * len(middle) + spatial
+    elif layout == 'training':
+        sample_bytes = int(np.prod(shape[1:])) * itemsize
+        chunks = (max(1, min(chunk_size, chunk_bytes // sample_bytes)),) + middle + spatial
+    elif layout == 'timeseries':
+        tile = tuple(min(n, 16) for n in spatial)
+        samples = min(chunk_bytes // (int(np.prod(tile)) * itemsize),
+                      block_bytes // (int(np.prod(shape[1:])) * itemsize))
+        chunks = (max(1, samples),) + (1,) * len(middle) + tile
+    else:
+        raise ValueError("'layout' must be 'training', 'verification', 'timeseries', or None")
+    chunks = (min(chunks[0], max(1, n_sample)),) + chunks[1:]
+    if layout is None:
+        compression = {}
+    else:
+        compression = {'zlib': True, 'complevel': 1 if layout == 'training' else 4, 'shuffle': True}
+    return chunks, compression
+
+
+def _zarr_encoding(compression):
+    # zarr encoding equivalent to netCDF compression keyword arguments
+    if not compression.get('zlib', False):
+        return {}
+    from numcodecs import Blosc
+    return {'compressor': Blosc(cname='zstd', clevel=compression['complevel'],
+                                shuffle=Blosc.SHUFFLE if compression['shuffle'] else Blosc.NOSHUFFLE)}
+
+
+def benchmark_chunk_layouts(ds, directory, layouts=('training', 'verification', 'timeseries'), n_sample=None,
+                            chunk_size=64, batch_size=32, n_reads=20, verbose=True):
+    """
+    Measure the read throughput of the predictors of a series Dataset written with each chunk layout, for each of
+    the access patterns in layout_chunks. Writes a netCDF file for each layout in directory.
+
+    :param ds: xarray Dataset: series data, e.g., Preprocessor.data after data_to_series
+    :param directory: str: directory for the test files
+    :param layouts: iter: layouts to test
+    :param n_sample: int: number of samples of ds to use; all if None
+    :param chunk_size: int: chunk size passed to layout_chunks
+    :param batch_size: int: number of samples in a training read
+    :param n_reads: int: number of reads timed for each access pattern
+    :param verbose: bool: print the results
+    :return: dict: {layout: {access pattern: read throughput in MB/s}}
+    """
+    predictors = ds['predictors']
+    if n_sample is not None:
+        predictors = predictors.isel(sample=slice(0, n_sample))
+    shape = predictors.shape
+    n_sample = shape[0]
+    middle = int(np.prod(shape[1:-2]))
+    random = np.random.RandomState(0)
+    results = {}
+    for layout in layouts:
+        file_name = os.path.join(directory, 'chunk_benchmark_%s.nc' % layout)
+        chunks, compression = layout_chunks(layout, shape, chunk_size)
+        nc_fid = nc.Dataset(file_name, 'w')
+        for dim, size in zip(predictors.dims, shape):
+            nc_fid.createDimension(dim, size)
+        var = nc_fid.createVariable('predictors', np.float32, predictors.dims, chunksizes=chunks, **compression)
+        for s in range(0, n_sample, chunks[0]):
+            var[s:s + chunks[0]] = predictors.isel(sample=slice(s, s + chunks[0])).values
+        nc_fid.close()
+
+        # Time each access pattern on a freshly opened file
+        results[layout] = {}
+        for pattern in ('training', 'verification', 'timeseries'):
+            nc_fid = nc.Dataset(file_name, 'r')
+            var = nc_fid.variables['predictors']
+            n_bytes = 0
+            start = time.time()
+            for r in range(n_reads):
+                if pattern == 'training':
+                    s = random.randint(max(1, n_sample - batch_size))
+                    n_bytes += var[s:s + batch_size].nbytes
+                elif pattern == 'verification':
+                    s = random.randint(max(1, n_sample - chunk_size))
+                    index = np.unravel_index(random.randint(middle), shape[1:-2])
+                    n_bytes += var[(slice(s, s + chunk_size),) + index].nbytes
+                else:
+                    index = np.unravel_index(random.randint(middle), shape[1:-2])
+                    point = (random.randint(shape[-2]), random.randint(shape[-1]))
+                    n_bytes += var[(slice(None),) + index + point].nbytes
+            elapsed = time.time() - start
+            nc_fid.close()
+            results[layout][pattern] = n_bytes / 1.e6 / max(elapsed, 1.e-9)
+        os.remove(file_name)
+        if verbose:
+            print('%s layout, chunks %s: %s' % (layout, chunks, ', '.join('%s %0.1f MB/s' % (k, v)
+                                                                         for k, v in results[layout].items())))
+    return results
+
+
+# Names of the running statistics of series data
+_moment_names = ('sample_count', 'sample_mean', 'sample_m2')
+
+
+def _moment_variables(dims, count, mean, m2):
+    # Dataset variables for the running statistics
+    return {
+        'sample_count': (dims, count.astype(np.float64), {
+            'long_name': 'Number of values of variables at levels',
+        }),
+        'sample_mean': (dims, mean.astype(np.float64), {
+            'long_name': 'Running mean of variables at levels',
+            'units': 'N/A',
+        }),
+        'sample_m2': (dims, m2.astype(np.float64), {
+            'long_name': 'Running sum of squared deviations from the mean of variables at levels',
+            'units': 'N/A',
+        }),
+    }
+
+
+def _open_zarr_group(file):
+    # Open a zarr group for writing from its own metadata rather than the consolidated metadata, which is stale once
+    # arrays are resized. zarr 2 never reads the consolidated metadata when opening a group; zarr 3 must be told.
+    import zarr
+    if int(zarr.__version__.split('.')[0]) >= 3:
+        return zarr.open_group(file, mode='r+', use_consolidated=False)
+    return zarr.open_group(file, mode='r+')
+
+
+class _VarlevSlice(object):
+    # A range of the varlev (second) axis of an array, written with slice assignment in the sample dimension by
+    # write_blocks
+
+    def __init__(self, array, start, stop):
+        self.array = array
+        self.start = start
+        self.stop = stop
+
+    @property
+    def shape(self):
+        return self.array.shape[:1] + (self.stop - self.start,) + self.array.shape[2:]
+
+    def __setitem__(self, key, value):
+        self.array[key, self.start:self.stop] = value
+
+
+def _encode_times(times, units, calendar, dtype):
+    # Encode datetime64 times in the units of an existing time variable
+    dates = np.array([datetime.utcfromtimestamp(d / 1e9) for d in times.astype('datetime64[ns]').astype(np.int64)])
+    values = np.asarray(nc.date2num(dates, units, calendar=calendar))
+    if np.issubdtype(dtype, np.integer):
+        values = np.round(values)
+    return values.astype(dtype)
+
+
+def renormalized(ds):
+    """
+    Lazily remap the predictors of a series Dataset from its 'mean' and 'std' to its 'renorm_mean' and 'renorm_std',
+    written by Preprocessor.renormalize(). The remapping is affine, so it is cheap to apply as the data are read.
+
+    :param ds: xarray Dataset
+    :return: xarray Dataset: predictors, mean, and std after renormalization
+    """
+    scale = ds['std'] / ds['renorm_std']
+    offset = (ds['mean'] - ds['renorm_mean']) / ds['renorm_std']
+    if ds['predictors'].chunks is None:
+        ds = ds.chunk({'sample': (ds['predictors'].encoding.get('chunksizes') or (64,))[0]})
+    predictors = (ds['predictors'] * scale + offset).astype(np.float32)
+    predictors.attrs = ds['predictors'].attrs
+    ds = ds.assign(predictors=predictors, mean=ds['renorm_mean'], std=ds['renorm_std'])
+    return ds.drop(['renorm_mean', 'renorm_std'])
+
+
+class DerivedArray(object):
+    """
+    A variable computed from other xarray DataArrays when it is read. Supports the parts of the DataArray interface
+    used by moments_by_batch and write_blocks: shape, dims, isel, and values.
+    """
+
+    def __init__(self, function, arrays):
+        """
+        :param function: function of the values of arrays returning the derived values
+        :param arrays: list of xarray DataArrays with the same shape
+        """
+        self.function = function
+        self.arrays = arrays
+
+    @property
+    def shape(self):
+        return self.arrays[0].shape
+
+    @property
+    def dims(self):
+        return self.arrays[0].dims
+
+    def isel(self, **kwargs):
+        return DerivedArray(self.function, [a.isel(**kwargs) for a in self.arrays])
+
+    @property
+    def values(self):
+        return np.asarray(self.function(*[a.values for a in self.arrays]), dtype=np.float32)
+
+
+def write_blocks(targets, arrays, means, stds, block_size, workers=4, verbose=False, offset=0, moments=False):
+    """
+    Read, normalize, and write a time series of several variable/level DataArrays into the sample dimension of one or
+    more output arrays. Contiguous blocks of samples are read for all of the variable/levels in parallel threads,
+    with the next block read while the current one is written, and each block is written to the outputs in a single
+    assignment. Blocks aligned with the chunks of the outputs avoid partially re-writing chunks. Writes to netCDF4
+    Variables hold xarray's HDF5 lock, so that they never overlap reads of netCDF data in the reading threads.
+
+    :param targets: list of arrays supporting slice assignment (ndarray, netCDF4 Variable, zarr array) of shape
+        (sample, [variable, level | varlev], lat, lon)
+    :param arrays: list of xarray DataArrays with a leading 'time' dimension, one per variable/level of the outputs
+    :param means: 1d array: mean subtracted from each of arrays
+    :param stds: 1d array: standard deviation dividing each of arrays
+    :param block_size: int: number of samples per block
+    :param workers: int: number of threads reading data
+    :param verbose: bool: print progress statements
+    :param offset: int: index in the sample dimension of the targets at which to write the first sample
+    :param moments: bool: if True, also take the count, mean, and sum of squared deviations from the mean of each of
+        the arrays (before normalization) as the blocks are read
+    :return: if moments, tuple of ndarrays: the count, mean, and sum of squared deviations of each array
+    """
+    n_sample = arrays[0].shape[0]
+    spatial_shape = arrays[0].shape[1:]
+    starts = list(range(0, n_sample, block_size))
+    result = None
+
+    def read(a, block, s):
+        block[:, a] = arrays[a].isel(time=slice(s, s + block.shape[0])).values
+        if moments:
+            values = block[:, a]
+            mean = np.sum(values, dtype=np.float64) / values.size
+            stats = (values.size, mean, np.sum((values - mean) ** 2.))
+        else:
+            stats = None
+        block[:, a] -= means[a]
+        block[:, a] /= stds[a]
+        return stats
+
+    with ThreadPoolExecutor(max_workers=max(1, int(workers))) as executor:
+        def submit(s):
+            block = np.empty((min(block_size, n_sample - s), len(arrays)) + spatial_shape, dtype=np.float32)
+            return block, [executor.submit(read, a, block, s) for a in range(len(arrays))]
+
+        pending = submit(starts[0])
+        for i, s in enumerate(starts):
+            block, futures = pending
+            if i + 1 < len(starts):
+                pending = submit(starts[i + 1])
+            stats = [future.result() for future in futures]
+            if moments:
+                stats = tuple(np.array(m, dtype=np.float64) for m in zip(*stats))
+                result = stats if result is None else combine_moments(result, stats)
+            if verbose:
+                print('Preprocessor: writing block %s of %s' % (i + 1, len(starts)))
+            for target in targets:
+                values = block.reshape(block.shape[:1] + tuple(target.shape[1:]))
+                if isinstance(target, nc.Variable):
+                    # The threads may be reading the next block through xarray, which holds this lock while in the
+                    # netCDF/HDF5 libraries; these are not thread-safe, so writes must hold it too
+                    with HDF5_LOCK:
+                        target[offset + s:offset + s + block.shape[0]] = values
+                else:
+                    target[offset + s:offset + s + block.shape[0]] = values
+    return result
+
+
 def mean_by_batch(da, batch_size, axis=0):
     """
     Loop over batches indexed in axis in an xarray DataArray to take the grand mean of the array in a memory-
@@ -862,3 +1473,68 @@ def std_by_batch(da, batch_size, axis=0, mean=None):
     for b in batches:
         total += np.sum((da.isel(**{dim: slice(b, min(b + batch_size, size))}).values - mean) ** 2.)
     return np.sqrt(total / da.size)
+
+
+def combine_moments(a, b):
+    """
+    Combine the count, mean, and sum of squared deviations from the mean of two sets of data with the numerically
+    stable pairwise algorithm of Chan et al. (1979).
+
+    :param a: tuple of (count, mean, m2) arrays for the first set
+    :param b: tuple of (count, mean, m2) arrays for the second set
+    :return: (count, mean, m2) of the combined set
+    """
+    n_a, mean_a, m2_a = a
+    n_b, mean_b, m2_b = b
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    return n, mean_a + delta * n_b / n, m2_a + m2_b + delta ** 2. * n_a * n_b / n
+
+
+def moments_by_batch(arrays, batch_size, axis=0, workers=4):
+    """
+    Take the count, grand mean, and sum of squared deviations from the mean of each of a list of xarray DataArrays in
+    a single pass over the data. Batches indexed in axis are read for all of the arrays at once, spread over a pool
+    of threads, and their statistics are combined with combine_moments.
+
+    :param arrays: list of xarray DataArrays, all with the same size along axis
+    :param batch_size: int: number of samples to load at a time
+    :param axis: int: axis along which to index batches
+    :param workers: int: number of threads reading batches
+    :return: ndarray, ndarray, ndarray: the count, mean, and sum of squared deviations of each array
+    """
+    size = arrays[0].shape[axis]
+    if any(da.shape[axis] != size for da in arrays):
+        raise ValueError("all arrays must have the same size along axis %d" % axis)
+
+    def batch_moments(b):
+        # Count, mean, and sum of squared deviations of the batch for each array
+        moments = np.zeros((len(arrays), 3))
+        for a, da in enumerate(arrays):
+            values = da.isel(**{da.dims[axis]: slice(b, min(b + batch_size, size))}).values
+            moments[a, 0] = values.size
+            moments[a, 1] = np.sum(values, dtype=np.float64) / values.size
+            moments[a, 2] = np.sum((values - moments[a, 1]) ** 2.)
+        return moments
+
+    with ThreadPoolExecutor(max_workers=max(1, int(workers))) as executor:
+        batches = executor.map(batch_moments, range(0, size, batch_size))
+        result = tuple(next(batches).T)
+        for moments in batches:
+            result = combine_moments(result, tuple(moments.T))
+    return result
+
+
+def mean_std_by_batch(arrays, batch_size, axis=0, workers=4):
+    """
+    Take the grand mean and standard deviation of each of a list of xarray DataArrays in a single pass over the data.
+    See moments_by_batch.
+
+    :param arrays: list of xarray DataArrays, all with the same size along axis
+    :param batch_size: int: number of samples to load at a time
+    :param axis: int: axis along which to index batches
+    :param workers: int: number of threads reading batches
+    :return: ndarray, ndarray: the mean and standard deviation of each array
+    """
+    n, mean, m2 = moments_by_batch(arrays, batch_size, axis=axis, workers=workers)
+    return mean, np.sqrt(m2 / n)
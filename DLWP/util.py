@@ -8,6 +8,7 @@
 DLWP utilities.
 """
 
+import os
 import pickle
 import random
 import tempfile
@@ -221,7 +222,8 @@ def load_torch_model(file_name, history=False):
 
 def delete_nan_samples(predictors, targets, large_fill_value=False, threshold=None):
     """
-    Delete any samples from the predictor and target numpy arrays and return new, reduced versions.
+    Delete any samples from the predictor and target numpy arrays and return new, reduced versions. If no samples
+    contain NaN, the input arrays are returned without a copy.
 
     :param predictors: ndarray, shape [num_samples,...]: predictor data
     :param targets: ndarray, shape [num_samples,...]: target data
@@ -234,22 +236,304 @@ def delete_nan_samples(predictors, targets, large_fill_value=False, threshold=No
     if large_fill_value:
         predictors[(predictors >= 1.e20) | (predictors <= -1.e20)] = np.nan
         targets[(targets >= 1.e20) | (targets <= -1.e20)] = np.nan
-    p_shape = predictors.shape
-    t_shape = targets.shape
-    predictors = predictors.reshape((p_shape[0], -1))
-    targets = targets.reshape((t_shape[0], -1))
+    valid = valid_samples(predictors, threshold) & valid_samples(targets, threshold)
+    if valid.all():
+        return predictors, targets
+    return predictors[valid], targets[valid]
+
+
+def valid_samples(data, threshold=None):
+    """
+    Find the samples of an array which do not contain NaN.
+
+    :param data: ndarray, shape [num_samples,...]: data
+    :param threshold: float 0-1: if not None, then only samples with a fraction of NaN at least this large are invalid
+    :return: 1d boolean ndarray, shape [num_samples]: True for valid samples
+    """
+    nan = np.isnan(data.reshape((data.shape[0], -1)))
     if threshold is None:
-        p_ind = list(np.where(np.isnan(predictors))[0])
-        t_ind = list(np.where(np.isnan(targets))[0])
+        return ~nan.any(axis=1)
+    return nan.mean(axis=1) < threshold
+
+
+def affine_scaler_parameters(scaler):
+    """
+    Get the parameters of a fitted scikit-learn scaler whose transform is (X - center) / scale.
+
+    :param scaler: fitted StandardScaler, RobustScaler, or MaxAbsScaler
+    :return: (center, scale): 1d arrays, or None where the scaler does not apply that step. Returns None if the scaler
+        is of another type.
+    """
+    scaler_type = type(scaler).__name__
+    if scaler_type == 'StandardScaler':
+        return (scaler.mean_ if scaler.with_mean else None), (scaler.scale_ if scaler.with_std else None)
+    elif scaler_type == 'RobustScaler':
+        return (scaler.center_ if scaler.with_centering else None), (scaler.scale_ if scaler.with_scaling else None)
+    elif scaler_type == 'MaxAbsScaler':
+        return None, scaler.scale_
+    return None
+
+
+def impute_scale(a, fill=None, center=None, scale=None):
+    """
+    Impute missing values and scale an array in place, in that order: NaNs are replaced by fill, then the array
+    becomes (a - center) / scale. This gives the same result as a mean Imputer followed by the equivalent
+    scikit-learn scaler.
+
+    :param a: ndarray, shape [num_samples,...]: floating-point data; overwritten if its features are contiguous
+    :param fill: 1d array: values to replace NaNs with for each feature, or None
+    :param center: 1d array: values subtracted from each feature, or None
+    :param scale: 1d array: values dividing each feature, or None
+    :return: ndarray: transformed array with the shape of a
+    """
+    a_shape = a.shape
+    a = a.reshape((a_shape[0], -1))
+    if fill is not None:
+        np.copyto(a, fill, where=np.isnan(a))
+    if center is not None:
+        np.subtract(a, center, out=a)
+    if scale is not None:
+        np.divide(a, scale, out=a)
+    return a.reshape(a_shape)
+
+
+def impute_scale_parameters(model):
+    """
+    Get the fitted Imputer and Scaler of a DLWP model as the fill, center, and scale of impute_scale, for the
+    predictors and for the targets. The result is cached on the model until its pre-processors are fit again.
+
+    :param model: DLWPNeuralNet or DLWPTorchNN with fitted pre-processors
+    :return: list of (fill, center, scale) for the predictors and the targets, or False if the scikit-learn transforms
+        are needed
+    """
+    if getattr(model, '_impute_scale_parameters', None) is not None:
+        return model._impute_scale_parameters
+    parameters = []
+    for imputer, scaler, scale in [(model.imputer, model.scaler, True),
+                                   (model.imputer_y, model.scaler_y, model.scale_targets)]:
+        fill = imputer.statistics_ if model.impute else None
+        if fill is not None and np.any(np.isnan(fill)):
+            # The Imputer drops features which are entirely missing
+            parameters = False
+            break
+        if model.scaler_type is None or not scale:
+            affine = (None, None)
+        else:
+            affine = affine_scaler_parameters(scaler)
+            if affine is None:
+                parameters = False
+                break
+        parameters.append((fill,) + affine)
+    model._impute_scale_parameters = parameters
+    return parameters
+
+
+def impute_scale_transform(model, X, y=None):
+    """
+    Apply the Imputer (if imputing) and the Scaler of a DLWP model to the predictors, and optionally the targets, in
+    place. The result is the same as the model's imputer_transform followed by scaler_transform, without allocating
+    new arrays. Scalers other than StandardScaler, RobustScaler, and MaxAbsScaler use the scikit-learn transforms.
+
+    :param model: DLWPNeuralNet or DLWPTorchNN with fitted pre-processors
+    :param X: ndarray: predictor data; may be overwritten
+    :param y: ndarray: target data; may be overwritten
+    :return: X[, y]: transformed arrays
+    """
+    parameters = impute_scale_parameters(model)
+    if parameters is False or not np.issubdtype(X.dtype, np.floating) or \
+            (y is not None and not np.issubdtype(y.dtype, np.floating)):
+        if model.impute:
+            if y is not None:
+                X, y = model.imputer_transform(X, y)
+            else:
+                X = model.imputer_transform(X)
+        return model.scaler_transform(X, y)
+    X = impute_scale(X, *parameters[0])
+    if y is not None:
+        return X, impute_scale(y, *parameters[1])
+    return X
+
+
+def rollout_scale_parameters(model, num_features, step_sequence=False):
+    """
+    Get the affine maps which let a DLWP model roll a time series forward in scaled space, as in predict_timeseries.
+    The prediction of the model, in the scaled space of the targets, becomes data as prediction * y_scale + y_center,
+    and becomes the scaled inputs of the next step as prediction * gain + offset. With step_sequence, the inputs of the
+    next step are the last time_dim - 1 steps of the current scaled inputs followed by the first step of the prediction,
+    to which the gain and offset are then applied, since each time step of the inputs has its own scaling.
+
+    :param model: DLWPNeuralNet or DLWPTorchNN with fitted pre-processors, whose targets have the shape of its inputs
+    :param num_features: int: number of features of one sample of the inputs
+    :param step_sequence: bool: as in predict_timeseries
+    :return: (y_scale, y_center, gain, offset): 1d arrays of length num_features, or None where the map is the
+        identity. Returns None if the pre-processors are not affine.
+    """
+    parameters = impute_scale_parameters(model)
+    if parameters is False:
+        return None
+    (_, x_center, x_scale), (_, y_center, y_scale) = parameters
+
+    def full(a, value):
+        return np.full(num_features, value) if a is None else np.asarray(a, dtype=np.float64).ravel()
+
+    x_center, x_scale, y_center, y_scale = full(x_center, 0.), full(x_scale, 1.), full(y_center, 0.), \
+        full(y_scale, 1.)
+    if step_sequence:
+        step_shape = (model.time_dim, -1)
+        source_center = np.concatenate([x_center.reshape(step_shape)[1:], y_center.reshape(step_shape)[:1]]).ravel()
+        source_scale = np.concatenate([x_scale.reshape(step_shape)[1:], y_scale.reshape(step_shape)[:1]]).ravel()
+    else:
+        source_center, source_scale = y_center, y_scale
+    gain = source_scale / x_scale
+    offset = (source_center - x_center) / x_scale
+
+    def identity(a, value):
+        return None if np.all(a == value) else a
+
+    return identity(y_scale, 1.), identity(y_center, 0.), identity(gain, 1.), identity(offset, 0.)
+
+
+class RunningMoments(object):
+    """
+    Running per-feature count, mean, and variance of samples, updated one batch at a time using the pairwise
+    combination of Chan et al. (1979), which is numerically stable for long streams. NaNs are ignored.
+    """
+
+    def __init__(self):
+        self.n_samples = 0
+        self.count = None
+        self._mean = None
+        self._m2 = None
+
+    def update(self, a):
+        """
+        Add a batch of samples.
+
+        :param a: ndarray, shape [num_samples,...]: batch of data; features are flattened
+        """
+        a = a.reshape((a.shape[0], -1))
+        valid = ~np.isnan(a)
+        count = valid.sum(axis=0)
+        mean = np.sum(np.where(valid, a, 0.), axis=0, dtype=np.float64) / np.maximum(count, 1)
+        dev = np.where(valid, a - mean, 0.)
+        m2 = np.einsum('ij,ij->j', dev, dev)
+        self.n_samples += a.shape[0]
+        if self.count is None:
+            self.count, self._mean, self._m2 = count, mean, m2
+            return
+        total = self.count + count
+        weight = count / np.maximum(total, 1)
+        delta = mean - self._mean
+        self._mean = self._mean + delta * weight
+        self._m2 = self._m2 + m2 + delta ** 2. * self.count * weight
+        self.count = total
+
+    @property
+    def mean(self):
+        """
+        :return: 1d array: mean of each feature; NaN for features with no valid data
+        """
+        return np.where(self.count > 0, self._mean, np.nan)
+
+    def var(self, impute=False):
+        """
+        Get the variance of each feature.
+
+        :param impute: bool: if True, the variance after replacing NaNs with the mean, as for the mean Imputer
+        :return: 1d array: population variance of each feature
+        """
+        count = self.n_samples if impute else self.count
+        return np.where(self.count > 0, self._m2 / np.maximum(count, 1), np.nan)
+
+
+def iterate_batches(data, batch_size=32):
+    """
+    Iterate over a dataset in batches of unscaled, flattened predictors and targets.
+
+    :param data: DLWP data generator, or xarray Dataset with 'predictors' and optionally 'targets' variables (if
+        absent, the targets are the predictors)
+    :param batch_size: int: number of samples per batch for a Dataset; generators use their own batch size
+    :return: iterator of (ndarray, ndarray): predictors, targets of shape [num_samples, num_features]
+    """
+    if hasattr(data, 'generate'):
+        n_sample, batch_size = data._n_sample, data._batch_size
+    else:
+        n_sample = data.dims['sample']
+    for start in range(0, n_sample, batch_size):
+        samples = np.arange(start, min(start + batch_size, n_sample))
+        if hasattr(data, 'generate'):
+            p, t = data.generate(samples, scale_and_impute=False)
+        else:
+            batch = data.isel(sample=samples)
+            p = batch['predictors'].values
+            t = batch['targets'].values if 'targets' in data.variables else p.copy()
+        yield p.reshape((p.shape[0], -1)), t.reshape((t.shape[0], -1))
+
+
+def streaming_init_fit(model, data, batch_size=32):
+    """
+    Fit the mean Imputer and Scaler of a DLWP model from a dataset read in batches, for data which do not fit in
+    memory, and mark the model as initialized for fitting. The Imputer and a StandardScaler are built from running
+    moments in a single pass; other scikit-learn scalers are fit with partial_fit, after a first pass for the Imputer
+    if imputing. The result is the same as the model's init_fit on all of the data.
+
+    :param model: DLWPNeuralNet or DLWPTorchNN
+    :param data: DLWP data generator, or xarray Dataset (see iterate_batches)
+    :param batch_size: int: number of samples per batch for a Dataset
+    """
+    scaler_class = None
+    if model.scaler_type is not None:
+        scaler_class = get_from_class('sklearn.preprocessing', model.scaler_type)
+        if model.scaler_type != 'StandardScaler' and not hasattr(scaler_class, 'partial_fit'):
+            raise ValueError("scaler_type '%s' does not support fitting in batches" % model.scaler_type)
+    fit_y = not model.apply_same_y_scaling
+    model._impute_scale_parameters = None
+
+    # Running moments for the Imputer and StandardScaler
+    p_moments, t_moments = RunningMoments(), RunningMoments()
+    if model.impute or model.scaler_type == 'StandardScaler':
+        for p, t in iterate_batches(data, batch_size):
+            p_moments.update(p)
+            if fit_y:
+                t_moments.update(t)
+
+    if model.impute:
+        imputer_class = get_from_class('sklearn.preprocessing', 'Imputer')
+        model.imputer = imputer_class(missing_values=np.nan, strategy="mean", axis=0, copy=False)
+        model.imputer.statistics_ = p_moments.mean
+        if fit_y:
+            model.imputer_y = imputer_class(missing_values=np.nan, strategy="mean", axis=0, copy=False)
+            model.imputer_y.statistics_ = t_moments.mean
+        else:
+            model.imputer_y = model.imputer
+
+    if scaler_class is None:
+        model._is_init_fit = True
+        return
+    model.scaler = scaler_class()
+    model.scaler_y = scaler_class()
+    if model.scaler_type == 'StandardScaler':
+        for scaler, moments in [(model.scaler, p_moments), (model.scaler_y, t_moments if fit_y else None)]:
+            if moments is None or moments.count is None:
+                continue
+            scaler.mean_ = moments.mean
+            scaler.var_ = moments.var(impute=model.impute)
+            scaler.scale_ = np.sqrt(scaler.var_)
+            scaler.scale_[scaler.scale_ == 0.] = 1.
+            if model.impute or np.all(moments.count == moments.n_samples):
+                scaler.n_samples_seen_ = moments.n_samples
+            else:
+                scaler.n_samples_seen_ = moments.count
     else:
-        p_ind = list(np.where(np.mean(np.isnan(predictors), axis=1) >= threshold)[0])
-        t_ind = list(np.where(np.mean(np.isnan(targets), axis=1) >= threshold)[0])
-    bad_ind = list(set(p_ind + t_ind))
-    predictors = np.delete(predictors, bad_ind, axis=0)
-    targets = np.delete(targets, bad_ind, axis=0)
-    new_p_shape = (predictors.shape[0],) + p_shape[1:]
-    new_t_shape = (targets.shape[0],) + t_shape[1:]
-    return predictors.reshape(new_p_shape), targets.reshape(new_t_shape)
+        for p, t in iterate_batches(data, batch_size):
+            if model.impute:
+                p, t = model.imputer_transform(p, t)
+            model.scaler.partial_fit(p)
+            if model.scale_targets and fit_y:
+                model.scaler_y.partial_fit(t)
+    if model.scale_targets and not fit_y:
+        model.scaler_y = model.scaler
+    model._is_init_fit = True
 
 
 def train_test_split_ind(n_sample, test_size, method='random'):
@@ -286,16 +570,21 @@ def day_of_year(date):
     return (date - year_start).total_seconds() / 3600. / 24.
 
 
-def insolation(dates, lat, lon, S=1.):
+def insolation(dates, lat, lon, S=1., dtype=np.float32, out=None, chunk_size=1000):
     """
     Calculate the approximate solar insolation for given dates
 
-    :param dates: 1d array: datetime or Timestamp
+    :param dates: 1d array: datetime64, datetime or Timestamp
     :param lat: 1d or 2d array of latitudes
     :param lon: 1d or 2d array of longitudes (0-360º). If 2d, must match the shape of lat.
     :param S: float: scaling factor (solar constant)
+    :param dtype: data type of the result
+    :param out: ndarray: if not None, write the insolation into this array of shape (date, lat, lon)
+    :param chunk_size: int: number of dates to calculate at a time, limiting the size of intermediate arrays
     :return: 3d array: insolation (date, lat, lon)
     """
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
     try:
         assert len(lat.shape) == len(lon.shape)
     except AssertionError:
@@ -307,6 +596,12 @@ def insolation(dates, lat, lon, S=1.):
             raise ValueError("shape mismatch between lat (%s) and lon (%s)" % (lat.shape, lon.shape))
     if len(lat.shape) == 1:
         lon, lat = np.meshgrid(lon, lat)
+    dates = np.asarray(dates, dtype='datetime64[ns]').ravel()
+    if out is None:
+        out = np.empty((len(dates),) + lat.shape, dtype=dtype)
+    elif out.shape != (len(dates),) + lat.shape:
+        raise ValueError("'out' must have shape %s; got %s" % ((len(dates),) + lat.shape, out.shape))
+    chunk_size = max(1, int(chunk_size))
 
     # Constants for year 1995 (standard)
     eps = 23.4441 * np.pi / 180.
@@ -314,23 +609,106 @@ def insolation(dates, lat, lon, S=1.):
     om = 282.7 * np.pi / 180.
     beta = np.sqrt(1 - ecc ** 2.)
     # Get the day of year. Ignore leap days.
-    days = pd.Series(dates)
-    days = days.apply(day_of_year)
+    days = (dates - dates.astype('datetime64[Y]')) / np.timedelta64(1, 's') / 3600. / 24.
     # Longitude of the earth relative to the orbit, 1st order approximation
     lambda_m0 = ecc * (1. + beta) * np.sin(om)
-    lambda_m = lambda_m0 + 2. * np.pi * (days.values - 80.5) / 365.
+    lambda_m = lambda_m0 + 2. * np.pi * (days - 80.5) / 365.
     lambda_ = lambda_m + 2. * ecc * np.sin(lambda_m - om)
     # Solar declination
     dec = np.arcsin(np.sin(eps) * np.sin(lambda_))
-    # Hour angle
-    h = 2 * np.pi * (days.values[:, None, None] + lon / 360.)
     # Distance
     rho = (1. - ecc ** 2.) / (1. + ecc * np.cos(lambda_ - om))
 
-    # Insolation
-    lat *= np.pi / 180.
-    sol = S * (np.sin(lat[None, ...]) * np.sin(dec[:, None, None]) -
-               np.cos(lat[None, ...]) * np.cos(dec[:, None, None]) * np.cos(h)) * rho[:, None, None] ** -2.
-    sol[sol < 0.] = 0.
+    # Insolation, computed in chunks of dates
+    lat = lat * np.pi / 180.
+    sin_lat = np.sin(lat[None, ...])
+    cos_lat = np.cos(lat[None, ...])
+    for c in range(0, len(dates), chunk_size):
+        s = slice(c, c + chunk_size)
+        # Hour angle
+        h = 2 * np.pi * (days[s, None, None] + lon / 360.)
+        sol = S * (sin_lat * np.sin(dec[s, None, None]) -
+                   cos_lat * np.cos(dec[s, None, None]) * np.cos(h)) * rho[s, None, None] ** -2.
+        sol[sol < 0.] = 0.
+        out[s] = sol
+
+    return out
+
+
+class InsolationTable(object):
+    """
+    Lookup table of insolation on a fixed latitude/longitude grid. Insolation depends only on the day of the year and
+    the time of day, so it is calculated once for every day of the year at each time of day that is requested, and
+    then looked up for any dates. The table may be cached in a file between runs.
+    """
 
-    return sol.astype(np.float32)
+    def __init__(self, lat, lon, S=1., cache_file=None):
+        """
+        Initialize an InsolationTable.
+
+        :param lat: 1d or 2d array of latitudes
+        :param lon: 1d or 2d array of longitudes (0-360º). If 2d, must match the shape of lat.
+        :param S: float: scaling factor (solar constant)
+        :param cache_file: str: path to a .npz file in which to save the table. If the file exists and matches the
+            grid, the table is loaded from it.
+        """
+        self.lat = np.array(lat, dtype=np.float64)
+        self.lon = np.array(lon, dtype=np.float64)
+        self.S = S
+        self._cache_file = cache_file
+        self._table = {}
+        if cache_file is not None and os.path.isfile(cache_file):
+            self.load(cache_file)
+
+    def _time_of_day(self, time):
+        # Insolation for all 366 days of a leap year at the given time of day (nanoseconds), (day, lat, lon)
+        dates = (np.datetime64('2000-01-01', 'ns') + np.arange(366).astype('timedelta64[D]') +
+                 np.timedelta64(int(time), 'ns'))
+        return insolation(dates, self.lat, self.lon, S=self.S)
+
+    def __call__(self, dates):
+        """
+        Look up the insolation for given dates.
+
+        :param dates: 1d array: datetime64, datetime or Timestamp
+        :return: 3d array: insolation (date, lat, lon)
+        """
+        dates = np.asarray(dates, dtype='datetime64[ns]').ravel()
+        days = dates.astype('datetime64[D]')
+        day_of_year = (days - dates.astype('datetime64[Y]')).astype(np.int64)
+        time_of_day = (dates - days).astype(np.int64)
+        grid_shape = self.lat.shape if len(self.lat.shape) == 2 else self.lat.shape + self.lon.shape
+        result = np.empty((len(dates),) + grid_shape, dtype=np.float32)
+        added = False
+        for t in np.unique(time_of_day).tolist():
+            if t not in self._table:
+                self._table[t] = self._time_of_day(t)
+                added = True
+            ind = time_of_day == t
+            result[ind] = self._table[t][day_of_year[ind]]
+        if added and self._cache_file is not None:
+            self.save(self._cache_file)
+        return result
+
+    def save(self, file_name):
+        """
+        Save the table to a .npz file.
+
+        :param file_name: str: file path
+        """
+        times = np.array(sorted(self._table.keys()), dtype=np.int64)
+        with open(file_name, 'wb') as f:
+            np.savez(f, lat=self.lat, lon=self.lon, S=self.S, times=times,
+                     table=np.stack([self._table[t] for t in times]))
+
+    def load(self, file_name):
+        """
+        Load a table saved with save(). The file is ignored if its grid or solar constant do not match.
+
+        :param file_name: str: file path
+        """
+        with np.load(file_name) as f:
+            if (f['lat'].shape != self.lat.shape or f['lon'].shape != self.lon.shape or
+                    not np.allclose(f['lat'], self.lat) or not np.allclose(f['lon'], self.lon) or f['S'] != self.S):
+                return
+            self._table.update({int(t): table for t, table in zip(f['times'], f['table'])})
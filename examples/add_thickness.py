@@ -5,83 +5,28 @@
 #
 
 """
-Add geopotential thickness as a variable to a predictor file.
+Add geopotential thickness as a variable to an existing series predictor zarr group. Only the new variable/level pair
+is written; the existing ones are left in place. The varlev dimension of a netCDF file cannot be extended in place, so
+when creating a new series predictor file, pass derived={'THICK/300-700': (np.subtract, ['HGT/300', 'HGT/700'])} to
+Preprocessor.data_to_series instead, which computes the thickness while the file is written. Use input_sel in the
+SeriesDataGenerator to select the variable/level pairs used for training, e.g. {'varlev': ['HGT/500', 'THICK/300-700']}.
 """
 
-import xarray as xr
-from DLWP.model.preprocessing import mean_by_batch, std_by_batch
+import numpy as np
+from DLWP.model import Preprocessor
 
 
 root_directory = '/home/disk/wave2/jweyn/Data'
-predictor_file = '%s/DLWP/cfs_analysis_1979-2010_z3-5-7_NH.nc' % root_directory
-new_file = '%s/DLWP/cfs_analysis_1979-2010_z500_tau300-700_NH.nc' % root_directory
+predictor_file = '%s/DLWP/cfs_analysis_1979-2010_z3-5-7_NH.zarr' % root_directory
 
-upper_sel = {'varlev': ['HGT/300']}
-lower_sel = {'varlev': ['HGT/700']}
-keep_sel = {'varlev': ['HGT/500']}
+upper = 'HGT/300'
+lower = 'HGT/700'
 new_var_coord = 'THICK/300-700'
 
 
-ds = xr.open_dataset(predictor_file)
-
-# Predictor variable
+pp = Preprocessor(None, predictor_file=predictor_file)
 
 print('Calculating predictor thickness...')
-
-upper_mean = ds['mean'].sel(**upper_sel)
-upper_std = ds['std'].sel(**upper_sel)
-upper_var = ds.predictors.sel(**upper_sel) * upper_std + upper_mean
-upper_var = upper_var.assign_coords(varlev=[new_var_coord])
-
-lower_mean = ds['mean'].sel(**lower_sel)
-lower_std = ds['std'].sel(**lower_sel)
-lower_var = ds.predictors.sel(**lower_sel) * lower_std + lower_mean
-lower_var = lower_var.assign_coords(varlev=[new_var_coord])
-
-p_thick = upper_var - lower_var
-
-if ds.attrs['scaling'] == 'True':
-    thick_mean = mean_by_batch(p_thick, 1000, axis=0)
-    thick_std = std_by_batch(p_thick, 1000, axis=0, mean=thick_mean)
-    p_thick = (p_thick - thick_mean) / thick_std
-else:
-    thick_mean = 1.
-    thick_std = 1.
-
-ds_thick = xr.Dataset({
-    'predictors': p_thick,
-    'mean': (['varlev'], [thick_mean], {
-        'long_name': 'Global mean of variables at levels',
-        'units': 'N/A',
-    }),
-    'std': (['varlev'], [thick_std], {
-        'long_name': 'Global std deviation of variables at levels',
-        'units': 'N/A',
-    })
-}, attrs=ds.attrs)
-
-# Targets
-
-if hasattr(ds, 'targets'):
-    print('Calculating target thickness...')
-
-    upper_var = ds.targets.sel(**upper_sel) * upper_std + upper_mean
-    lower_var = ds.targets.sel(**lower_sel) * lower_std + lower_mean
-    t_thick = upper_var - lower_var
-
-    if ds.attrs['scaling'] == 'True':
-        t_thick = (t_thick - thick_mean) / thick_std
-
-    ds_thick['targets'] = t_thick
-
-
-# Merge the datasets
-
-print('Concatenating datasets...')
-ds_new = xr.concat([ds.sel(**keep_sel), ds_thick], dim='varlev')
-
-
-# Write to output
-
-print('Writing new file (%s)...' % new_file)
-ds_new.to_netcdf(new_file)
+pp.add_derived({new_var_coord: (np.subtract, [upper, lower])}, batch_samples=1000, verbose=True)
+print(pp.data)
+pp.close()
@@ -0,0 +1,22 @@
+#
+# Copyright (c) 2019 Jonathan Weyn <jweyn@uw.edu>
+#
+# See the file LICENSE for your rights.
+#
+
+"""
+Compare the read throughput of a series predictor file written with each of the chunk layouts available in
+Preprocessor.data_to_series, for training, verification, and time series access patterns.
+"""
+
+from DLWP.model import Preprocessor
+from DLWP.model.preprocessing import benchmark_chunk_layouts
+
+root_directory = '/home/disk/wave2/jweyn/Data/DLWP'
+predictor_file = '%s/cfs_6h_1979-2010_z500-th3-7-w700-rh850-pwat_NH_T2.nc' % root_directory
+
+pp = Preprocessor(None, predictor_file=predictor_file)
+pp.open()
+# Use two years of 6-hourly samples
+results = benchmark_chunk_layouts(pp.data, root_directory, n_sample=2920, chunk_size=64, batch_size=32)
+pp.close()
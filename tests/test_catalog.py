@@ -0,0 +1,49 @@
+#
+# Copyright (c) 2019 Jonathan Weyn <jweyn@uw.edu>
+#
+# See the file LICENSE for your rights.
+#
+
+"""
+Tests for the FileCatalog of data files.
+"""
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pytest
+
+pytest.importorskip('netCDF4')
+pytest.importorskip('dask')
+from DLWP.data.catalog import FileCatalog
+
+
+def monthly_files(directory, n_files=4):
+    files = []
+    for m in range(n_files):
+        times = pd.date_range('2000-%02d-01' % (m + 1), periods=5, freq='6h')
+        ds = xr.Dataset({
+            'HGT': (('time', 'lat', 'lon'), np.random.RandomState(m).normal(size=(5, 3, 4)).astype(np.float32))
+        }, coords={'time': times, 'lat': [30., 40., 50.], 'lon': [0., 10., 20., 30.]})
+        file_name = str(directory.join('month%d.nc' % m))
+        ds.to_netcdf(file_name)
+        files.append(file_name)
+    return files
+
+
+def test_catalog_max_open_files(tmpdir):
+    files = monthly_files(tmpdir)
+    expected = xr.concat([xr.open_dataset(f).load() for f in files], dim='time')
+    catalog = FileCatalog(files, index_file=str(tmpdir.join('catalog.json')), max_open_files=2)
+    try:
+        ds = catalog.sel()
+        # Reading every file reopens, through the catalog, the handles closed to make room for later files
+        for _ in range(2):
+            np.testing.assert_array_equal(ds.HGT.values, expected.HGT.values)
+            assert len(catalog._file_cache) <= 2
+        times = expected.time.values[[17, 2, 8]]
+        np.testing.assert_array_equal(catalog.sel(time=times).HGT.values, expected.HGT.sel(time=times).values)
+        assert len(catalog._file_cache) <= 2
+    finally:
+        catalog.close()
+    assert len(catalog._file_cache) == 0
@@ -0,0 +1,271 @@
+#
+# Copyright (c) 2019 Jonathan Weyn <jweyn@uw.edu>
+#
+# See the file LICENSE for your rights.
+#
+
+"""
+Tests for DLWP.data.cfsr.
+"""
+
+import os
+import struct
+import numpy as np
+import pytest
+
+pygrib = pytest.importorskip('pygrib')
+from DLWP.data import cfsr
+
+
+def _section(number, body):
+    return struct.pack('>IB', 5 + len(body), number) + body
+
+
+def grib2_message(fields, ni=4, nj=3):
+    """
+    Encode a GRIB2 message on a regular 1-degree grid holding one field for each (parameterCategory, parameterNumber,
+    values) in fields, at 500 hPa. Several fields make a multi-field message sharing the grid section.
+    """
+    sec1 = _section(1, struct.pack('>HHBBBHBBBBBBB', 7, 0, 2, 1, 1, 2000, 1, 1, 0, 0, 0, 0, 1))
+    grid = struct.pack('>BBIBIBIIIIIIIBIIIIB', 6, 0, 0, 0, 0, 0, 0, ni, nj, 0, 0xffffffff,
+                       90000000, 0, 48, 90000000 - (nj - 1) * 1000000, (ni - 1) * 1000000, 1000000, 1000000, 0)
+    sec3 = _section(3, struct.pack('>BIBBH', 0, ni * nj, 0, 0, 0) + grid)
+    body = b''
+    for category, number, values in fields:
+        sec4 = _section(4, struct.pack('>HHBBBBBHBBIBBIBBI', 0, 0, category, number, 2, 0, 0, 0, 0, 1, 0,
+                                       100, 0, 50000, 255, 0, 0))
+        reference = float(values.min())
+        sec5 = _section(5, struct.pack('>IHfHHBB', ni * nj, 0, reference, 0, 0, 8, 0))
+        sec6 = _section(6, struct.pack('>B', 255))
+        sec7 = _section(7, np.round(values.ravel() - reference).astype(np.uint8).tobytes())
+        body += sec4 + sec5 + sec6 + sec7
+    payload = sec1 + sec3 + body + b'7777'
+    return b'GRIB' + struct.pack('>HBBQ', 0, 0, 2, 16 + len(payload)) + payload
+
+
+def test_decode_multi_field_message(tmpdir):
+    hgt = np.arange(12.).reshape((3, 4)) * 2.
+    ugrd = np.arange(12.).reshape((3, 4)) + 100.
+    vgrd = np.arange(12.).reshape((3, 4))[::-1] + 200.
+    file_name = os.path.join(str(tmpdir), 'test.grb2')
+    single = grib2_message([(3, 5, hgt)])
+    double = grib2_message([(2, 2, ugrd), (2, 3, vgrd)])
+    with open(file_name, 'wb') as fid:
+        fid.write(single + double)
+
+    assert cfsr._grib_message_layout(file_name) == [(0, len(single), 1), (len(single), len(double), 2)]
+    keys = [(0, 2, 3, 500), (0, 2, 2, 500), (0, 3, 5), (0, 1, 0, 500)]
+    # Decode once while building the index file, then again from the saved index
+    for n in range(2):
+        fields = cfsr._decode_grib(file_name, keys)
+        assert os.path.isfile(file_name + '.idx.json')
+        np.testing.assert_array_equal(fields[0], vgrd)
+        np.testing.assert_array_equal(fields[1], ugrd)
+        np.testing.assert_array_equal(fields[2], hgt)
+        assert fields[3] is None
+    index = cfsr._grib_index(cfsr._grib_file_index(file_name))
+    assert index[(0, 2, 2, 500)] == (len(single), len(double), 0, 2)
+    assert index[(0, 2, 3, 500)] == (len(single), len(double), 1, 3)
+
+
+class _RemoteFile(object):
+    """
+    Local stand-in for the remote data server, serving one file over HTTP. Range requests are honored unless
+    ignore_range; the first truncate responses are cut short of their Content-Length.
+    """
+
+    def __init__(self, content, ignore_range=False, truncate=0):
+        import threading
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+
+        remote = self
+        self.content = content
+        self.ignore_range = ignore_range
+        self.truncate = truncate
+        self.ranges = []
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                content = remote.content
+                start = 0
+                header = self.headers.get('Range')
+                remote.ranges.append(header)
+                if header is not None and not remote.ignore_range:
+                    start = int(header.split('=')[1].rstrip('-'))
+                    if start >= len(content):
+                        self.send_response(416)
+                        self.send_header('Content-Range', 'bytes */%d' % len(content))
+                        self.send_header('Content-Length', '0')
+                        self.end_headers()
+                        return
+                    self.send_response(206)
+                    self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(content) - 1, len(content)))
+                else:
+                    self.send_response(200)
+                self.send_header('Content-Length', str(len(content) - start))
+                self.end_headers()
+                body = content[start:]
+                if remote.truncate > 0:
+                    remote.truncate -= 1
+                    body = body[:len(body) // 2]
+                    self.close_connection = True
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d/pgbl.grb2' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def content():
+    return np.random.RandomState(0).bytes(100000)
+
+
+def _read(file_name):
+    with open(file_name, 'rb') as fid:
+        return fid.read()
+
+
+def test_download(tmpdir, content):
+    remote = _RemoteFile(content)
+    local_file = os.path.join(str(tmpdir), 'pgbl.grb2')
+    try:
+        assert cfsr._download(remote.url, local_file, chunk_size=4096) == len(content)
+    finally:
+        remote.close()
+    assert _read(local_file) == content
+    assert not os.path.exists(local_file + '.part')
+    assert remote.ranges == [None]
+
+
+def test_download_resume(tmpdir, content):
+    remote = _RemoteFile(content)
+    local_file = os.path.join(str(tmpdir), 'pgbl.grb2')
+    with open(local_file + '.part', 'wb') as fid:
+        fid.write(content[:30000])
+    try:
+        cfsr._download(remote.url, local_file)
+    finally:
+        remote.close()
+    assert _read(local_file) == content
+    assert remote.ranges == ['bytes=30000-']
+
+
+def test_download_truncated(tmpdir, content):
+    # A response cut short is never renamed to the local file, and the retry resumes where it stopped
+    remote = _RemoteFile(content, truncate=2)
+    local_file = os.path.join(str(tmpdir), 'pgbl.grb2')
+    try:
+        with pytest.raises(IOError):
+            cfsr._download(remote.url, local_file, retries=0)
+        assert not os.path.exists(local_file)
+        assert os.path.getsize(local_file + '.part') == len(content) // 2
+        cfsr._download(remote.url, local_file, retries=1)
+    finally:
+        remote.close()
+    assert _read(local_file) == content
+    assert not os.path.exists(local_file + '.part')
+    assert remote.ranges == [None, 'bytes=50000-', 'bytes=75000-']
+
+
+def test_download_ignores_range(tmpdir, content):
+    # The server answers a range request with the whole file, so the download starts over
+    remote = _RemoteFile(content, ignore_range=True)
+    local_file = os.path.join(str(tmpdir), 'pgbl.grb2')
+    with open(local_file + '.part', 'wb') as fid:
+        fid.write(content[:30000])
+    try:
+        cfsr._download(remote.url, local_file)
+    finally:
+        remote.close()
+    assert _read(local_file) == content
+    assert remote.ranges == ['bytes=30000-']
+
+
+def test_download_unsatisfiable_range(tmpdir, content):
+    # A partial file longer than the remote file is discarded
+    remote = _RemoteFile(content)
+    local_file = os.path.join(str(tmpdir), 'pgbl.grb2')
+    with open(local_file + '.part', 'wb') as fid:
+        fid.write(content + b'extra')
+    try:
+        cfsr._download(remote.url, local_file, retries=1)
+    finally:
+        remote.close()
+    assert _read(local_file) == content
+    assert remote.ranges == ['bytes=100005-', None]
+
+
+class _ChunkedResponse(object):
+    """
+    Stand-in for the response to a chunked-transfer request which the server cuts off after break_after bytes, so
+    that reading past them raises http.client.IncompleteRead.
+    """
+
+    def __init__(self, content, start, break_after=None):
+        self.content = content[start:]
+        self.code = 206 if start > 0 else 200
+        self.headers = {'Content-Range': 'bytes %d-%d/%d' % (start, len(content) - 1, len(content))} if start else {}
+        self.break_after = break_after
+        self.position = 0
+
+    def getcode(self):
+        return self.code
+
+    def read(self, amt):
+        from http.client import IncompleteRead
+        if self.break_after is not None and self.position + amt > self.break_after:
+            raise IncompleteRead(b'')
+        chunk = self.content[self.position:self.position + amt]
+        self.position += len(chunk)
+        return chunk
+
+    def close(self):
+        pass
+
+
+def test_download_incomplete_read(tmpdir, monkeypatch, content):
+    # A chunked response cut off mid-transfer is retried, resuming from the bytes already written
+    ranges = []
+
+    def urlopen(request, timeout=None):
+        header = request.get_header('Range')
+        ranges.append(header)
+        start = int(header.split('=')[1].rstrip('-')) if header else 0
+        return _ChunkedResponse(content, start, break_after=40960 if len(ranges) == 1 else None)
+
+    monkeypatch.setattr(cfsr, 'urlopen', urlopen)
+    local_file = os.path.join(str(tmpdir), 'pgbl.grb2')
+    assert cfsr._download('http://example.com/pgbl.grb2', local_file, chunk_size=4096, retries=1) == len(content)
+    assert _read(local_file) == content
+    assert not os.path.exists(local_file + '.part')
+    assert ranges == [None, 'bytes=40960-']
+
+
+def test_decode_grib_errors(tmpdir, monkeypatch):
+    file_name = os.path.join(str(tmpdir), 'test.grb2')
+    with open(file_name, 'wb') as fid:
+        fid.write(grib2_message([(3, 5, np.zeros((3, 4)))]))
+    keys = [(0, 3, 5, 500)]
+
+    # A field which fails to decode is returned as its exception; an interrupt stops the decoding
+    for error in [ValueError('corrupt field'), KeyboardInterrupt()]:
+        def read(self, *args):
+            raise error
+
+        monkeypatch.setattr(cfsr._GribFieldReader, 'read', read)
+        if isinstance(error, Exception):
+            assert cfsr._decode_grib(file_name, keys) == [error]
+        else:
+            with pytest.raises(KeyboardInterrupt):
+                cfsr._decode_grib(file_name, keys)
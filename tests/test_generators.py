@@ -0,0 +1,298 @@
+#
+# Copyright (c) 2019 Jonathan Weyn <jweyn@uw.edu>
+#
+# See the file LICENSE for your rights.
+#
+
+"""
+Tests for the DLWP data generators.
+"""
+
+import os
+import pickle
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pytest
+
+pytest.importorskip('keras')
+from DLWP.model.generators import DataGenerator, SeriesDataGenerator, PrefetchGenerator
+
+
+class IdentityModel(object):
+    """
+    Stand-in for a DLWP model which does not scale or impute its data.
+    """
+
+    def __init__(self, is_convolutional=False, is_recurrent=False):
+        self.is_convolutional = is_convolutional
+        self.is_recurrent = is_recurrent
+        self.impute = False
+
+    def impute_scale_transform(self, X, y=None):
+        return X, y
+
+
+def series_dataset(n_sample=40, nan_samples=(), seed=0):
+    random = np.random.RandomState(seed)
+    predictors = random.normal(size=(n_sample, 3, 4, 5)).astype(np.float32)
+    predictors[list(nan_samples), 0, 1, 2] = np.nan
+    return xr.Dataset({
+        'predictors': (('sample', 'varlev', 'lat', 'lon'), predictors)
+    }, coords={
+        'sample': pd.date_range('2000-01-01', periods=n_sample, freq='6h'),
+        'varlev': ['HGT/500', 'HGT/1000', 'TMP/850'],
+        'lat': np.linspace(60., 30., 4),
+        'lon': np.linspace(0., 20., 5)
+    })
+
+
+def sample_dataset(n_sample=40, nan_samples=(), seed=0):
+    random = np.random.RandomState(seed)
+    predictors = random.normal(size=(n_sample, 2, 3, 4, 5)).astype(np.float32)
+    targets = random.normal(size=(n_sample, 2, 3, 4, 5)).astype(np.float32)
+    predictors[list(nan_samples), 0, 0, 1, 2] = np.nan
+    return xr.Dataset({
+        'predictors': (('sample', 'time_step', 'varlev', 'lat', 'lon'), predictors),
+        'targets': (('sample', 'time_step', 'varlev', 'lat', 'lon'), targets)
+    }, coords={
+        'sample': pd.date_range('2000-01-01', periods=n_sample, freq='6h'),
+        'varlev': ['HGT/500', 'HGT/1000', 'TMP/850'],
+        'lat': np.linspace(60., 30., 4),
+        'lon': np.linspace(0., 20., 5)
+    })
+
+
+def reference_data_batch(generator, samples):
+    # A batch as read in earlier versions, by indexing the dataset with the samples of the batch
+    ds = generator.ds.isel(sample=samples)
+    p = ds.predictors.values.reshape((len(samples), -1))
+    t = ds.targets.values.reshape((len(samples), -1))
+    if generator._remove_nan:
+        bad = np.isnan(p).any(axis=1) | np.isnan(t).any(axis=1)
+        p, t = p[~bad], t[~bad]
+    if generator._is_convolutional:
+        p = p.reshape((p.shape[0],) + generator.convolution_shape)
+        t = t.reshape((t.shape[0],) + generator.convolution_shape)
+    elif generator._keep_time_axis:
+        p = p.reshape((p.shape[0],) + generator.dense_shape)
+        t = t.reshape((t.shape[0],) + generator.dense_shape)
+    return p, t
+
+
+def reference_series_batch(generator, samples):
+    # A batch as gathered in earlier versions: one copy of the series values per time step, with NaN samples removed
+    # from the gathered batch
+    samples = np.array(samples, dtype=int)
+    n_sample = len(samples)
+    p = np.concatenate([generator.input_da.values[samples + n, np.newaxis]
+                        for n in range(generator._input_time_steps)], axis=1)
+    t = np.concatenate([generator.output_da.values[samples + generator._input_time_steps + n, np.newaxis]
+                        for n in range(generator._output_time_steps)], axis=1)
+    if generator._add_insolation:
+        p = p.reshape((n_sample, generator._input_time_steps, -1) + generator.shape[-2:])
+        sol = np.concatenate([generator.insolation_da.values[samples + n, np.newaxis]
+                              for n in range(generator._input_time_steps)], axis=1)
+        p = np.concatenate([p, sol[:, :, np.newaxis]], axis=2)
+    p = p.reshape((n_sample, -1))
+    t = t.reshape((n_sample, -1))
+    if generator._remove_nan:
+        bad = np.isnan(p).any(axis=1) | np.isnan(t).any(axis=1)
+        p, t = p[~bad], t[~bad]
+        n_sample = p.shape[0]
+    if generator._is_convolutional:
+        p = p.reshape((n_sample,) + generator.convolution_shape)
+        t = t.reshape((n_sample,) + generator.output_convolution_shape)
+    elif generator._keep_time_axis:
+        p = p.reshape((n_sample,) + generator.dense_shape)
+        t = t.reshape((n_sample,) + generator.output_dense_shape)
+    return p, t
+
+
+def assert_batches_equal(generator, reference=None):
+    # Every batch of an epoch matches the reference gathering of its samples
+    if reference is None:
+        reference = generator
+    for index in range(len(generator)):
+        samples = generator._indices[index * generator._batch_size:(index + 1) * generator._batch_size]
+        p, t = generator[index]
+        if isinstance(reference, DataGenerator):
+            p_ref, t_ref = reference_data_batch(reference, samples)
+        else:
+            p_ref, t_ref = reference_series_batch(reference, samples)
+        assert p.shape == p_ref.shape and t.shape == t_ref.shape
+        np.testing.assert_array_equal(p, p_ref)
+        np.testing.assert_array_equal(t, t_ref)
+
+
+def _series_generator(model=None, ds=None, **kwargs):
+    kwargs.setdefault('input_time_steps', 2)
+    kwargs.setdefault('output_time_steps', 2)
+    kwargs.setdefault('batch_size', 8)
+    return SeriesDataGenerator(model or IdentityModel(), series_dataset() if ds is None else ds, **kwargs)
+
+
+@pytest.mark.parametrize('load', [True, False])
+@pytest.mark.parametrize('add_insolation', [False, True])
+@pytest.mark.parametrize('is_convolutional,is_recurrent', [(False, False), (True, False), (False, True),
+                                                           (True, True)])
+def test_series_generate(load, add_insolation, is_convolutional, is_recurrent):
+    for output_sel in [None, {'varlev': ['HGT/500', 'TMP/850']}]:
+        generator = _series_generator(IdentityModel(is_convolutional, is_recurrent), load=load,
+                                      add_insolation=add_insolation, shuffle=True,
+                                      input_sel={'varlev': ['HGT/500', 'TMP/850']} if output_sel else None,
+                                      output_sel=output_sel, output_time_steps=1 if output_sel else 2)
+        assert_batches_equal(generator)
+        p, t = generator.generate([])
+        p_ref, t_ref = reference_series_batch(generator, np.arange(generator._n_sample))
+        np.testing.assert_array_equal(p, p_ref)
+        np.testing.assert_array_equal(t, t_ref)
+
+
+@pytest.mark.parametrize('cache_blocks', [1, 3, 100])
+@pytest.mark.parametrize('is_convolutional,is_recurrent', [(False, False), (True, True)])
+def test_data_generator_block_cache(cache_blocks, is_convolutional, is_recurrent):
+    ds = sample_dataset().chunk({'sample': 6})
+    block_bytes = 6 * (ds.predictors[0].nbytes + ds.targets[0].nbytes)
+    generator = DataGenerator(IdentityModel(is_convolutional, is_recurrent), ds, batch_size=8, shuffle=True,
+                              cache_bytes=cache_blocks * block_bytes)
+    assert generator._block_size == 6
+    for epoch in range(2):
+        # The epoch visits every sample once, reading the samples of each block one after another
+        blocks = generator._indices // 6
+        assert sorted(generator._indices) == list(range(40))
+        assert np.count_nonzero(np.diff(blocks)) == len(np.unique(blocks)) - 1
+        assert_batches_equal(generator)
+        assert generator._cached_bytes <= max(cache_blocks, 1) * block_bytes
+        assert len(generator._block_cache) <= cache_blocks
+        generator.on_epoch_end()
+    p, t = generator.generate([3, 17, 4, 39])
+    p_ref, t_ref = reference_data_batch(generator, [3, 17, 4, 39])
+    np.testing.assert_array_equal(p, p_ref)
+    np.testing.assert_array_equal(t, t_ref)
+    # A pickled copy starts with an empty cache
+    copy = pickle.loads(pickle.dumps(generator))
+    assert len(copy._block_cache) == 0 and copy._cached_bytes == 0
+    assert_batches_equal(copy, generator)
+
+    # Without a block cache, batches are read as before
+    generator = DataGenerator(IdentityModel(is_convolutional, is_recurrent), ds, batch_size=8, shuffle=True)
+    assert_batches_equal(generator)
+
+
+@pytest.mark.parametrize('add_insolation', [False, True])
+@pytest.mark.parametrize('output_sel', [None, {'varlev': ['HGT/500', 'TMP/850']}])
+def test_series_shared_memory(add_insolation, output_sel):
+    kwargs = dict(add_insolation=add_insolation, output_sel=output_sel, output_time_steps=1)
+    reference = _series_generator(load=False, **kwargs)
+    generator = _series_generator(shared_memory=True, shuffle=True, **kwargs)
+    try:
+        assert_batches_equal(generator, reference)
+        # A copy sent to a worker attaches to the shared memory instead of carrying the data
+        state = pickle.dumps(generator)
+        assert len(state) < generator._input_data.nbytes
+        copy = pickle.loads(state)
+        assert set(copy._shared_memory.keys()) == set(generator._shared_memory.keys())
+        copy._indices = generator._indices
+        assert_batches_equal(copy, reference)
+        # The worker's view of the data is the same memory
+        copy._input_data[0, 0, 0, 0] = 1.e6
+        assert generator._input_data[0, 0, 0, 0] == 1.e6
+        copy.close()
+        assert_batches_equal(generator, generator)
+    finally:
+        generator.close()
+    assert generator._shared_memory == {}
+
+
+def test_series_memmap(tmpdir):
+    memmap_dir = str(tmpdir.join('memmap'))
+    file_name = str(tmpdir.join('series.nc'))
+    series_dataset().to_netcdf(file_name)
+    kwargs = dict(add_insolation=True, output_sel={'varlev': ['HGT/500', 'TMP/850']}, output_time_steps=1)
+    with xr.open_dataset(file_name) as ds:
+        reference = _series_generator(ds=ds, load=False, **kwargs)
+        generator = _series_generator(ds=ds, memmap_dir=memmap_dir, shuffle=True, **kwargs)
+        assert isinstance(generator._input_data, np.memmap)
+        assert_batches_equal(generator, reference)
+        copy = pickle.loads(pickle.dumps(generator))
+        copy._indices = generator._indices
+        assert_batches_equal(copy, reference)
+    for name in ['input', 'output']:
+        assert os.path.isfile(os.path.join(memmap_dir, '%s.npy' % name))
+        assert os.path.isfile(os.path.join(memmap_dir, '%s.json' % name))
+    exported = os.stat(os.path.join(memmap_dir, 'input.npy')).st_mtime_ns
+
+    # The store is re-used for the same data, and exported again when the data change
+    with xr.open_dataset(file_name) as ds:
+        _series_generator(ds=ds, memmap_dir=memmap_dir, **kwargs)
+    assert os.stat(os.path.join(memmap_dir, 'input.npy')).st_mtime_ns == exported
+    series_dataset(seed=1).to_netcdf(file_name)
+    stat = os.stat(file_name)
+    os.utime(file_name, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    with xr.open_dataset(file_name) as ds:
+        reference = _series_generator(ds=ds, load=False, **kwargs)
+        generator = _series_generator(ds=ds, memmap_dir=memmap_dir, **kwargs)
+        assert_batches_equal(generator, reference)
+
+
+@pytest.mark.parametrize('precompute_valid', [False, True])
+def test_data_generator_remove_nan(precompute_valid):
+    ds = sample_dataset(nan_samples=(3, 4, 21)).chunk({'sample': 6})
+    for cache_bytes in [0, 10 ** 6]:
+        generator = DataGenerator(IdentityModel(True), ds, batch_size=8, shuffle=True, cache_bytes=cache_bytes,
+                                  precompute_valid=precompute_valid)
+        assert_batches_equal(generator)
+        p, t = generator.generate([])
+        assert p.shape[0] == 37 and not np.isnan(p).any()
+        if precompute_valid:
+            # Invalid samples are left out of the epoch, so every batch but the last is full
+            assert sorted(generator._indices) == sorted(set(range(40)) - {3, 4, 21})
+            assert [generator[i][0].shape[0] for i in range(len(generator))] == [8, 8, 8, 8, 5]
+
+
+@pytest.mark.parametrize('precompute_valid', [False, True])
+@pytest.mark.parametrize('load', [True, False])
+def test_series_remove_nan(precompute_valid, load):
+    ds = series_dataset(nan_samples=(5, 20, 21))
+    kwargs = dict(load=load, shuffle=True, precompute_valid=precompute_valid, input_time_steps=2,
+                  output_time_steps=1)
+    for output_sel in [None, {'varlev': ['HGT/1000', 'TMP/850']}]:
+        generator = _series_generator(ds=ds, output_sel=output_sel, **kwargs)
+        assert_batches_equal(generator)
+        p, t = generator.generate([])
+        p_ref, t_ref = reference_series_batch(generator, np.arange(generator._n_sample))
+        np.testing.assert_array_equal(p, p_ref)
+        np.testing.assert_array_equal(t, t_ref)
+        if precompute_valid:
+            # The windows with a NaN in their inputs or, if the outputs include it, outputs are left out of the epoch
+            invalid = {3, 4, 5, 18, 19, 20, 21} if output_sel is None else {4, 5, 19, 20, 21}
+            assert sorted(generator._indices) == sorted(set(range(generator._n_sample)) - invalid)
+
+
+@pytest.mark.parametrize('use_multiprocessing', [False, True])
+def test_prefetch_generator(use_multiprocessing):
+    generator = _series_generator(shuffle=True, shared_memory=use_multiprocessing)
+    prefetch = PrefetchGenerator(generator, max_queue_size=2, workers=2, use_multiprocessing=use_multiprocessing,
+                                 seed=1)
+    try:
+        for epoch in range(2):
+            for index in range(len(prefetch)):
+                p, t = prefetch[index]
+                p_ref, t_ref = generator[index]
+                np.testing.assert_array_equal(p, p_ref)
+                np.testing.assert_array_equal(t, t_ref)
+            prefetch.on_epoch_end()
+        np.testing.assert_array_equal(prefetch[-1][0], generator[len(generator) - 1][0])
+        with pytest.raises(IndexError):
+            prefetch[len(prefetch)]
+    finally:
+        prefetch.close()
+        generator.close()
+
+
+def test_prefetch_generator_process_memory():
+    # Process workers would each get a copy of data loaded in the generator's own memory
+    with pytest.raises(ValueError):
+        PrefetchGenerator(_series_generator(), use_multiprocessing=True)
+    PrefetchGenerator(_series_generator(load=False), use_multiprocessing=True).close()
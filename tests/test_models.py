@@ -0,0 +1,162 @@
+#
+# Copyright (c) 2019 Jonathan Weyn <jweyn@uw.edu>
+#
+# See the file LICENSE for your rights.
+#
+
+"""
+Tests for the DLWP model classes.
+"""
+
+import numpy as np
+import pytest
+
+pytest.importorskip('keras')
+pytest.importorskip('sklearn')
+from DLWP.model import DLWPNeuralNet
+
+
+class LinearModel(object):
+    """
+    Stand-in for a compiled Keras model: a fixed linear map of the flattened features.
+    """
+
+    def __init__(self, n_features, seed=0):
+        random = np.random.RandomState(seed)
+        self.weights = (np.eye(n_features) * 0.9 + random.normal(0., 0.05, (n_features, n_features))).astype(np.float32)
+        self.bias = random.normal(0., 0.1, n_features).astype(np.float32)
+
+    def predict(self, x, **kwargs):
+        return (x.reshape((x.shape[0], -1)) @ self.weights + self.bias).reshape(x.shape).astype(np.float32)
+
+
+def reference_timeseries(model, predictors, time_steps, step_sequence=False, keep_time_dim=False):
+    # The time series as predicted in earlier versions: the inputs are transformed and the predictions inverse-
+    # transformed by model.predict at every step
+    if not step_sequence:
+        time_steps = int(np.ceil(1. * time_steps / model.time_dim))
+    time_series = np.full((time_steps,) + predictors.shape, np.nan, dtype=np.float32)
+    p = predictors.copy()
+    sample_dim = p.shape[0]
+    for t in range(time_steps):
+        if step_sequence:
+            pr = model.predict(p)
+            pr_steps = pr.reshape((sample_dim, model.time_dim, -1))
+            p_steps = p.reshape((sample_dim, model.time_dim, -1))
+            p = np.concatenate((p_steps[:, 1:], pr_steps[:, [0]]), axis=1).reshape(predictors.shape)
+            time_series[t] = pr
+        else:
+            p = 1. * model.predict(p)
+            time_series[t] = p
+    time_series = time_series.reshape((time_steps, sample_dim, model.time_dim, -1))
+    if not keep_time_dim:
+        if step_sequence:
+            time_series = time_series[:, :, 0]
+        else:
+            time_series = time_series.transpose((0, 2, 1, 3)).reshape((time_steps * model.time_dim, sample_dim, -1))
+    return time_series
+
+
+def _predictors():
+    random = np.random.RandomState(1)
+    return (random.normal(0., 1., (11, 2, 6)) * np.arange(1., 13.).reshape((2, 6)) + 100.).reshape((11, 12))
+
+
+def _fit(model, predictors):
+    targets = predictors * 1.5 - 20.
+    model.init_fit(predictors, targets)
+
+
+@pytest.mark.parametrize('scaler_type', ['StandardScaler', 'MinMaxScaler'])
+@pytest.mark.parametrize('step_sequence', [False, True])
+@pytest.mark.parametrize('keep_time_dim', [False, True])
+def test_predict_timeseries(scaler_type, step_sequence, keep_time_dim):
+    predictors = _predictors().astype(np.float32)
+    model = DLWPNeuralNet(is_convolutional=False, time_dim=2, scaler_type=scaler_type, apply_same_y_scaling=False)
+    _fit(model, predictors)
+    model.model = LinearModel(12)
+    expected = reference_timeseries(model, predictors, 5, step_sequence=step_sequence, keep_time_dim=keep_time_dim)
+
+    result = model.predict_timeseries(predictors, 5, step_sequence=step_sequence, keep_time_dim=keep_time_dim)
+    np.testing.assert_allclose(result, expected, rtol=1e-4, atol=1e-3)
+    out = np.empty_like(expected)
+    result = model.predict_timeseries(predictors, 5, step_sequence=step_sequence, keep_time_dim=keep_time_dim,
+                                      chunk_size=4, out=out)
+    assert result is out
+    np.testing.assert_allclose(out, expected, rtol=1e-4, atol=1e-3)
+    with pytest.raises(ValueError):
+        model.predict_timeseries(predictors, 5, step_sequence=step_sequence, keep_time_dim=keep_time_dim,
+                                 out=out[:-1])
+
+
+def _torch_model(n_features):
+    torch = pytest.importorskip('torch')
+    from DLWP.model import models_torch
+    linear = LinearModel(n_features)
+    module = torch.nn.Linear(n_features, n_features)
+    with torch.no_grad():
+        module.weight.copy_(torch.as_tensor(linear.weights.T))
+        module.bias.copy_(torch.as_tensor(linear.bias))
+    return module.to(models_torch.device)
+
+
+@pytest.mark.parametrize('scaler_type', ['StandardScaler', 'MinMaxScaler'])
+@pytest.mark.parametrize('step_sequence', [False, True])
+@pytest.mark.parametrize('keep_time_dim', [False, True])
+def test_torch_predict_timeseries(scaler_type, step_sequence, keep_time_dim):
+    module = _torch_model(12)
+    from DLWP.model import DLWPTorchNN
+    predictors = _predictors().astype(np.float32)
+    model = DLWPTorchNN(is_convolutional=False, time_dim=2, scaler_type=scaler_type, apply_same_y_scaling=False)
+    _fit(model, predictors)
+    model.model = module
+    expected = reference_timeseries(model, predictors, 5, step_sequence=step_sequence, keep_time_dim=keep_time_dim)
+
+    result = model.predict_timeseries(predictors, 5, step_sequence=step_sequence, keep_time_dim=keep_time_dim)
+    np.testing.assert_allclose(result, expected, rtol=1e-4, atol=1e-3)
+    out = np.empty_like(expected)
+    result = model.predict_timeseries(predictors, 5, step_sequence=step_sequence, keep_time_dim=keep_time_dim,
+                                      chunk_size=4, out=out)
+    assert result is out
+    np.testing.assert_allclose(out, expected, rtol=1e-4, atol=1e-3)
+
+    # Only the requested steps are returned, and the rollout stops at the last of them
+    output_steps = [2, 0]
+    result = model.predict_timeseries(predictors, 5, step_sequence=step_sequence, keep_time_dim=keep_time_dim,
+                                      chunk_size=4, output_steps=output_steps)
+    np.testing.assert_allclose(result, expected[output_steps], rtol=1e-4, atol=1e-3)
+    with pytest.raises(ValueError):
+        model.predict_timeseries(predictors, 5, step_sequence=step_sequence, keep_time_dim=keep_time_dim,
+                                 output_steps=[len(expected)])
+
+
+def test_torch_predict_batches():
+    torch = pytest.importorskip('torch')
+    module = _torch_model(12)
+    from DLWP.model import DLWPTorchNN
+    predictors = _predictors().astype(np.float32)
+    model = DLWPTorchNN(is_convolutional=False, time_dim=2)
+    _fit(model, predictors)
+    model.model = module
+    expected = model.predict(predictors)
+
+    # Invalid arguments are reported when predict_batches is called, not when the first batch is requested
+    with pytest.raises(ValueError):
+        model.predict_batches(predictors, batch_size=0)
+    threads = torch.get_num_threads()
+    batches = list(model.predict_batches(predictors, batch_size=4, num_threads=1))
+    assert [b.shape[0] for b in batches] == [4, 4, 3]
+    assert torch.get_num_threads() == threads
+    np.testing.assert_allclose(np.concatenate(batches), expected, rtol=1e-5)
+    np.testing.assert_allclose(model.predict(predictors, batch_size=4), expected, rtol=1e-5)
+
+
+def test_torch_set_num_threads():
+    torch = pytest.importorskip('torch')
+    from DLWP.model import DLWPTorchNN
+    interop_threads = torch.get_num_interop_threads()
+    # The number of inter-op threads can be set only once
+    with pytest.warns(UserWarning):
+        DLWPTorchNN.set_num_threads(num_interop_threads=interop_threads)
+        DLWPTorchNN.set_num_threads(num_interop_threads=interop_threads)
+    assert torch.get_num_interop_threads() == interop_threads
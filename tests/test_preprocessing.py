@@ -0,0 +1,183 @@
+#
+# Copyright (c) 2017-18 Jonathan Weyn <jweyn@uw.edu>
+#
+# See the file LICENSE for your rights.
+#
+
+"""
+Tests for DLWP.model.preprocessing.
+"""
+
+import os
+import netCDF4 as nc
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+pytest.importorskip('zarr')
+pytest.importorskip('keras')
+from DLWP.model.preprocessing import Preprocessor
+
+
+class CountingDataset(nc.Dataset):
+    """
+    netCDF4 Dataset which records the assignments to its predictors and targets variables.
+    """
+
+    def createVariable(self, varname, *args, **kwargs):
+        variable = super(CountingDataset, self).createVariable(varname, *args, **kwargs)
+        if varname in ['predictors', 'targets']:
+            return CountingVariable(variable)
+        return variable
+
+
+class CountingVariable(object):
+    writes = []
+
+    def __init__(self, variable):
+        self.variable = variable
+
+    def __getattr__(self, item):
+        return getattr(self.variable, item)
+
+    def __setitem__(self, key, value):
+        CountingVariable.writes.append((self.variable.name, key))
+        self.variable[key] = value
+
+
+class RawData(object):
+    """
+    Minimal stand-in for a DLWP.data object with data loaded.
+    """
+
+    def __init__(self, n_sample):
+        times = pd.date_range('2000-01-01', periods=n_sample, freq='6h')
+        values = np.random.RandomState(0).normal(500., 10., size=(n_sample, 2, 4, 5)).astype(np.float32)
+        self.Dataset = xr.Dataset({'HGT': (('time', 'level', 'lat', 'lon'), values)},
+                                  coords={'time': times, 'level': [500., 700.], 'lat': np.arange(4.),
+                                          'lon': np.arange(5.)})
+        self.dataset_dates = list(times)
+
+    def subset(self, n_sample):
+        raw = RawData(0)
+        raw.Dataset = self.Dataset.isel(time=slice(0, n_sample))
+        raw.dataset_dates = self.dataset_dates[:n_sample]
+        return raw
+
+
+def test_append_series_zarr(tmpdir):
+    raw = RawData(80)
+    zarr_file = os.path.join(str(tmpdir), 'predictors.zarr')
+    pp = Preprocessor(raw.subset(50), predictor_file=os.path.join(str(tmpdir), 'predictors.nc'))
+    pp.data_to_series(batch_samples=16, chunk_size=8, scale_variables=True, in_memory=True, to_zarr=True)
+    pp.close()
+
+    pp = Preprocessor(raw, predictor_file=zarr_file)
+    pp.data_to_series(batch_samples=16, chunk_size=8, scale_variables=True, append=True)
+    pp.close()
+
+    ds = xr.open_zarr(zarr_file)
+    assert ds.sizes['sample'] == 80
+    np.testing.assert_array_equal(ds['sample'].values, raw.Dataset['time'].values)
+    # Appended samples are normalized with the mean and std already in the file
+    mean = ds['mean'].values[np.newaxis, :, :, np.newaxis, np.newaxis]
+    std = ds['std'].values[np.newaxis, :, :, np.newaxis, np.newaxis]
+    expected = (raw.Dataset['HGT'].values[:, np.newaxis] - mean) / std
+    np.testing.assert_allclose(ds['predictors'].values, expected, rtol=1e-5, atol=1e-5)
+    ds.close()
+
+
+def test_append_series_moments(tmpdir):
+    raw = RawData(80)
+    predictor_file = os.path.join(str(tmpdir), 'predictors.nc')
+    pp = Preprocessor(raw.subset(50), predictor_file=predictor_file)
+    pp.data_to_series(batch_samples=16, chunk_size=8, scale_variables=True)
+    pp.close()
+
+    pp = Preprocessor(raw, predictor_file=predictor_file)
+    pp.data_to_series(batch_samples=16, chunk_size=8, scale_variables=True, append=True)
+    pp.close()
+
+    # The running statistics cover all of the samples, old and appended
+    ds = xr.open_dataset(predictor_file)
+    assert ds.sizes['sample'] == 80
+    values = raw.Dataset['HGT'].values.astype(np.float64)
+    np.testing.assert_array_equal(ds['sample_count'].values.ravel(), [80 * 4 * 5] * 2)
+    np.testing.assert_allclose(ds['sample_mean'].values.ravel(), values.mean(axis=(0, 2, 3)), rtol=1e-6)
+    np.testing.assert_allclose(ds['sample_m2'].values.ravel(), values.var(axis=(0, 2, 3)) * 80 * 4 * 5, rtol=1e-5)
+    ds.close()
+
+
+def test_add_derived_zarr(tmpdir):
+    raw = RawData(40)
+    derived = {'THICK/500-700': (np.subtract, ['HGT/500.0', 'HGT/700.0'])}
+    pp = Preprocessor(raw, predictor_file=os.path.join(str(tmpdir), 'expected.nc'))
+    pp.data_to_series(batch_samples=16, chunk_size=8, variables=['HGT', 'HGT'], levels=[500., 700.], pairwise=True,
+                      scale_variables=True, in_memory=True, derived=derived)
+    expected = pp.data.load()
+    pp.close()
+
+    pp = Preprocessor(raw, predictor_file=os.path.join(str(tmpdir), 'predictors.nc'))
+    pp.data_to_series(batch_samples=16, chunk_size=8, variables=['HGT', 'HGT'], levels=[500., 700.], pairwise=True,
+                      scale_variables=True, in_memory=True, to_zarr=True)
+    pp.close()
+    zarr_file = os.path.join(str(tmpdir), 'predictors.zarr')
+    before = xr.open_zarr(zarr_file)['predictors'].values
+
+    pp = Preprocessor(None, predictor_file=zarr_file)
+    pp.add_derived(derived, batch_samples=16)
+    ds = pp.data
+    assert list(ds['varlev'].values) == ['HGT/500.0', 'HGT/700.0', 'THICK/500-700']
+    np.testing.assert_array_equal(ds['predictors'].values[:, :2], before)
+    np.testing.assert_allclose(ds['predictors'].values, expected['predictors'].values, rtol=1e-4, atol=1e-4)
+    for name in ('mean', 'std', 'sample_mean', 'sample_m2'):
+        np.testing.assert_allclose(ds[name].values, expected[name].values, rtol=1e-5)
+    pp.close()
+
+    with pytest.raises(ValueError):
+        Preprocessor(None, predictor_file=os.path.join(str(tmpdir), 'expected.nc')).add_derived(derived)
+
+
+def test_data_to_samples_chunk_layout(tmpdir):
+    raw = RawData(20)
+    pp = Preprocessor(raw, predictor_file=os.path.join(str(tmpdir), 'samples.nc'))
+    pp.data_to_samples(time_step=2, batch_samples=8, scale_variables=False, chunk_size=4, chunk_layout='training')
+    ds = pp.data
+    assert ds['predictors'].encoding['chunksizes'] == (4, 2, 1, 2, 4, 5)
+    assert ds['predictors'].encoding['zlib']
+    values = raw.Dataset['HGT'].values
+    np.testing.assert_allclose(ds['predictors'].values[:, 1, 0], values[1:18])
+    np.testing.assert_allclose(ds['targets'].values[:, 0, 0], values[2:19])
+    pp.close()
+
+
+@pytest.mark.parametrize('chunk_layout', [None, 'training', 'timeseries'])
+@pytest.mark.parametrize('pairwise', [False, True])
+def test_data_to_samples_chunk_writes(tmpdir, monkeypatch, chunk_layout, pairwise):
+    raw = RawData(30)
+    kwargs = dict(time_step=2, batch_samples=8, scale_variables=True, chunk_size=4, chunk_layout=chunk_layout,
+                  pairwise=pairwise, levels=[500., 700.] if pairwise else 'all',
+                  variables=['HGT', 'HGT'] if pairwise else 'all')
+    pp = Preprocessor(raw, predictor_file=os.path.join(str(tmpdir), 'memory.nc'))
+    pp.data_to_samples(in_memory=True, **kwargs)
+    expected = pp.data.load()
+    pp.close()
+
+    CountingVariable.writes = []
+    monkeypatch.setattr(nc, 'Dataset', CountingDataset)
+    pp = Preprocessor(raw, predictor_file=os.path.join(str(tmpdir), 'samples.nc'))
+    pp.data_to_samples(**kwargs)
+    ds = pp.data
+    np.testing.assert_array_equal(ds['predictors'].values, expected['predictors'].values)
+    np.testing.assert_array_equal(ds['targets'].values, expected['targets'].values)
+    writes = [key for name, key in CountingVariable.writes if name == 'predictors']
+    if chunk_layout is None:
+        # One variable/level map of one time step for each batch: 2 variable/levels, 2 time steps, 4 batches
+        assert len(writes) == 2 * 2 * 4
+    else:
+        # Each chunk-aligned block of samples is written once, with every time step and variable/level
+        chunks = ds['predictors'].encoding['chunksizes']
+        assert len(writes) == int(np.ceil(27. / chunks[0] / max(1, 8 // chunks[0])))
+        assert all(isinstance(key, slice) and key.start % chunks[0] == 0 for key in writes)
+    pp.close()
@@ -0,0 +1,204 @@
+#
+# Copyright (c) 2019 Jonathan Weyn <jweyn@uw.edu>
+#
+# See the file LICENSE for your rights.
+#
+
+"""
+Tests for DLWP.util.
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('keras')
+pytest.importorskip('sklearn')
+from DLWP import util
+
+
+def _imputer():
+    try:
+        from sklearn.preprocessing import Imputer
+        return Imputer(missing_values=np.nan, strategy='mean', axis=0, copy=False)
+    except ImportError:
+        from sklearn.impute import SimpleImputer
+        return SimpleImputer(missing_values=np.nan, strategy='mean', copy=False)
+
+
+def _data(nan=False):
+    random = np.random.RandomState(0)
+    X = random.normal(10., 3., size=(50, 2, 3, 4)).astype(np.float32)
+    y = random.normal(-5., 2., size=(50, 2, 3, 4)).astype(np.float32)
+    if nan:
+        X[random.rand(*X.shape) < 0.1] = np.nan
+        y[random.rand(*y.shape) < 0.1] = np.nan
+    return X, y
+
+
+@pytest.mark.parametrize('impute', [False, True])
+@pytest.mark.parametrize('scaler_type', ['StandardScaler', 'MinMaxScaler'])
+def test_impute_scale_transform(impute, scaler_type):
+    pytest.importorskip('torch')
+    from DLWP.model import DLWPTorchNN
+    from sklearn.preprocessing import StandardScaler, MinMaxScaler
+
+    X, y = _data(nan=impute)
+    model = DLWPTorchNN(scaler_type=scaler_type, apply_same_y_scaling=False, impute_missing=impute)
+    if impute:
+        model.imputer = _imputer().fit(X.reshape((50, -1)))
+        model.imputer_y = _imputer().fit(y.reshape((50, -1)))
+        X_fit, y_fit = model.imputer_transform(X.copy(), y.copy())
+    else:
+        X_fit, y_fit = X, y
+    model.scaler_fit(X_fit, y_fit)
+
+    # Reference: the scikit-learn transforms
+    scaler = {'StandardScaler': StandardScaler, 'MinMaxScaler': MinMaxScaler}[scaler_type]()
+    scaler_y = {'StandardScaler': StandardScaler, 'MinMaxScaler': MinMaxScaler}[scaler_type]()
+    X_expected = scaler.fit(X_fit.reshape((50, -1))).transform(X_fit.reshape((50, -1))).reshape(X.shape)
+    y_expected = scaler_y.fit(y_fit.reshape((50, -1))).transform(y_fit.reshape((50, -1))).reshape(y.shape)
+
+    X_transform, y_transform = util.impute_scale_transform(model, X.copy(), y.copy())
+    np.testing.assert_allclose(X_transform, X_expected, rtol=1e-5, atol=1e-5)
+    np.testing.assert_allclose(y_transform, y_expected, rtol=1e-5, atol=1e-5)
+    np.testing.assert_allclose(util.impute_scale_transform(model, X.copy()), X_expected, rtol=1e-5, atol=1e-5)
+    assert (util.impute_scale_parameters(model) is False) == (scaler_type == 'MinMaxScaler')
+
+
+@pytest.mark.parametrize('scaler_type', ['StandardScaler', 'MinMaxScaler'])
+@pytest.mark.parametrize('apply_same_y_scaling', [True, False])
+@pytest.mark.parametrize('impute', [False, True])
+def test_streaming_init_fit(scaler_type, apply_same_y_scaling, impute):
+    pytest.importorskip('torch')
+    xr = pytest.importorskip('xarray')
+    from DLWP.model import DLWPTorchNN
+    import sklearn.preprocessing
+    if impute and not hasattr(sklearn.preprocessing, 'Imputer'):
+        pytest.skip('init_fit needs the Imputer of scikit-learn < 0.22')
+
+    X, y = _data(nan=impute)
+    ds = xr.Dataset({'predictors': (('sample', 'a', 'b', 'c'), X), 'targets': (('sample', 'a', 'b', 'c'), y)})
+    expected = DLWPTorchNN(scaler_type=scaler_type, apply_same_y_scaling=apply_same_y_scaling, impute_missing=impute)
+    expected.init_fit(X.copy(), y.copy())
+    model = DLWPTorchNN(scaler_type=scaler_type, apply_same_y_scaling=apply_same_y_scaling, impute_missing=impute)
+    model.init_fit_generator(ds, batch_size=7)
+    assert model._is_init_fit
+
+    attributes = ['mean_', 'var_', 'scale_'] if scaler_type == 'StandardScaler' else ['data_min_', 'data_max_',
+                                                                                     'scale_', 'min_']
+    for scaler, expected_scaler in [(model.scaler, expected.scaler), (model.scaler_y, expected.scaler_y)]:
+        for attribute in attributes:
+            np.testing.assert_allclose(getattr(scaler, attribute), getattr(expected_scaler, attribute), rtol=1e-5)
+    if impute:
+        np.testing.assert_allclose(model.imputer.statistics_, expected.imputer.statistics_, rtol=1e-5)
+        np.testing.assert_allclose(model.imputer_y.statistics_, expected.imputer_y.statistics_, rtol=1e-5)
+
+
+def _insolation_dates():
+    # Dates spanning leap and non-leap years, including leap days and year ends, at several times of day
+    days = np.array(['1999-12-31', '2000-01-01', '2000-02-28', '2000-02-29', '2000-03-01', '2000-12-31', '2001-02-28',
+                     '2001-03-01', '2001-06-21', '2004-02-29', '2010-12-31'], dtype='datetime64[ns]')
+    times = np.array([0, 3, 6, 12, 18], dtype='timedelta64[h]') + np.timedelta64(30, 'm') * np.array([0, 1, 0, 0, 1])
+    return (days[:, None] + times[None, :]).ravel()
+
+
+def _insolation_reference(dates, lat, lon, S=1.):
+    # The insolation as calculated one date at a time with pandas in earlier versions
+    lon, lat = np.meshgrid(lon, lat)
+    eps = 23.4441 * np.pi / 180.
+    ecc = 0.016715
+    om = 282.7 * np.pi / 180.
+    beta = np.sqrt(1 - ecc ** 2.)
+    days = pd.Series(pd.DatetimeIndex(dates)).apply(util.day_of_year)
+    lambda_m0 = ecc * (1. + beta) * np.sin(om)
+    lambda_m = lambda_m0 + 2. * np.pi * (days.values - 80.5) / 365.
+    lambda_ = lambda_m + 2. * ecc * np.sin(lambda_m - om)
+    dec = np.arcsin(np.sin(eps) * np.sin(lambda_))
+    h = 2 * np.pi * (days.values[:, None, None] + lon / 360.)
+    rho = (1. - ecc ** 2.) / (1. + ecc * np.cos(lambda_ - om))
+    lat = lat * np.pi / 180.
+    sol = S * (np.sin(lat[None, ...]) * np.sin(dec[:, None, None]) -
+               np.cos(lat[None, ...]) * np.cos(dec[:, None, None]) * np.cos(h)) * rho[:, None, None] ** -2.
+    sol[sol < 0.] = 0.
+    return sol.astype(np.float32)
+
+
+def test_insolation():
+    lat = np.linspace(90., -90., 7)
+    lon = np.arange(0., 360., 45.)
+    dates = _insolation_dates()
+    expected = _insolation_reference(dates, lat, lon, S=1361.)
+    np.testing.assert_allclose(util.insolation(dates, lat, lon, S=1361.), expected, rtol=1e-5, atol=1e-3)
+    # Python datetimes, small chunks, a preallocated output, and a 2d grid give the same result
+    lon2d, lat2d = np.meshgrid(lon, lat)
+    out = np.empty((len(dates),) + lat2d.shape, dtype=np.float32)
+    result = util.insolation(list(pd.DatetimeIndex(dates).to_pydatetime()), lat2d, lon2d, S=1361., out=out,
+                             chunk_size=4)
+    assert result is out
+    np.testing.assert_allclose(out, expected, rtol=1e-5, atol=1e-3)
+
+
+def test_insolation_table(tmpdir):
+    lat = np.linspace(90., -90., 7)
+    lon = np.arange(0., 360., 45.)
+    dates = _insolation_dates()
+    expected = util.insolation(dates, lat, lon, S=1361.)
+    cache_file = str(tmpdir.join('insolation.npz'))
+    table = util.InsolationTable(lat, lon, S=1361., cache_file=cache_file)
+    np.testing.assert_allclose(table(dates), expected, rtol=1e-6, atol=1e-4)
+    np.testing.assert_allclose(table(dates[::-1]), expected[::-1], rtol=1e-6, atol=1e-4)
+
+    # The table for each time of day is saved and loaded from the cache file
+    cached = util.InsolationTable(lat, lon, S=1361., cache_file=cache_file)
+    assert sorted(cached._table.keys()) == sorted(table._table.keys())
+    np.testing.assert_array_equal(cached(dates), table(dates))
+    assert util.InsolationTable(lat, lon, S=1., cache_file=cache_file)._table == {}
+
+
+def _delete_nan_samples_reference(predictors, targets, threshold=None):
+    # NaN samples found from the per-element NaN indices, as in earlier versions
+    if threshold is None:
+        p_ind = list(np.where(np.isnan(predictors.reshape((predictors.shape[0], -1))))[0])
+        t_ind = list(np.where(np.isnan(targets.reshape((targets.shape[0], -1))))[0])
+    else:
+        p_ind = list(np.where(np.mean(np.isnan(predictors.reshape((predictors.shape[0], -1))), axis=1) >=
+                              threshold)[0])
+        t_ind = list(np.where(np.mean(np.isnan(targets.reshape((targets.shape[0], -1))), axis=1) >= threshold)[0])
+    bad_ind = list(set(p_ind + t_ind))
+    return np.delete(predictors, bad_ind, axis=0), np.delete(targets, bad_ind, axis=0)
+
+
+@pytest.mark.parametrize('threshold', [None, 0., 0.05, 0.1, 1.])
+def test_delete_nan_samples(threshold):
+    X, y = _data(nan=True)
+    X_ref, y_ref = _delete_nan_samples_reference(X, y, threshold)
+    X_del, y_del = util.delete_nan_samples(X.copy(), y.copy(), threshold=threshold)
+    np.testing.assert_array_equal(X_del, X_ref)
+    np.testing.assert_array_equal(y_del, y_ref)
+    valid = util.valid_samples(X, threshold) & util.valid_samples(y, threshold)
+    assert valid.shape == (X.shape[0],)
+    np.testing.assert_array_equal(X[valid], X_ref)
+
+    # Large fill values are removed like NaN
+    X, y = _data()
+    X[[3, 7], 0, 1, 2] = 1.e20
+    y[11, 1, 2, 3] = -1.e20
+    X_ref, y_ref = X.copy(), y.copy()
+    X_ref[np.abs(X_ref) >= 1.e20] = np.nan
+    y_ref[np.abs(y_ref) >= 1.e20] = np.nan
+    X_ref, y_ref = _delete_nan_samples_reference(X_ref, y_ref, threshold)
+    X_del, y_del = util.delete_nan_samples(X, y, large_fill_value=True, threshold=threshold)
+    np.testing.assert_array_equal(X_del, X_ref)
+    np.testing.assert_array_equal(y_del, y_ref)
+
+    # Without NaN, the data are returned as they are; a threshold of 0 removes every sample, as before
+    X, y = _data()
+    X_del, y_del = util.delete_nan_samples(X, y, threshold=threshold)
+    if threshold == 0.:
+        assert X_del.shape[0] == 0 and y_del.shape[0] == 0
+    else:
+        assert X_del is X and y_del is y
+
+    with pytest.raises(ValueError):
+        util.delete_nan_samples(X, y, threshold=1.5)